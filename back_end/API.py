@@ -1,45 +1,200 @@
-import re
-import GoogleAPI
+import OTPStore
+import RateLimiter
+import Idempotency
+import Counting
+import Snapshots
+import Export
+import Profiling
+import ImageStore
+import Replicas
+import VoteJournal
+import Notifications
+import Turnout
+import Elections
+import Merkle
+import Compression
+import Health
+import tempfile
 from functools import wraps
-from sqlalchemy.orm import sessionmaker
-from datetime import timedelta
+from sqlalchemy.orm import sessionmaker, scoped_session
+from datetime import datetime, timedelta
 from decouple import config
-from flask import Flask, request, jsonify, make_response
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from flask import Flask, Blueprint, Response, request, jsonify, make_response, send_file, stream_with_context
+from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, verify_jwt_in_request
 from flask_cors import CORS
-from Models import Voter, Verification, Party, Candidate, engine, Constituency, Votes, VoteType
+from Models import Voter, Party, Candidate, engine, Constituency, Votes, VoteType, IdempotencyKey, RankedBallot, \
+    NotificationJob, TallySnapshot, Election, Candidacy, RejectedVote
 from sqlalchemy import func
-from flask_talisman import Talisman
-from back_end import Helpers
+from sqlalchemy.exc import IntegrityError
+import Security
+from werkzeug.middleware.proxy_fix import ProxyFix
+import Helpers
+import CircuitBreaker
+from sqlalchemy.exc import OperationalError, InterfaceError, TimeoutError as PoolTimeoutError
 
-app = Flask(__name__)
-talisman = Talisman(app)
+api = Blueprint('api', __name__)
 
-app.secret_key = config('SK')
-app.config['JWT_SECRET_KEY'] = config('SK')
-app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(minutes=10)
-app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
-CORS(app)
-
-jwt = JWTManager(app)
+# Read only routes are served from REPLICA_URLS while one of them is healthy and up to date
+replica_set = Replicas.ReplicaSet(engine)
 
 # Create a session factory
-Session = sessionmaker(bind=engine)
+Session = scoped_session(sessionmaker(class_=Replicas.RoutingSession, bind=engine, replicas=replica_set))
+
+# Use the session to interact with the database, each thread gets its own
+# session which is removed when the request finishes
+session = Session
+
+# Pending OTPs are kept out of the Voter tables and expire on their own
+otp_store = OTPStore.create_otp_store(sessionmaker(bind=engine))
+
+# Rejects abusive clients before any hashing, database or email work is done
+limiter = RateLimiter.RateLimiter()
+
+# Maps Idempotency-Key headers to the vote they created so retried submissions are not counted twice
+idempotency_store = Idempotency.IdempotencyStore(sessionmaker(bind=engine))
+
+# Records the tallies at a fixed interval for the results history
+snapshotter = Snapshots.Snapshotter(sessionmaker(bind=engine))
 
-# Use the session to interact with the database
-session = Session()
+# With VOTE_JOURNAL_DIR set votes are acknowledged once they are fsynced to a local
+# journal, and the replayer writes them to the database in the background
+vote_journal = VoteJournal.VoteJournal() if VoteJournal.VOTE_JOURNAL_DIR else None
+journal_replayer = VoteJournal.JournalReplayer(VoteJournal.VOTE_JOURNAL_DIR, sessionmaker(bind=engine),
+                                               idempotency_store,
+                                               Helpers.apply_vote_to_tally,
+                                               vote_journal) if vote_journal else None
+
+# Adds committed votes to their election's Merkle tree off the request path
+merkle_appender = Merkle.MerkleAppender(sessionmaker(bind=engine))
+
+# Party and candidate images, stored under the hash of their content
+image_store = ImageStore.ImageStore()
+
+# Sends election wide announcements in the background, NOTIFY_TRANSPORT=sink discards them
+notification_sender = Notifications.NotificationSender(sessionmaker(bind=engine),
+                                                       Notifications.create_transport())
+
+# Opens after repeated connection failures or timeouts, requests then get a 503 straight away
+# until a probe request finds the database answering again
+DATABASE_ERRORS = (OperationalError, InterfaceError, PoolTimeoutError)
+database_breaker = CircuitBreaker.CircuitBreaker('database', errors=DATABASE_ERRORS)
+CircuitBreaker.guard_engine(engine, database_breaker, DATABASE_ERRORS)
+
+# Liveness and readiness for the load balancer, counts the requests each worker is running
+health_check = Health.HealthCheck(engine, replica_set, notification_sender,
+                                  breakers=[database_breaker, Helpers.mail_breaker])
 
 # Constants
 GOV_ID_LENGTH = 8
 PASSWORD_LENGTH = 8
 max_positive_votes = 2
 max_negative_votes = 1
+ADMIN_PAGE_SIZE = 20
+ADMIN_MAX_PAGE_SIZE = 100
+ADMIN_RECENT_ITEMS = 5
+
+# Rate limits as (bucket name, requests, per seconds)
+VERIFICATION_IP_LIMIT = ("verification-ip", 10, 60)
+VERIFICATION_EMAIL_LIMIT = ("verification-email", 3, 600)
+LOGIN_IP_LIMIT = ("login-ip", 20, 60)
+LOGIN_GOV_ID_LIMIT = ("login-gov-id", 5, 60)
+VOTES_IP_LIMIT = ("votes-ip", 60, 60)
+VOTES_IDENTITY_LIMIT = ("votes-identity", 10, 60)
+
+
+def unavailable_response(error):
+    # As (body, status, headers), the async routes answer a CircuitOpen with the same
+    return {"message": f"Service temporarily unavailable, {error}"}, 503, \
+        {"Retry-After": str(int(error.retry_after) + 1)}
+
+
+def unavailable(error):
+    body, status, headers = unavailable_response(error)
+    response = make_response(jsonify(body), status)
+    response.headers.update(headers)
+    return response
+
+
+def database_failure(error):
+    # The CircuitOpen a database error is answered with, also used by the async routes.
+    # Statement errors are already counted by the engine hooks, waiting too long for a pooled connection is not.
+    if isinstance(error, PoolTimeoutError):
+        database_breaker.failure(error)
+    print(f"An error occurred: {error}")
+    return CircuitBreaker.CircuitOpen("database", database_breaker.reset_timeout)
+
+
+def bypasses_database_breaker(endpoint):
+    # The health routes report the breaker instead of being blocked by it, and
+    # journaled votes are accepted without the database
+    return endpoint in ("api.liveness", "api.readiness") or \
+        (vote_journal is not None and endpoint == "api.submit_vote")
+
+
+@api.before_request
+def check_database_breaker():
+    if bypasses_database_breaker(request.endpoint):
+        return None
+    if not database_breaker.allow():
+        return unavailable(CircuitBreaker.CircuitOpen("database", database_breaker.retry_after()))
+    return None
+
 
-# Regular expression that takes the first part of postcode
-postcode_regex = r'^[A-Z0-9]{3}([A-Z0-9](?=\s*[A-Z0-9]{3}|$))?'
+@api.errorhandler(OperationalError)
+@api.errorhandler(InterfaceError)
+@api.errorhandler(PoolTimeoutError)
+def database_unavailable(error):
+    circuit_open = database_failure(error)
+    Session.remove()
+    return unavailable(circuit_open)
 
 
-@app.route("/api/v1.0/register", methods=["POST"])
+@api.errorhandler(Idempotency.KeyReused)
+def idempotency_key_reused(error):
+    return make_response(jsonify({"message": "Idempotency-Key was already used for a different request"}), 422)
+
+
+@api.after_request
+def close_database_breaker(response):
+    # A probe request answered from the caches never runs a statement, it still counts as a success.
+    # A failure the route caught itself has already reopened the breaker, which ignores this.
+    if response.status_code < 500 and not bypasses_database_breaker(request.endpoint):
+        database_breaker.success()
+    return response
+
+
+def read_only(f):
+    # Runs the route's queries on a replica, unless the caller changed something in
+    # the last few seconds that they would expect to read back. Routes a voter reads
+    # straight after their own writes, their profile and remaining votes, always use the primary.
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        try:
+            verify_jwt_in_request(optional=True)
+            identity = get_jwt_identity()
+        except Exception:
+            identity = None
+
+        if identity is None or not replica_set.recently_wrote(identity):
+            session.info['read_only'] = True
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
+@api.after_request
+def remember_writer(response):
+    if Session.registry.has() and session.info.pop('wrote', False):
+        try:
+            identity = get_jwt_identity()
+        except Exception:
+            identity = None
+        if identity is not None:
+            replica_set.wrote(identity)
+    return response
+
+
+@api.route("/api/v1.0/register", methods=["POST"])
 def register():
     try:
         data = request.get_json()
@@ -64,14 +219,14 @@ def register():
         if len(password) < PASSWORD_LENGTH:
             return make_response(jsonify({"message": "Password must be at least 8 characters!"}), 400)
 
-        if not Helpers.verify_otp(email, otp, session):
+        if not Helpers.verify_otp(email, otp, otp_store):
             return make_response(jsonify({"message": "Invalid OTP or email"}), 400)
 
         # All validations passed, proceed with registration
 
         # Password is hashed before it is inserted into database
         hashed_pw = Helpers.encrypt_password(password)
-        c_id = Helpers.match_postcode_with_constituency(re.search(postcode_regex, postcode).group(0))
+        c_id = Helpers.match_postcode_with_constituency(Helpers.postcode_regex.search(postcode).group(0))
         gov_id = Helpers.gov_id_generator(GOV_ID_LENGTH)
 
         if Helpers.user_exists(email, session):
@@ -88,13 +243,17 @@ def register():
 
             # Add the new voter to the session
             session.add(new_voter)
+            Turnout.record_registration(session, Elections.active_election_id(session), c_id)
 
             # Commit the session to save the new voter to the database
             session.commit()
 
-            session.query(Verification).filter_by(email=email, otp=otp).delete()
-            session.commit()
-            Helpers.send_gov_id(email, gov_id)
+            otp_store.discard(email)
+            try:
+                Helpers.send_gov_id(email, gov_id)
+            except Exception as e:
+                # The voter is registered and the response carries their Government ID, the email is a copy
+                print(f"An error occurred: {e}")
 
             return make_response(jsonify({"message": "Success", "gov_id": new_voter.gov_id}), 201)
 
@@ -103,7 +262,9 @@ def register():
         return make_response(jsonify("An error occurred", 500))
 
 
-@app.route("/api/v1.0/verification", methods=["POST"])
+@api.route("/api/v1.0/verification", methods=["POST"])
+@limiter.limit(*VERIFICATION_IP_LIMIT, key="ip")
+@limiter.limit(*VERIFICATION_EMAIL_LIMIT, key="email")
 def verification():
     try:
         request_data = request.get_json()
@@ -120,26 +281,22 @@ def verification():
         # Use GoogleAPI to send email containing otp
         Helpers.send_otp(email, OTP)
 
-        user = session.query(Verification).filter_by(email=email).first()
-
-        if user:
-            # New otp will overwrite old one to prevent duplicate entries
-            session.query(Verification).filter_by(email=email).update({'otp': OTP})
-            session.commit()
-
-        else:
-            # Save the OTP and email as a temporary registration record
-            session.add(Verification(email=email, otp=OTP))
-            session.commit()
+        # New otp will overwrite old one and restart its expiry
+        otp_store.put(email, OTP)
 
         return make_response(jsonify({'message': 'OTP sent'}), 200)
 
+    except Helpers.CircuitOpen as e:
+        return unavailable(e)
+
     except Exception as e:
         print(f"An error occurred: {e}")
         return make_response("An error occurred", 500)
 
 
-@app.route("/api/v1.0/login", methods=["POST"])
+@api.route("/api/v1.0/login", methods=["POST"])
+@limiter.limit(*LOGIN_IP_LIMIT, key="ip")
+@limiter.limit(*LOGIN_GOV_ID_LIMIT, key="gov_id")
 def login():
     gov_id = request.form['gov_id']
     password = request.form['password']
@@ -148,11 +305,12 @@ def login():
 
     # Check if the user was found in the database
     if user:
-        if Helpers.check_password(password, Helpers.get_password(user.gov_id, session)):
+        if Helpers.check_password(password, user.password):
 
-            # Set gov_id as token identity
+            # Set gov_id as token identity, the claims let later requests skip the Voter lookup
             access_token = create_access_token(identity=gov_id,
-                                               expires_delta=timedelta(minutes=10))
+                                               additional_claims=Helpers.identity_claims(user),
+                                               expires_delta=timedelta(minutes=Helpers.TOKEN_LIFETIME_MINUTES))
 
             user_data = {
                 'voter_id': user.voter_id,
@@ -172,33 +330,29 @@ def login():
         return jsonify({'message': 'User not found.'}), 404
 
 
-@app.route('/api/v1.0/profile', methods=["GET"])
+@api.route('/api/v1.0/profile', methods=["GET"])
 @jwt_required()
 def profile():
     gov_id = get_jwt_identity()
 
-    user = session.query(Voter, Constituency) \
-        .join(Constituency, Voter.constituency_id == Constituency.constituency_id) \
-        .filter(Voter.gov_id == gov_id) \
-        .first()
+    user = Helpers.get_cached_identity(gov_id, session)
 
     if user is None:
         return jsonify({"message": "User not found"}), 404
 
-    voter, constituency = user
-
-    return jsonify({'first_name': voter.first_name,
-                    'last_name': voter.last_name,
-                    'gov_id': voter.gov_id,
-                    'constituency_name': constituency.constituency_name,
-                    'email': voter.email})
+    return jsonify({'first_name': user['first_name'],
+                    'last_name': user['last_name'],
+                    'gov_id': user['gov_id'],
+                    'constituency_name': user['constituency_name'],
+                    'email': user['email']})
 
 
 def admin_required(f):
     @wraps(f)
+    @jwt_required()
     def decorated_function(*args, **kwargs):
-        user = Helpers.get_user_from_request(session)
-        if user is None or not user.isAdmin:
+        user = Helpers.get_identity(session)
+        if user is None or not user['isAdmin']:
             response = jsonify({'message': 'Admin access required'})
             response.status_code = 403
             return response
@@ -207,48 +361,37 @@ def admin_required(f):
     return decorated_function
 
 
-@app.route("/api/v1.0/parties", methods=["GET"])
+@api.route("/api/v1.0/parties", methods=["GET"])
+@read_only
 def show_all_parties():
-    session = Session()
-    parties = session.query(Party).all()
-
-    party_list = []
-    for party in parties:
-        item_dict = {"party_id": party.party_id,
-                     "party_name": party.party_name,
-                     "image": party.image,
-                     "manifesto": party.manifesto}
-        party_list.append(item_dict)
-        session.close()
-    return make_response(jsonify(party_list), 200)
+    # Names and images only, ?excerpt=<n> adds the first n characters of each manifesto
+    excerpt = Helpers.excerpt_length(request.args.get("excerpt", 0, type=int))
+    return make_response(jsonify(Helpers.get_party_list(session, excerpt)), 200)
 
 
-@app.route("/api/v1.0/parties/<id>", methods=["GET"])
+@api.route("/api/v1.0/parties/<id>", methods=["GET"])
+@read_only
 def show_one_party(id):
-    party = session.query(Party).filter(Party.party_id == id).first()
+    party = session.execute(Helpers.party_detail_query(id)).scalars().first()
 
     if not party:
         return make_response(jsonify({"error": "Party not found"}), 404)
 
-    party_dict = {
-        "party_id": party.party_id,
-        "party_name": party.party_name,
-        "image": party.image,
-        "manifesto": party.manifesto
-    }
-
-    return make_response(jsonify(party_dict), 200)
+    return make_response(jsonify(Helpers.party_to_dict(party)), 200)
 
 
-@app.route("/api/v1.0/parties", methods=["POST"])
+@api.route("/api/v1.0/parties", methods=["POST"])
 @admin_required
 def add_party():
     if "party_name" in request.form \
             and "image" in request.form \
             and "manifesto" in request.form:
         pn = request.form["party_name"]
-        im = request.form["image"]
         ma = request.form["manifesto"]
+        try:
+            im = image_store.ingest(request.form["image"], request.host_url)
+        except ImageStore.ImageError as e:
+            return make_response(jsonify({"message": str(e)}), 400)
 
         party = session.query(Party).filter_by(party_name=pn).first()
         if party:
@@ -266,19 +409,23 @@ def add_party():
 
             session.add(new_party)
             session.commit()
+            Helpers.invalidate_catalog()
 
         return make_response(jsonify({"message": "Party created", "party_id": new_party.party_id}), 201)
 
 
-@app.route("/api/v1.0/parties/<id>", methods=["PUT"])
+@api.route("/api/v1.0/parties/<id>", methods=["PUT"])
 @admin_required
 def edit_party(id):
     if "party_name" in request.form \
             and "image" in request.form \
             and "manifesto" in request.form:
         pn = request.form["party_name"]
-        im = request.form["image"]
         ma = request.form["manifesto"]
+        try:
+            im = image_store.ingest(request.form["image"], request.host_url)
+        except ImageStore.ImageError as e:
+            return make_response(jsonify({"message": str(e)}), 400)
 
         party = session.query(Party).filter_by(party_id=id).first()
 
@@ -295,13 +442,14 @@ def edit_party(id):
             party.manifesto = ma
 
             session.commit()
+            Helpers.invalidate_catalog()
 
         return make_response(jsonify("Party updated"), 200)
     else:
         return make_response("Invalid request", 400)
 
 
-@app.route("/api/v1.0/parties/<id>", methods=["DELETE"])
+@api.route("/api/v1.0/parties/<id>", methods=["DELETE"])
 @admin_required
 def delete_party(id):
     party = session.query(Party).filter_by(party_id=id).first()
@@ -311,67 +459,32 @@ def delete_party(id):
 
     session.delete(party)
     session.commit()
+    Helpers.invalidate_catalog()
 
     return make_response(jsonify('Party deleted'), 200)
 
 
-@app.route("/api/v1.0/candidates", methods=["GET"])
+@api.route("/api/v1.0/candidates", methods=["GET"])
+@read_only
 def show_all_candidates():
-    session = Session()
-    try:
-        candidate_list = []
-        query = session.query(Candidate, Party.party_name) \
-            .select_from(Candidate) \
-            .join(Party, Candidate.party_id == Party.party_id) \
-            .all()
-
-        for candidate, party_name in query:
-            candidate_dict = {
-                "candidate_id": candidate.candidate_id,
-                "candidate_firstname": candidate.candidate_firstname,
-                "candidate_lastname": candidate.candidate_lastname,
-                "party_id": candidate.party_id,
-                "image": candidate.image,
-                "statement": candidate.statement,
-                "party_name": party_name
-            }
-            candidate_list.append(candidate_dict)
-
-        return make_response(jsonify(candidate_list), 200)
-    finally:
-        session.close()
+    # ?excerpt=<n> adds the first n characters of each statement
+    excerpt = Helpers.excerpt_length(request.args.get("excerpt", 0, type=int))
+    return make_response(jsonify(Helpers.get_candidate_list(session, excerpt)), 200)
 
 
-@app.route("/api/v1.0/candidates/<id>", methods=["GET"])
+@api.route("/api/v1.0/candidates/<id>", methods=["GET"])
+@read_only
 def show_one_candidate(id):
     candidate_list = []
 
-    candidate = (
-        session.query(Candidate, Party, Constituency)
-        .join(Party, Candidate.party_id == Party.party_id)
-        .join(Constituency, Candidate.constituency_id == Constituency.constituency_id)
-        .filter(Candidate.candidate_id == id)
-        .first()
-    )
+    candidate = session.execute(Helpers.candidate_detail_query(id)).first()
 
     if candidate:
-        cand, party, constituency = candidate
-        candidate_dict = {
-            "candidate_id": cand.candidate_id,
-            "candidate_firstname": cand.candidate_firstname,
-            "candidate_lastname": cand.candidate_lastname,
-            "party_id": party.party_id,
-            "image": cand.image,
-            "statement": cand.statement,
-            "party_name": party.party_name,
-            "party_image": party.image,
-            "constituency_name": constituency.constituency_name,
-        }
-        candidate_list.append(candidate_dict)
+        candidate_list.append(Helpers.candidate_detail_to_dict(*candidate))
     return make_response(jsonify(candidate_list), 200)
 
 
-@app.route("/api/v1.0/candidates/<id>", methods=["PUT"])
+@api.route("/api/v1.0/candidates/<id>", methods=["PUT"])
 @admin_required
 def edit_candidate(id):
     if "candidate_firstname" in request.form \
@@ -383,9 +496,12 @@ def edit_candidate(id):
         fn = request.form["candidate_firstname"]
         ln = request.form["candidate_lastname"]
         p_id = request.form["party_id"]
-        im = request.form["image"]
         c_id = request.form["constituency_id"]
         st = request.form["statement"]
+        try:
+            im = image_store.ingest(request.form["image"], request.host_url)
+        except ImageStore.ImageError as e:
+            return make_response(jsonify({"message": str(e)}), 400)
 
         candidate = session.query(Candidate).filter_by(candidate_id=id).first()
         if not candidate:
@@ -402,11 +518,12 @@ def edit_candidate(id):
         candidate.statement = st
 
         session.commit()
+        Helpers.invalidate_catalog()
 
     return make_response(jsonify("Candidate updated"), 200)
 
 
-@app.route("/api/v1.0/candidates", methods=["POST"])
+@api.route("/api/v1.0/candidates", methods=["POST"])
 @admin_required
 def add_candidate():
     if "candidate_firstname" in request.form \
@@ -418,9 +535,12 @@ def add_candidate():
         fn = request.form["candidate_firstname"]
         ln = request.form["candidate_lastname"]
         p_id = request.form["party_id"]
-        im = request.form["image"]
         c_id = request.form["constituency_id"]
         st = request.form["statement"]
+        try:
+            im = image_store.ingest(request.form["image"], request.host_url)
+        except ImageStore.ImageError as e:
+            return make_response(jsonify({"message": str(e)}), 400)
 
         candidate = session.query(Candidate).filter_by(candidate_firstname=fn, candidate_lastname=ln).first()
         if candidate:
@@ -440,6 +560,7 @@ def add_candidate():
 
             session.add(new_candidate)
             session.commit()
+            Helpers.invalidate_catalog()
 
             return make_response(jsonify({"message": "Candidate added", "candidate_id": new_candidate.candidate_id}),
                                  201)
@@ -447,7 +568,7 @@ def add_candidate():
         return make_response("Invalid request", 400)
 
 
-@app.route("/api/v1.0/candidates/<id>", methods=["DELETE"])
+@api.route("/api/v1.0/candidates/<id>", methods=["DELETE"])
 @admin_required
 def delete_candidate(id):
     candidate = session.query(Candidate).filter_by(candidate_id=id).first()
@@ -457,11 +578,12 @@ def delete_candidate(id):
 
     session.delete(candidate)
     session.commit()
+    Helpers.invalidate_catalog()
 
     return make_response(jsonify('Candidate deleted'), 200)
 
 
-@app.route("/api/v1.0/voters", methods=["GET"])
+@api.route("/api/v1.0/voters", methods=["GET"])
 def show_all_voters():
     voters = session.query(Voter).all()
 
@@ -480,7 +602,7 @@ def show_all_voters():
     return make_response(jsonify(voter_list), 200)
 
 
-@app.route("/api/v1.0/profile/<g_id>", methods=["PUT"])
+@api.route("/api/v1.0/profile/<g_id>", methods=["PUT"])
 @jwt_required()
 def update_password(g_id):
     if "password" in request.form \
@@ -502,15 +624,19 @@ def update_password(g_id):
         voter.password = Helpers.encrypt_password(pw)
         session.commit()
 
-        GoogleAPI.send_message(GoogleAPI.service, email, "Password Change", "Hi, your password has been changed on "
-                                                                            "the Online Election System")
+        try:
+            Helpers.send_mail(email, "Password Change", "Hi, your password has been changed on "
+                                                        "the Online Election System")
+        except Exception as e:
+            # The password has already changed, only the notice was not sent
+            print(f"An error occurred: {e}")
 
         return jsonify({"message": "Password successfully updated!"}), 200
     else:
         return jsonify({"message": "Password field is missing in the request."}), 400
 
 
-@app.route("/api/v1.0/profile/<g_id>", methods=["DELETE"])
+@api.route("/api/v1.0/profile/<g_id>", methods=["DELETE"])
 @admin_required
 def delete_voter(g_id):
     user = session.query(Voter).filter_by(gov_id=g_id).first()
@@ -518,94 +644,335 @@ def delete_voter(g_id):
     if not user:
         return make_response("User not found", 404)
 
+    Turnout.record_removal(session, user, Elections.active_election_id(session))
     session.delete(user)
     session.commit()
+    Helpers.invalidate_identity(g_id)
 
     return make_response('User deleted', 200)
 
 
-@app.route("/api/v1.0/votes", methods=["POST"])
+@api.route("/api/v1.0/votes", methods=["POST"])
+@limiter.limit(*VOTES_IP_LIMIT, key="ip")
 @jwt_required()
+@limiter.limit(*VOTES_IDENTITY_LIMIT, key="identity")
 def submit_vote():
-    if "voter_id" in request.json and "candidate_id" in request.json and "vote_type" in request.json:
-        voter_id = request.json["voter_id"]
+    if "candidate_id" in request.json and "vote_type" in request.json:
+        # The voter always comes from the token, never from the request body
+        identity = Helpers.get_identity(session)
+        if identity is None:
+            return make_response(jsonify({"message": "User not found"}), 404)
+
+        voter_id = identity['voter_id']
+        if "voter_id" in request.json and str(request.json["voter_id"]) != str(voter_id):
+            return make_response(jsonify({"message": "Votes can only be cast for yourself"}), 403)
+
+        idempotency_key = request.headers.get("Idempotency-Key")
+        if idempotency_key is not None and not Idempotency.valid_key(idempotency_key):
+            return make_response(jsonify({"message": "Invalid Idempotency-Key"}), 400)
+        request_hash = Idempotency.request_hash(request.json) if idempotency_key is not None else None
+
         candidate_id = request.json["candidate_id"]
         vote_type = VoteType(request.json["vote_type"])
 
-        # Check if the user has reached the maximum allowed votes for the given vote_type
-        existing_votes = session.query(Votes).filter_by(voter_id=voter_id, vote_type=vote_type.value).count()
         if vote_type == VoteType.POSITIVE:
             max_votes = max_positive_votes  # = 2
         else:
-            max_votes = 1  # if vote_type is not positive it is negative
-        if existing_votes >= max_votes:
-            return make_response(
-                jsonify({"message": f"User has already cast {max_votes} votes of type {vote_type.name}"}), 403)
+            max_votes = max_negative_votes  # if vote_type is not positive it is negative
+
+        if vote_journal is not None:
+            return journal_vote(voter_id, candidate_id, vote_type, max_votes, idempotency_key, request_hash)
+
+        # A retry of a vote that was already stored gets the original response back
+        if idempotency_key is not None:
+            vote_id = idempotency_store.lookup(session, voter_id, idempotency_key, request_hash)
+            if vote_id is not None:
+                return vote_submitted(vote_id, replayed=True)
+
+        election_id = Elections.active_election_id(session)
+        if election_id is None:
+            return no_open_election()
 
         candidate = session.query(Candidate).filter_by(candidate_id=candidate_id).first()
         if not candidate:
             return make_response(jsonify("Candidate not found"), 404)
 
-        new_vote = Votes(voter_id=voter_id, candidate_id=candidate_id, vote_type=vote_type.value)
-        session.add(new_vote)
-
-        # Ensure candidate vote number cannot be a negative value
-        if vote_type.value == 1 or (vote_type.value == -1 and candidate.vote_count > 0):
-            candidate.vote_count += vote_type.value
+        # Each attempt claims a free slot, losing a race for it means another
+        # request from this voter got there first so the free slots are read again
+        for attempt in range(max_votes + 1):
+            slot = Helpers.free_vote_slot(session, election_id, voter_id, vote_type.value, max_votes)
+            if slot is None:
+                return make_response(
+                    jsonify({"message": f"User has already cast {max_votes} votes of type {vote_type.name}"}), 403)
+
+            new_vote = Votes(election_id=election_id, voter_id=voter_id, candidate_id=candidate_id,
+                             vote_type=vote_type.value, slot=slot)
+            try:
+                session.add(new_vote)
+                Helpers.apply_vote_to_tally(session, candidate_id, vote_type.value)
+                Turnout.record_vote(session, voter_id, election_id)
+                if idempotency_key is not None:
+                    session.flush()
+                    idempotency_store.record(session, voter_id, idempotency_key, new_vote.vote_id, request_hash)
+                session.commit()
+                break
+            except IntegrityError:
+                session.rollback()
+                # A concurrent retry with the same key may have committed first, return its vote instead
+                vote_id = idempotency_store.lookup(session, voter_id, idempotency_key, request_hash) \
+                    if idempotency_key else None
+                if vote_id is not None:
+                    return vote_submitted(vote_id, replayed=True)
+        else:
+            return make_response(jsonify({"message": "Vote could not be recorded, please try again"}), 409)
 
-        session.commit()
+        if idempotency_key is not None:
+            idempotency_store.remember(voter_id, idempotency_key, new_vote.vote_id, request_hash)
 
-        return make_response(jsonify({"message": "Vote submitted", "vote_id": new_vote.vote_id}), 201)
+        return vote_submitted(new_vote.vote_id)
     else:
         return make_response(jsonify({"message": "Invalid request"}), 400)
 
 
-@app.route("/api/v1.0/votes/<vote_id>", methods=["DELETE"])
+def no_open_election():
+    return make_response(jsonify({"message": "No election is open"}), 403)
+
+
+def vote_submitted(vote_id, replayed=False):
+    response = make_response(jsonify({"message": "Vote submitted", "vote_id": vote_id}), 201)
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def journal_vote(voter_id, candidate_id, vote_type, max_votes, idempotency_key, request_hash):
+    # Checked against the journal and cached reads of the database, so a database stall only holds
+    # up a voter whose slots this worker has not read lately. The replayer settles a slot another
+    # worker gave out in the meantime, a vote it rejects is reported by journaled_vote_status.
+    if idempotency_key is not None:
+        entry = vote_journal.find_key(voter_id, idempotency_key)
+        if entry is not None:
+            Idempotency.check_request(entry.get('request_hash'), request_hash)
+            return vote_journaled(entry, replayed=True)
+        vote_id = idempotency_store.cached(session, voter_id, idempotency_key, request_hash)
+        if vote_id is not None:
+            return vote_submitted(vote_id, replayed=True)
+
+    if not vote_journal.ready:
+        # Only before the replayer has first run in this process
+        journal_replayer.refresh()
+    if vote_journal.election_id is None:
+        return no_open_election()
+    if not vote_journal.standing(candidate_id):
+        return make_response(jsonify("Candidate not found"), 404)
+
+    # The voter's slots in the database are read again every few seconds, a worker that
+    # has not read them lately answers 503 rather than accept a vote it cannot check
+    election_id = vote_journal.election_id
+    if not vote_journal.has_stored_slots(election_id, voter_id, vote_type.value) and not database_breaker.allow():
+        return unavailable(CircuitBreaker.CircuitOpen("database", database_breaker.retry_after()))
+    stored = vote_journal.stored_slots(session, election_id, voter_id, vote_type.value)
+
+    try:
+        entry = vote_journal.accept(election_id, voter_id, int(candidate_id), vote_type.value, max_votes, stored,
+                                    idempotency_key, request_hash)
+    except VoteJournal.AppendError as e:
+        print(f"An error occurred: {e}")
+        return make_response(jsonify({"message": "Vote could not be recorded, please try again"}), 503)
+
+    if entry is None:
+        return make_response(
+            jsonify({"message": f"User has already cast {max_votes} votes of type {vote_type.name}"}), 403)
+    # A concurrent request with the same key may have been journaled first
+    Idempotency.check_request(entry.get('request_hash'), request_hash)
+    return vote_journaled(entry)
+
+
+def vote_journaled(entry, replayed=False):
+    # Accepted rather than created, the vote reaches the database when the journal is replayed
+    response = make_response(jsonify({"message": "Vote submitted", "journal_id": entry['id']}), 202)
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+@api.route("/api/v1.0/votes/journal/<journal_id>", methods=["GET"])
+@jwt_required()
+def journaled_vote_status(journal_id):
+    # What became of a vote answered with 202, pending until the replayer has written or rejected it
+    identity = Helpers.get_identity(session)
+    if identity is None:
+        return make_response(jsonify({"message": "User not found"}), 404)
+    voter_id = identity['voter_id']
+
+    rejected = session.query(RejectedVote).filter_by(journal_id=journal_id, voter_id=voter_id).first()
+    if rejected is not None:
+        return jsonify({"status": "rejected", "reason": rejected.reason})
+    vote_id = session.query(IdempotencyKey.vote_id).filter_by(journal_id=journal_id, voter_id=voter_id).scalar()
+    if vote_id is not None:
+        return jsonify({"status": "accepted", "vote_id": vote_id})
+    if vote_journal is None:
+        return make_response(jsonify({"message": "Vote not found"}), 404)
+    # Still in this worker's journal, or in another worker's
+    return jsonify({"status": "pending"})
+
+
+@api.route("/api/v1.0/ballots", methods=["POST"])
+@limiter.limit(*VOTES_IP_LIMIT, key="ip")
+@jwt_required()
+@limiter.limit(*VOTES_IDENTITY_LIMIT, key="identity")
+def submit_ballot():
+    # A voter's positive and negative votes in one request, written together or not at all
+    identity = Helpers.get_identity(session)
+    if identity is None:
+        return make_response(jsonify({"message": "User not found"}), 404)
+    voter_id = identity['voter_id']
+
+    data = request.get_json(silent=True) or {}
+    try:
+        choices = {VoteType.POSITIVE: [int(candidate_id) for candidate_id in data.get("positive", [])],
+                   VoteType.NEGATIVE: [int(candidate_id) for candidate_id in data.get("negative", [])]}
+    except (TypeError, ValueError):
+        return make_response(jsonify({"message": "Invalid request"}), 400)
+    if not any(choices.values()):
+        return make_response(jsonify({"message": "Invalid request"}), 400)
+
+    idempotency_key = request.headers.get("Idempotency-Key")
+    request_hash = None
+    if idempotency_key is not None:
+        if not Idempotency.valid_key(idempotency_key):
+            return make_response(jsonify({"message": "Invalid Idempotency-Key"}), 400)
+        request_hash = Idempotency.request_hash(data)
+        vote_id = idempotency_store.lookup(session, voter_id, idempotency_key, request_hash)
+        if vote_id is not None:
+            return ballot_replayed(vote_id)
+
+    election_id = Elections.active_election_id(session)
+    if election_id is None:
+        return no_open_election()
+
+    candidate_ids = set(choices[VoteType.POSITIVE]) | set(choices[VoteType.NEGATIVE])
+    standing, used = Helpers.ballot_state(session, election_id, voter_id, identity['constituency_id'], candidate_ids)
+    if standing != candidate_ids:
+        return make_response(jsonify({"message": "Candidate not found"}), 404)
+
+    votes = []
+    for vote_type, max_votes in ((VoteType.POSITIVE, max_positive_votes), (VoteType.NEGATIVE, max_negative_votes)):
+        taken = used.get(vote_type.value, set())
+        free = [slot for slot in range(max_votes) if slot not in taken]
+        if vote_journal is not None:
+            # Votes still waiting in the journal count against the limit too, they get their slots when replayed
+            free = free[:max(len(free) - len(vote_journal.pending_slots(election_id, voter_id, vote_type.value)), 0)]
+        if len(choices[vote_type]) > len(free):
+            return make_response(
+                jsonify({"message": f"User has {len(free)} votes of type {vote_type.name} remaining"}), 403)
+        votes += [Votes(election_id=election_id, voter_id=voter_id, candidate_id=candidate_id,
+                        vote_type=vote_type.value, slot=slot)
+                  for candidate_id, slot in zip(choices[vote_type], free)]
+
+    try:
+        session.add_all(votes)
+        for vote in votes:
+            Helpers.apply_vote_to_tally(session, vote.candidate_id, vote.vote_type)
+        Turnout.record_vote(session, voter_id, election_id)
+        session.flush()
+        if idempotency_key is not None:
+            idempotency_store.record(session, voter_id, idempotency_key, votes[0].vote_id, request_hash)
+        session.commit()
+    except IntegrityError:
+        # Another vote from this voter took one of the slots first, nothing from this ballot was kept
+        session.rollback()
+        vote_id = idempotency_store.lookup(session, voter_id, idempotency_key, request_hash) \
+            if idempotency_key else None
+        if vote_id is not None:
+            return ballot_replayed(vote_id)
+        return make_response(jsonify({"message": "Ballot could not be recorded, please try again"}), 409)
+
+    if idempotency_key is not None:
+        idempotency_store.remember(voter_id, idempotency_key, votes[0].vote_id, request_hash)
+    return make_response(jsonify({"message": "Ballot submitted", "vote_ids": [vote.vote_id for vote in votes]}), 201)
+
+
+def ballot_replayed(first_vote_id):
+    # A retried ballot gets back every vote the voter now has in the election its first vote went to
+    first_vote = session.get(Votes, first_vote_id)
+    vote_ids = [vote_id for vote_id, in session.query(Votes.vote_id)
+                .filter_by(election_id=first_vote.election_id, voter_id=first_vote.voter_id)
+                .order_by(Votes.vote_id)] if first_vote else [first_vote_id]
+    response = make_response(jsonify({"message": "Ballot submitted", "vote_ids": vote_ids}), 201)
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+@api.route("/api/v1.0/votes/<vote_id>", methods=["DELETE"])
 @admin_required
 def delete_vote(vote_id):
     vote = session.query(Votes).filter_by(vote_id=vote_id).first()
     if vote:
         candidate_id = vote.candidate_id
+        election_id = vote.election_id
+        idempotency_store.delete_vote(session, vote.vote_id)
         session.delete(vote)
         session.commit()
 
-        # Update the vote count for the candidate
-        vote_count = Helpers.get_vote_count(candidate_id, session)
-        candidate = session.query(Candidate).filter_by(candidate_id=candidate_id).first()
-        if candidate:
-            candidate.vote_count = vote_count
+        # Update the vote count for the candidate, a closed election keeps its count in Candidacy
+        vote_count = Helpers.get_vote_count(candidate_id, session, election_id)
+        if session.query(Candidacy).filter_by(election_id=election_id, candidate_id=candidate_id) \
+                .update({Candidacy.vote_count: vote_count}, synchronize_session=False):
             session.commit()
+        else:
+            candidate = session.query(Candidate).filter_by(candidate_id=candidate_id).first()
+            if candidate:
+                candidate.vote_count = vote_count
+                session.commit()
 
         return make_response(jsonify({"message": "Vote deleted", "vote_id": vote_id}), 200)
     else:
         return make_response(jsonify({"message": "Vote not found"}), 404)
 
 
-@app.route("/api/v1.0/remaining-votes/<voter_id>", methods=["GET"])
+@api.route("/api/v1.0/remaining-votes/<voter_id>", methods=["GET"])
 @jwt_required()
 def get_remaining_votes(voter_id):
-    positive_votes = session.query(Votes) \
-        .filter_by(voter_id=voter_id, vote_type=VoteType.POSITIVE.value) \
-        .count()
-    negative_votes = session.query(Votes) \
-        .filter_by(voter_id=voter_id, vote_type=VoteType.NEGATIVE.value) \
-        .count()
-
-    remaining_positive_votes = max_positive_votes - positive_votes
-    remaining_negative_votes = max_negative_votes - negative_votes
-
-    return jsonify({
-        "remaining_positive_votes": remaining_positive_votes,
-        "remaining_negative_votes": remaining_negative_votes
-    })
+    election_id = Elections.latest_election_id(session)
+    used = dict(session.execute(Helpers.used_vote_counts_query(election_id, voter_id)).all())
+    return jsonify(remaining_votes(election_id, voter_id, used))
+
+
+def remaining_votes(election_id, voter_id, used):
+    # used is the number of each type of vote stored in the database, shared with the async route
+    remaining = {}
+    for vote_type, max_votes in ((VoteType.POSITIVE, max_positive_votes), (VoteType.NEGATIVE, max_negative_votes)):
+        count = used.get(vote_type.value, 0)
+        if vote_journal is not None:
+            # Votes still waiting in the journal count against the limit too, their slots are given out when replayed
+            count += len(vote_journal.pending_slots(election_id, int(voter_id), vote_type.value))
+        remaining[vote_type] = max(max_votes - count, 0)
+    return {
+        "remaining_positive_votes": remaining[VoteType.POSITIVE],
+        "remaining_negative_votes": remaining[VoteType.NEGATIVE]
+    }
 
 
-@app.route("/api/v1.0/votes", methods=["DELETE"])
+@api.route("/api/v1.0/votes", methods=["DELETE"])
 @admin_required
 def reset_election():
-    # Delete all vote entries
-    session.query(Votes).delete()
+    # Starts the open election over, closed elections are never touched
+    election_id = Elections.active_election_id(session)
+    if election_id is None:
+        return no_open_election()
+
+    # Votes still in the journal were cast before the reset, so they are written first and cleared with the rest
+    if journal_replayer is not None:
+        journal_replayer.replay()
+
+    # Delete the election's vote entries and the keys that replay them
+    idempotency_store.clear(session, election_id)
+    session.query(Votes).filter(Votes.election_id == election_id).delete(synchronize_session=False)
+    Merkle.reset(session, election_id)
     session.commit()
+    if vote_journal is not None:
+        vote_journal.forget_slots()
 
     # Update the vote_count for all candidates
     candidates = session.query(Candidate).all()
@@ -613,46 +980,494 @@ def reset_election():
         candidate.vote_count = 0
         session.commit()
 
+    # Voters who only cast a ranked ballot still count as having voted
+    Turnout.rebuild(session, election_id)
+    session.commit()
+
     return make_response(jsonify({"message": "Election Reset"}), 200)
 
 
-@app.route("/api/v1.0/profile/<gov_id>/make-admin", methods=["PATCH"])
+@api.route("/api/v1.0/profile/<gov_id>/make-admin", methods=["PATCH"])
 @jwt_required()
 @admin_required
 def make_user_admin(gov_id):
-    user = Voter.get_gov_id(gov_id)
+    user = Helpers.get_gov_id(gov_id, session)
     if not user:
         return make_response(jsonify({"message": "User not found"}), 404)
 
     user.isAdmin = True
+    Helpers.expire_token_claims(user)
     session.commit()
+    Helpers.invalidate_identity(gov_id)
     return make_response(jsonify({"message": "User is now an admin"}), 200)
 
 
-@app.route("/api/v1.0/voting-data", methods=["GET"])
+@api.route("/api/v1.0/images", methods=["POST"])
+@admin_required
+def upload_image():
+    # Accepts a file upload or a data URI, returns the URLs of the image and its thumbnails
+    try:
+        if "image" in request.files:
+            name = image_store.put(request.files["image"].read())
+        elif request.form.get("image", "").startswith("data:"):
+            name = image_store.put(ImageStore.decode_data_uri(request.form["image"]))
+        else:
+            return make_response(jsonify({"message": "No image provided"}), 400)
+    except ImageStore.ImageError as e:
+        return make_response(jsonify({"message": str(e)}), 400)
+
+    url = image_store.url(name, request.host_url)
+    return make_response(jsonify({"image": url,
+                                  "thumbnails": {size: ImageStore.thumbnail_url(url, size)
+                                                 for size in ImageStore.THUMBNAIL_SIZES}}), 201)
+
+
+@api.route("/api/v1.0/images/<name>", methods=["GET"])
+def get_image(name):
+    try:
+        path = image_store.resolve(name)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        path = None
+
+    if path is None:
+        return make_response(jsonify({"message": "Image not found"}), 404)
+
+    # The name is the hash of the content, so the response never changes
+    response = send_file(path, mimetype=ImageStore.CONTENT_TYPES[path.rsplit('.', 1)[1]], etag=name,
+                         max_age=ImageStore.IMAGE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@api.route("/api/v1.0/voting-data", methods=["GET"])
+@read_only
 def get_voting_data():
-    candidates = session.query(Candidate, Party) \
-        .join(Party, Candidate.party_id == Party.party_id) \
-        .all()
+    candidates = session.execute(Helpers.voting_data_query()).all()
 
     # Calculate the total number of votes
-    total_votes = session.query(func.sum(Candidate.vote_count)).scalar()
+    total_votes = session.execute(Helpers.total_votes_query()).scalar()
 
     # Prepare the voting data
     voting_data = []
     for candidate, party in candidates:
-        voting_data.append({
-            "candidate_id": candidate.candidate_id,
-            "candidate_name": f"{candidate.candidate_firstname} {candidate.candidate_lastname}",
-            "party_id": party.party_id,
-            "party_name": party.party_name,
-            "vote_count": candidate.vote_count,
-            "candidate_image": candidate.image,
-            "vote_percentage": (candidate.vote_count / total_votes) * 100 if total_votes else 0
-        })
+        voting_data.append(Helpers.voting_data_to_dict(candidate, party, total_votes))
 
     return jsonify(voting_data)
 
 
+@api.route("/api/v1.0/voting-data/history", methods=["GET"])
+@read_only
+def get_voting_history():
+    try:
+        end = datetime.fromisoformat(request.args["to"]) if "to" in request.args else datetime.utcnow()
+        start = datetime.fromisoformat(request.args["from"]) if "from" in request.args else end - timedelta(days=1)
+    except ValueError:
+        return make_response(jsonify({"message": "from and to must be ISO 8601 timestamps"}), 400)
+
+    points = request.args.get("points", 200, type=int)
+    if start >= end or not 0 < points <= Snapshots.MAX_HISTORY_POINTS:
+        return make_response(jsonify({"message": "Invalid range"}), 400)
+
+    election_id = request.args.get("election_id", type=int) or Elections.latest_election_id(session)
+    return make_response(jsonify(Snapshots.get_history(session, election_id, start, end, points)), 200)
+
+
+@api.route("/api/v1.0/export/<table>", methods=["GET"])
+@admin_required
+def export_table(table):
+    if table not in Export.EXPORTS:
+        return make_response(jsonify({"message": "Unknown table"}), 404)
+
+    file_format = request.args.get("format", "csv")
+    constituency_id = request.args.get("constituency_id", type=int)
+
+    # Exports get their own session so the stream can outlive the request session
+    export_session = sessionmaker(bind=engine)()
+
+    if file_format == "csv":
+        def generate():
+            try:
+                yield from Export.stream_csv(export_session, table, constituency_id)
+            finally:
+                export_session.close()
+
+        response = Response(stream_with_context(generate()), mimetype="text/csv")
+        response.headers["Content-Disposition"] = f"attachment; filename={table}.csv"
+        return response
+
+    if file_format == "parquet":
+        if Export.pyarrow is None:
+            export_session.close()
+            return make_response(jsonify({"message": "Parquet export is not available"}), 501)
+
+        # Written to an unnamed temporary file chunk by chunk, then streamed back
+        output = tempfile.TemporaryFile()
+        try:
+            Export.write_parquet(export_session, table, output, constituency_id)
+        finally:
+            export_session.close()
+        output.seek(0)
+        return send_file(output, mimetype="application/vnd.apache.parquet",
+                         as_attachment=True, download_name=f"{table}.parquet")
+
+    export_session.close()
+    return make_response(jsonify({"message": "format must be csv or parquet"}), 400)
+
+
+@api.route("/api/v1.0/ranked-ballots", methods=["POST"])
+@limiter.limit(*VOTES_IP_LIMIT, key="ip")
+@jwt_required()
+@limiter.limit(*VOTES_IDENTITY_LIMIT, key="identity")
+def submit_ranked_ballot():
+    identity = Helpers.get_identity(session)
+    if identity is None:
+        return make_response(jsonify({"message": "User not found"}), 404)
+
+    preferences = (request.get_json(silent=True) or {}).get("preferences")
+    if not isinstance(preferences, list) or not preferences:
+        return make_response(jsonify({"message": "Invalid request"}), 400)
+
+    try:
+        preferences = [int(candidate_id) for candidate_id in preferences]
+    except (TypeError, ValueError):
+        return make_response(jsonify({"message": "Invalid request"}), 400)
+
+    if len(set(preferences)) != len(preferences):
+        return make_response(jsonify({"message": "Each candidate can only be ranked once"}), 400)
+
+    # Only candidates standing in the voter's constituency can be ranked
+    standing = session.query(func.count(Candidate.candidate_id)) \
+        .filter(Candidate.candidate_id.in_(preferences),
+                Candidate.constituency_id == identity['constituency_id']) \
+        .scalar()
+    if standing != len(preferences):
+        return make_response(jsonify({"message": "Candidate not found"}), 404)
+
+    election_id = Elections.active_election_id(session)
+    if election_id is None:
+        return no_open_election()
+
+    ballot = RankedBallot(election_id=election_id,
+                          voter_id=identity['voter_id'],
+                          constituency_id=identity['constituency_id'],
+                          preferences=Counting.pack_preferences(preferences))
+    try:
+        session.add(ballot)
+        Turnout.record_vote(session, identity['voter_id'], election_id)
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        return make_response(jsonify({"message": "User has already cast a ballot"}), 403)
+
+    return make_response(jsonify({"message": "Ballot submitted", "ballot_id": ballot.ballot_id}), 201)
+
+
+@api.route("/api/v1.0/results/<constituency_id>", methods=["GET"])
+@read_only
+def get_results(constituency_id):
+    method = Counting.COUNTING_METHODS.get(request.args.get("method", "plus-minus"))
+    if method is None:
+        return make_response(jsonify({"message": "Unknown counting method"}), 400)
+
+    seats = request.args.get("seats", Counting.DEFAULT_SEATS, type=int)
+    if seats < 1:
+        return make_response(jsonify({"message": "Invalid number of seats"}), 400)
+
+    election_id = request.args.get("election_id", type=int) or Elections.latest_election_id(session)
+    return make_response(jsonify(method.run(session, election_id, constituency_id, seats)), 200)
+
+
+@api.route("/api/v1.0/turnout", methods=["GET"])
+@read_only
+def get_turnout():
+    election_id = request.args.get("election_id", type=int) or Elections.latest_election_id(session)
+    return make_response(jsonify(Turnout.get_turnout(session, election_id)), 200)
+
+
+@api.route("/api/v1.0/elections", methods=["GET"])
+@read_only
+def get_elections():
+    elections = session.query(Election).order_by(Election.election_id.desc()).all()
+    return make_response(jsonify([Elections.election_to_dict(election) for election in elections]), 200)
+
+
+@api.route("/api/v1.0/elections", methods=["POST"])
+@admin_required
+def start_election():
+    # Closes the open election and opens a new one, without deleting anything
+    name = ((request.get_json(silent=True) or {}).get("name") or "").strip()
+    if not name:
+        return make_response(jsonify({"message": "Election name is required"}), 400)
+
+    # Votes still in the journal were cast in the election being closed
+    if journal_replayer is not None:
+        journal_replayer.replay()
+
+    election = Elections.start_election(session, name)
+    session.commit()
+    return make_response(jsonify(Elections.election_to_dict(election)), 201)
+
+
+@api.route("/api/v1.0/elections/<int:election_id>", methods=["GET"])
+@read_only
+def get_election(election_id):
+    election = session.get(Election, election_id)
+    if election is None:
+        return make_response(jsonify({"message": "Election not found"}), 404)
+
+    return make_response(jsonify({**Elections.election_to_dict(election),
+                                  "turnout": Turnout.get_turnout(session, election_id),
+                                  "results": Elections.load_results(session, election)}), 200)
+
+
+@api.route("/api/v1.0/elections/<int:election_id>/root", methods=["GET"])
+@read_only
+def get_election_root(election_id):
+    # The published root, anyone holding it can check a vote's inclusion proof
+    if session.get(Election, election_id) is None:
+        return make_response(jsonify({"message": "Election not found"}), 404)
+    return make_response(jsonify(Merkle.load_root(session, election_id)), 200)
+
+
+@api.route("/api/v1.0/votes/<int:vote_id>/proof", methods=["GET"])
+@jwt_required()
+def get_vote_proof(vote_id):
+    # A leaf hash is only given to the voter who cast it, or an admin
+    identity = Helpers.get_identity(session)
+    if identity is None:
+        return make_response(jsonify({"message": "User not found"}), 404)
+
+    vote = session.get(Votes, vote_id)
+    if vote is None or (vote.voter_id != identity['voter_id'] and not identity['isAdmin']):
+        return make_response(jsonify({"message": "Vote not found"}), 404)
+
+    proof = Merkle.inclusion_proof(session, vote)
+    if proof is None:
+        return make_response(jsonify({"message": "Vote has not been added to the tree yet"}), 404)
+    return make_response(jsonify(proof), 200)
+
+
+@api.route("/api/v1.0/elections/<int:election_id>/close", methods=["POST"])
+@admin_required
+def close_election(election_id):
+    election = session.get(Election, election_id)
+    if election is None:
+        return make_response(jsonify({"message": "Election not found"}), 404)
+    if election.closed_at is not None:
+        return make_response(jsonify({"message": "Election is already closed"}), 409)
+
+    if journal_replayer is not None:
+        journal_replayer.replay()
+
+    Elections.close_election(session, election)
+    session.commit()
+    return make_response(jsonify(Elections.election_to_dict(election)), 200)
+
+
+@api.route("/api/v1.0/admin/summary", methods=["GET"])
+@admin_required
+@read_only
+def admin_summary():
+    # Everything the admin page shows in one bounded response, the lists are
+    # paged and the counts come from the cached read models and aggregates
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = min(max(request.args.get("per_page", ADMIN_PAGE_SIZE, type=int), 1), ADMIN_MAX_PAGE_SIZE)
+    start = (page - 1) * per_page
+    excerpt = Helpers.excerpt_length(request.args.get("excerpt", 0, type=int))
+
+    election = session.get(Election, Elections.latest_election_id(session) or 0)
+    election_id = election.election_id if election else None
+    parties = Helpers.get_party_list(session, excerpt)
+    candidates = Helpers.get_candidate_list(session, excerpt)
+    turnout = Turnout.get_turnout(session, election_id)
+    voters = session.query(Voter).order_by(Voter.voter_id).offset(start).limit(per_page).all()
+    latest_snapshot = session.query(TallySnapshot.taken_at, TallySnapshot.total_votes) \
+        .filter(TallySnapshot.election_id == election_id) \
+        .order_by(TallySnapshot.taken_at.desc()).first()
+
+    return make_response(jsonify({
+        "election": Elections.election_to_dict(election) if election else None,
+        "counts": {
+            "parties": len(parties),
+            "candidates": len(candidates),
+            "voters": turnout["registered"],
+            "voted": turnout["voted"],
+            "votes": session.query(func.count(Votes.vote_id)).filter(Votes.election_id == election_id).scalar(),
+            "ranked_ballots": session.query(func.count(RankedBallot.ballot_id))
+            .filter(RankedBallot.election_id == election_id).scalar()
+        },
+        "turnout": turnout["turnout"],
+        "recent": {
+            "voters": [Helpers.voter_summary_to_dict(voter, election_id) for voter in
+                       session.query(Voter).order_by(Voter.voter_id.desc()).limit(ADMIN_RECENT_ITEMS)],
+            "notifications": [Notifications.job_to_dict(job) for job in
+                              session.query(NotificationJob).order_by(NotificationJob.job_id.desc())
+                              .limit(ADMIN_RECENT_ITEMS)],
+            "snapshot": {"taken_at": latest_snapshot.taken_at.isoformat(),
+                         "total_votes": latest_snapshot.total_votes} if latest_snapshot else None
+        },
+        "page": page,
+        "per_page": per_page,
+        "parties": parties[start:start + per_page],
+        "candidates": candidates[start:start + per_page],
+        "voters": [Helpers.voter_summary_to_dict(voter, election_id) for voter in voters]
+    }), 200)
+
+
+@api.route("/api/v1.0/health/live", methods=["GET"])
+def liveness():
+    # Never touches the database, a worker that answers is alive
+    return make_response(jsonify(health_check.live()), 200)
+
+
+@api.route("/api/v1.0/health/ready", methods=["GET"])
+def readiness():
+    # 503 takes this worker out of rotation until the database answers and it has capacity again
+    report, ready = health_check.ready()
+    return make_response(jsonify(report), 200 if ready else 503)
+
+
+@api.route("/api/v1.0/notifications", methods=["POST"])
+@admin_required
+def send_notification():
+    # Either a named template or a subject and body, which may use $first_name, $last_name and $constituency_name
+    template = request.form.get("template")
+    if template:
+        if template not in Notifications.TEMPLATES:
+            return make_response(jsonify({"message": "Unknown template"}), 400)
+        subject, body = Notifications.TEMPLATES[template]
+    else:
+        subject, body = request.form.get("subject"), request.form.get("body")
+        if not subject or not body:
+            return make_response(jsonify({"message": "A template or a subject and body are required"}), 400)
+
+    constituency_id = request.form.get("constituency_id", type=int)
+    if constituency_id is not None and session.get(Constituency, constituency_id) is None:
+        return make_response(jsonify({"message": "Invalid constituency"}), 400)
+
+    job = notification_sender.create_job(session, subject, body, constituency_id)
+    notification_sender.start(job.job_id)
+    return make_response(jsonify(Notifications.job_to_dict(job)), 202)
+
+
+@api.route("/api/v1.0/notifications/<int:job_id>", methods=["GET"])
+@admin_required
+def get_notification(job_id):
+    job = session.get(NotificationJob, job_id)
+    if job is None:
+        return make_response(jsonify({"message": "Notification not found"}), 404)
+    return make_response(jsonify(Notifications.job_to_dict(job)), 200)
+
+
+@api.route("/api/v1.0/notifications/<int:job_id>/pause", methods=["POST"])
+@admin_required
+def pause_notification(job_id):
+    if not notification_sender.pause(session, job_id):
+        return make_response(jsonify({"message": "Notification is not running"}), 409)
+    return make_response(jsonify({"message": "Notification pausing"}), 202)
+
+
+@api.route("/api/v1.0/notifications/<int:job_id>/resume", methods=["POST"])
+@admin_required
+def resume_notification(job_id):
+    # Also restarts a job left running by a worker that stopped, it carries on from its last checkpoint
+    job = session.get(NotificationJob, job_id)
+    if job is None:
+        return make_response(jsonify({"message": "Notification not found"}), 404)
+    if not notification_sender.resume(session, job_id):
+        return make_response(jsonify({"message": "Notification is already " + job.status}), 409)
+    return make_response(jsonify({"message": "Notification resumed"}), 202)
+
+
+DEFAULT_CONFIG = {
+    'SECRET_KEY': config('SK'),
+    'JWT_SECRET_KEY': config('SK'),
+    'PERMANENT_SESSION_LIFETIME': timedelta(minutes=10),
+    'JSONIFY_PRETTYPRINT_REGULAR': True,
+    'FORCE_HTTPS': config('FORCE_HTTPS', default=True, cast=bool),
+    # Proxies in front of the app that each append to X-Forwarded-For, the client address used for
+    # rate limiting is taken from the header this many hops back. 0 uses the connecting address.
+    'TRUSTED_PROXIES': config('TRUSTED_PROXIES', default=0, cast=int)
+}
+
+
+def create_app(config=None):
+    # Settings are taken from DEFAULT_CONFIG, then FLASK_* environment variables, then config
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.from_prefixed_env()
+    if config:
+        app.config.update(config)
+
+    if app.config['TRUSTED_PROXIES']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'],
+                                x_proto=app.config['TRUSTED_PROXIES'])
+    # AsyncAPI sends the same headers from its routes through Security.init_async_app
+    Security.init_app(app, app.config['FORCE_HTTPS'])
+    CORS(app)
+    JWTManager(app)
+    # Admins profile a request by sending X-Profile, PROFILE_SAMPLE_RATE profiles a share of all traffic
+    Profiling.init_app(app, engine)
+    # Cache-Control by route, then gzip or brotli for large enough bodies
+    Compression.init_app(app)
+    health_check.init_app(app)
+
+    app.register_blueprint(api)
+    app.teardown_appcontext(remove_session)
+
+    return app
+
+
+def remove_session(exception=None):
+    Session.remove()
+
+
+def start_background_tasks():
+    replica_set.start()
+    if journal_replayer is not None:
+        journal_replayer.start()
+    merkle_appender.start()
+    otp_store.start_sweeper()
+    idempotency_store.start_sweeper()
+    limiter.start_sweeper()
+    notification_sender.start_poller()
+    # Normally the snapshotter runs as its own process (python Snapshots.py), this
+    # runs it inside a single process deployment instead
+    if config('RUN_SNAPSHOTTER', default=False, cast=bool):
+        snapshotter.start()
+
+
+def preload():
+    # Loads the read mostly data so pre-forked workers inherit it warm, then drops
+    # every pooled connection so none of them are shared with the workers
+    Helpers.load_constituencies()
+    try:
+        Helpers.get_party_list(session)
+        Helpers.get_candidate_list(session)
+    finally:
+        Session.remove()
+        engine.dispose()
+
+
+def init_worker():
+    # Runs in each worker straight after fork, every worker needs its own pool,
+    # SQLite handles and background threads
+    engine.dispose(close=False)
+    replica_set.dispose()
+    Session.remove()
+    limiter.store = RateLimiter.create_bucket_store()
+    start_background_tasks()
+
+
+def create_production_app():
+    app = create_app()
+    preload()
+    return app
+
+
 if __name__ == "__main__":
+    app = create_app()
+    start_background_tasks()
     app.run(debug=True)
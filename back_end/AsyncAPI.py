@@ -0,0 +1,347 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from asgiref.wsgi import WsgiToAsgi
+from decouple import config
+from hypercorn.middleware import ProxyFixMiddleware
+from flask_jwt_extended import create_access_token, decode_token
+from quart import Quart, request, jsonify, make_response
+from quart_cors import cors
+from sqlalchemy import event, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from werkzeug.exceptions import HTTPException
+
+import API
+import CircuitBreaker
+import Compression
+import Elections
+import Helpers
+import Models
+import Security
+from DBConfig import DBConfig
+from Models import Voter
+
+# Async serving mode. The read heavy and IO bound routes are served by async
+# handlers here, every other route falls through to the Flask app in API.py.
+# Run with: hypercorn AsyncAPI:application --workers 4
+
+app = cors(Quart(__name__))
+# Serves every route without an async handler, and its settings apply to both
+flask_app = API.create_app()
+
+# The async driver for each driver the Flask app's engines use
+ASYNC_DRIVERS = {'mssql+pyodbc': 'mssql+aioodbc', 'sqlite': 'sqlite+aiosqlite', 'sqlite+pysqlite': 'sqlite+aiosqlite'}
+
+
+def async_url(url):
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername)).render_as_string(hide_password=False)
+
+
+def make_async_engine(url):
+    # Fails as fast as the Flask app's engines, and its errors count towards the same database breaker
+    engine = create_async_engine(url,
+                                 pool_size=config('ASYNC_POOL_SIZE', default=20, cast=int),
+                                 max_overflow=config('ASYNC_MAX_OVERFLOW', default=40, cast=int),
+                                 pool_timeout=Models.DB_POOL_TIMEOUT,
+                                 pool_pre_ping=True,
+                                 connect_args=Models.connect_args(url))
+    CircuitBreaker.guard_engine(engine.sync_engine, API.database_breaker, API.DATABASE_ERRORS)
+
+    if engine.dialect.name == 'mssql':
+        @event.listens_for(engine.sync_engine, 'connect')
+        def set_query_timeout(dbapi_connection, connection_record):
+            # aioodbc has no setter for it, SQLAlchemy's adapter reaches the pyodbc connection the same way
+            dbapi_connection.driver_connection._conn.timeout = Models.DB_QUERY_TIMEOUT
+
+    return engine
+
+
+async_db_url = config('ASYNC_DB_URL', default='') or DBConfig().get_async_conn_string()
+async_engine = make_async_engine(async_db_url)
+AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+
+# One session factory per replica, chosen by the Flask app's replica set so both serving modes
+# skip the same stale replicas
+ReplicaSessions = {replica.url: async_sessionmaker(make_async_engine(async_url(replica.url)), expire_on_commit=False)
+                   for replica in API.replica_set.replicas}
+
+# bcrypt releases the GIL so hashing threads run on every core without blocking the event loop
+bcrypt_executor = ThreadPoolExecutor(max_workers=config('BCRYPT_WORKERS', default=os.cpu_count(), cast=int),
+                                     thread_name_prefix="bcrypt")
+
+# HTTPS redirects and security headers follow the same policy as the Flask app's
+Security.init_async_app(app, flask_app.config['FORCE_HTTPS'], flask_app.debug)
+
+
+@app.before_request
+async def check_database_breaker():
+    # The async handlers are named like their Flask twins, so the same routes bypass the breaker
+    if API.bypasses_database_breaker(f"api.{request.endpoint}"):
+        return None
+    if not API.database_breaker.allow():
+        return API.unavailable_response(CircuitBreaker.CircuitOpen("database", API.database_breaker.retry_after()))
+    return None
+
+
+@app.after_request
+async def close_database_breaker(response):
+    if response.status_code < 500 and not API.bypasses_database_breaker(f"api.{request.endpoint}"):
+        API.database_breaker.success()
+    return response
+
+
+@app.errorhandler(CircuitBreaker.CircuitOpen)
+async def circuit_open(error):
+    return API.unavailable_response(error)
+
+
+async def database_unavailable(error):
+    return API.unavailable_response(API.database_failure(error))
+
+
+for database_error in API.DATABASE_ERRORS:
+    app.register_error_handler(database_error, database_unavailable)
+
+
+Compression.init_async_app(app)
+
+
+@app.before_serving
+async def start_background_tasks():
+    # Runs in every worker once it is ready to serve, however it was started
+    API.start_background_tasks()
+
+
+async def run_blocking(function, *args, executor=None):
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+
+def rate_limited(limit, value):
+    # Returns a 429 response when the bucket for value is empty, otherwise None
+    if value is None:
+        return None
+    allowed, retry_after = API.limiter.hit(limit[0], value, limit[1], limit[2])
+    if allowed:
+        return None
+    return {"message": "Too many requests, try again later"}, 429, {"Retry-After": str(int(retry_after) + 1)}
+
+
+def token_claims():
+    header = request.headers.get("Authorization", "")
+    if not header.startswith("Bearer "):
+        return None
+    try:
+        with flask_app.app_context():
+            return decode_token(header[len("Bearer "):])
+    except Exception:
+        return None
+
+
+def read_session():
+    # Like API.read_only, reads go to a replica unless the caller wrote in the last few seconds
+    claims = token_claims()
+    if claims is None or not API.replica_set.recently_wrote(claims['sub']):
+        replica = API.replica_set.choose_replica()
+        if replica is not None:
+            return ReplicaSessions[replica.url]()
+    return AsyncSession()
+
+
+def send_otp(email, otp):
+    with flask_app.app_context():
+        Helpers.send_otp(email, otp)
+
+
+@app.route("/api/v1.0/verification", methods=["POST"])
+async def verification():
+    try:
+        request_data = await request.get_json()
+        email = request_data.get("email")
+
+        limited = rate_limited(API.VERIFICATION_IP_LIMIT, request.remote_addr) \
+            or rate_limited(API.VERIFICATION_EMAIL_LIMIT, email.strip().lower() if email else None)
+        if limited:
+            return limited
+
+        async with AsyncSession() as session:
+            user = (await session.execute(select(Voter.voter_id).filter_by(email=email))).first()
+
+        if user:
+            return await make_response(jsonify({"message": "User already exists!"}), 403)
+
+        OTP = Helpers.generate_otp()
+
+        # Sending the email and storing the otp both block, so they run off the event loop
+        await run_blocking(send_otp, email, OTP)
+        await run_blocking(API.otp_store.put, email, OTP)
+
+        return await make_response(jsonify({'message': 'OTP sent'}), 200)
+
+    except Helpers.CircuitOpen as e:
+        return API.unavailable_response(e)
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return await make_response("An error occurred", 500)
+
+
+@app.route("/api/v1.0/login", methods=["POST"])
+async def login():
+    form = await request.form
+    gov_id = form['gov_id']
+    password = form['password']
+
+    limited = rate_limited(API.LOGIN_IP_LIMIT, request.remote_addr) or rate_limited(API.LOGIN_GOV_ID_LIMIT, gov_id)
+    if limited:
+        return limited
+
+    async with AsyncSession() as session:
+        user = (await session.execute(select(Voter).filter_by(gov_id=gov_id))).scalars().first()
+
+    if not user:
+        return jsonify({'message': 'User not found.'}), 404
+
+    if not await run_blocking(Helpers.check_password, password, user.password, executor=bcrypt_executor):
+        return jsonify({'message': 'Incorrect password.'}), 401
+
+    with flask_app.app_context():
+        access_token = create_access_token(identity=gov_id,
+                                           additional_claims=Helpers.identity_claims(user),
+                                           expires_delta=timedelta(minutes=Helpers.TOKEN_LIFETIME_MINUTES))
+
+    user_data = {
+        'voter_id': user.voter_id,
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'gov_id': user.gov_id,
+        'email': user.email,
+        'constituency_id': user.constituency_id,
+        'isAdmin': user.isAdmin
+    }
+
+    return jsonify({'access_token': access_token, 'user_data': user_data})
+
+
+@app.route('/api/v1.0/profile', methods=["GET"])
+async def profile():
+    claims = token_claims()
+    if claims is None:
+        return jsonify({"msg": "Missing or invalid Authorization header"}), 401
+
+    gov_id = claims['sub']
+    user = Helpers.identity_cache.get(gov_id)
+    # Reloaded like Helpers.get_cached_identity does once the voter's token_version has moved on
+    if user is None or user['token_version'] != Helpers.token_versions.get(gov_id):
+        async with AsyncSession() as session:
+            row = (await session.execute(Helpers.identity_query(gov_id))).first()
+
+        if row is None:
+            return jsonify({"message": "User not found"}), 404
+
+        user = Helpers.identity_from_row(*row)
+        Helpers.identity_cache.set(gov_id, user)
+        Helpers.token_versions.set(gov_id, user['token_version'])
+
+    return jsonify({'first_name': user['first_name'],
+                    'last_name': user['last_name'],
+                    'gov_id': user['gov_id'],
+                    'constituency_name': user['constituency_name'],
+                    'email': user['email']})
+
+
+@app.route("/api/v1.0/parties", methods=["GET"])
+async def show_all_parties():
+    excerpt = Helpers.excerpt_length(request.args.get("excerpt", 0, type=int))
+    party_list = Helpers.catalog_cache.get(('parties', excerpt))
+    if party_list is None:
+        async with read_session() as session:
+            rows = (await session.execute(Helpers.party_summary_query(excerpt))).all()
+        party_list = [Helpers.party_summary_to_dict(row, excerpt) for row in rows]
+        Helpers.catalog_cache.set(('parties', excerpt), party_list)
+
+    return jsonify(party_list)
+
+
+@app.route("/api/v1.0/parties/<id>", methods=["GET"])
+async def show_one_party(id):
+    async with read_session() as session:
+        party = (await session.execute(Helpers.party_detail_query(id))).scalars().first()
+
+    if not party:
+        return jsonify({"error": "Party not found"}), 404
+
+    return jsonify(Helpers.party_to_dict(party))
+
+
+@app.route("/api/v1.0/candidates", methods=["GET"])
+async def show_all_candidates():
+    excerpt = Helpers.excerpt_length(request.args.get("excerpt", 0, type=int))
+    candidate_list = Helpers.catalog_cache.get(('candidates', excerpt))
+    if candidate_list is None:
+        async with read_session() as session:
+            rows = (await session.execute(Helpers.candidate_summary_query(excerpt))).all()
+        candidate_list = [Helpers.candidate_summary_to_dict(row, excerpt) for row in rows]
+        Helpers.catalog_cache.set(('candidates', excerpt), candidate_list)
+
+    return jsonify(candidate_list)
+
+
+@app.route("/api/v1.0/candidates/<id>", methods=["GET"])
+async def show_one_candidate(id):
+    async with read_session() as session:
+        row = (await session.execute(Helpers.candidate_detail_query(id))).first()
+
+    return jsonify([Helpers.candidate_detail_to_dict(*row)] if row else [])
+
+
+@app.route("/api/v1.0/remaining-votes/<voter_id>", methods=["GET"])
+async def get_remaining_votes(voter_id):
+    if token_claims() is None:
+        return jsonify({"msg": "Missing or invalid Authorization header"}), 401
+
+    async with AsyncSession() as session:
+        election_id = (await session.execute(Elections.latest_election_query())).scalar()
+        used = dict((await session.execute(Helpers.used_vote_counts_query(election_id, voter_id))).all())
+
+    return jsonify(API.remaining_votes(election_id, voter_id, used))
+
+
+@app.route("/api/v1.0/voting-data", methods=["GET"])
+async def get_voting_data():
+    async with read_session() as session:
+        candidates = (await session.execute(Helpers.voting_data_query())).all()
+        total_votes = (await session.execute(Helpers.total_votes_query())).scalar()
+
+    return jsonify([Helpers.voting_data_to_dict(candidate, party, total_votes) for candidate, party in candidates])
+
+
+flask_application = WsgiToAsgi(flask_app)
+
+# The async routes read the client address behind the same number of proxies as the Flask app
+trusted_proxies = flask_app.config['TRUSTED_PROXIES']
+async_application = ProxyFixMiddleware(app, trusted_hops=trusted_proxies) if trusted_proxies else app
+
+
+async def application(scope, receive, send):
+    # Requests for routes without an async handler are passed to the Flask app,
+    # which asgiref runs on its thread pool
+    if scope["type"] == "http":
+        try:
+            app.url_map.bind("").match(scope["path"], method=scope["method"])
+        except HTTPException:
+            await flask_application(scope, receive, send)
+            return
+    await async_application(scope, receive, send)
+
+
+if __name__ == "__main__":
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    hypercorn_config = Config()
+    hypercorn_config.bind = [config('BIND', default='0.0.0.0:5000')]
+    asyncio.run(serve(application, hypercorn_config))
@@ -0,0 +1,17 @@
+import threading
+
+
+def run_periodically(name, interval, function):
+    # Calls function every interval seconds on a daemon thread until the
+    # returned event is set, errors are reported and the loop carries on
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                function()
+            except Exception as e:
+                print(f"An error occurred in {name}: {e}")
+
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return stop
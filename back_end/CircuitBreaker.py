@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+from functools import wraps
+
+from decouple import config
+
+# Consecutive failures that open a breaker, and how long it stays open before one probe is let through
+BREAKER_FAILURES = config('BREAKER_FAILURES', default=5, cast=int)
+BREAKER_RESET_TIMEOUT = config('BREAKER_RESET_TIMEOUT', default=30, cast=float)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is unavailable, retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    # Stops calling a dependency after failure_threshold consecutive failures.
+    # Callers fail straight away with CircuitOpen until reset_timeout has passed,
+    # then a single call is let through: success closes the breaker, failure
+    # opens it again. Only exceptions in errors count as failures.
+    #
+    # Use as a context manager (with breaker: ...) or a decorator (@breaker).
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_TIMEOUT,
+                 errors=(Exception,), clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.errors = errors
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at = None
+        self.last_error = None
+        self.lock = threading.Lock()
+
+    def retry_after(self):
+        return max(self.opened_at + self.reset_timeout - self.clock(), 0.0)
+
+    def allow(self):
+        if self.state == CLOSED:
+            return True
+        with self.lock:
+            now = self.clock()
+            if self.state == OPEN and now >= self.opened_at + self.reset_timeout:
+                self.state = HALF_OPEN
+                self.probe_started_at = None
+                logger.info("Circuit %s half-open, probing", self.name)
+            if self.state == HALF_OPEN:
+                # One probe at a time, a probe that never reported back is replaced after reset_timeout
+                if self.probe_started_at is None or now >= self.probe_started_at + self.reset_timeout:
+                    self.probe_started_at = now
+                    return True
+            return self.state == CLOSED
+
+    def check(self):
+        if not self.allow():
+            raise CircuitOpen(self.name, self.retry_after() or self.reset_timeout)
+
+    def success(self):
+        # Called on every successful call, so the common case takes no lock
+        if self.state == CLOSED and not self.failures:
+            return
+        with self.lock:
+            if self.state == OPEN:
+                # A call that started before the breaker opened proves nothing
+                return
+            if self.state == HALF_OPEN:
+                logger.info("Circuit %s closed", self.name)
+            self.state = CLOSED
+            self.failures = 0
+            self.probe_started_at = None
+
+    def failure(self, error=None):
+        with self.lock:
+            self.last_error = (str(error).splitlines() or [type(error).__name__])[0] if error is not None else None
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = self.clock()
+                self.probe_started_at = None
+                logger.warning("Circuit %s opened after %d failures: %s", self.name, self.failures, self.last_error)
+
+    def __enter__(self):
+        self.check()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.success()
+        elif issubclass(exc_type, self.errors):
+            self.failure(exc)
+        return False
+
+    def __call__(self, f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            with self:
+                return f(*args, **kwargs)
+
+        return decorated_function
+
+    def status(self):
+        return {"name": self.name,
+                "state": self.state,
+                "failures": self.failures,
+                "retry_after": round(self.retry_after(), 1) if self.state == OPEN else 0,
+                "last_error": self.last_error}
+
+
+def guard_engine(engine, breaker, errors):
+    # Feeds every statement run on engine into breaker, so it also sees the
+    # failures that routes catch and report themselves
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "handle_error")
+    def record_failure(context):
+        if context.is_disconnect or isinstance(context.sqlalchemy_exception, errors):
+            breaker.failure(context.original_exception)
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def record_success(connection, cursor, statement, parameters, context, executemany):
+        breaker.success()
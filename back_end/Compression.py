@@ -0,0 +1,135 @@
+import gzip
+import hashlib
+
+from decouple import config
+
+from Cache import TTLCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are sent as they are, compressing them saves less than the headers cost
+COMPRESSION_MIN_SIZE = config('COMPRESSION_MIN_SIZE', default=1024, cast=int)
+GZIP_LEVEL = config('GZIP_LEVEL', default=6, cast=int)
+BROTLI_QUALITY = config('BROTLI_QUALITY', default=5, cast=int)
+COMPRESSED_CACHE_SIZE = config('COMPRESSED_CACHE_SIZE', default=256, cast=int)
+COMPRESSED_CACHE_TTL = 600
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/', 'application/javascript', 'image/svg+xml')
+
+# Cache-Control for GET responses by route, anything not listed may hold personal data and is never stored.
+# Public responses also get an ETag, so a browser revalidating an unchanged list gets an empty 304.
+CACHE_POLICIES = {
+    '/api/v1.0/parties': 'public, max-age=30, stale-while-revalidate=60',
+    '/api/v1.0/parties/<id>': 'public, max-age=30, stale-while-revalidate=60',
+    '/api/v1.0/candidates': 'public, max-age=30, stale-while-revalidate=60',
+    '/api/v1.0/candidates/<id>': 'public, max-age=30, stale-while-revalidate=60',
+    '/api/v1.0/voting-data': 'public, max-age=5',
+    '/api/v1.0/voting-data/history': 'public, max-age=30',
+    '/api/v1.0/turnout': 'public, max-age=5',
+    '/api/v1.0/results/<constituency_id>': 'public, max-age=5',
+    '/api/v1.0/elections/<int:election_id>/root': 'public, max-age=5',
+}
+DEFAULT_POLICY = 'no-store'
+
+# Compressed copies of public bodies, which are the cached read models served over and over
+compressed_cache = TTLCache(ttl=COMPRESSED_CACHE_TTL, maxsize=COMPRESSED_CACHE_SIZE)
+
+
+def negotiate(accept_encoding):
+    # Brotli when the client accepts it and it is installed, then gzip, otherwise None
+    accepted = {}
+    for part in (accept_encoding or '').lower().split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip()] = quality
+
+    for coding in ('br', 'gzip'):
+        if coding == 'br' and brotli is None:
+            continue
+        if accepted.get(coding, accepted.get('*', 0)) > 0:
+            return coding
+    return None
+
+
+def compress(body, coding):
+    if coding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def compressible(content_type, body):
+    return len(body) >= COMPRESSION_MIN_SIZE and (content_type or '').startswith(COMPRESSIBLE_TYPES)
+
+
+def digest(body):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def encode(body, coding, key=None):
+    # Compresses body, reusing the copy made for an identical earlier body when key is given
+    if key is None:
+        return compress(body, coding)
+    return compressed_cache.get_or_load((coding, key), lambda: compress(body, coding))
+
+
+def cache_policy(rule, method, status):
+    if method not in ('GET', 'HEAD') or status != 200 or rule is None:
+        return DEFAULT_POLICY
+    return CACHE_POLICIES.get(rule, DEFAULT_POLICY)
+
+
+def finish(response, request, body):
+    # Sets the caching and compression headers, returns the body to send or None to keep body
+    response.headers.setdefault('Cache-Control', cache_policy(getattr(request.url_rule, 'rule', None),
+                                                              request.method, response.status_code))
+    public = response.status_code == 200 and response.headers['Cache-Control'].startswith('public')
+    key = digest(body) if public else None
+    if key is not None:
+        response.set_etag(key, weak=True)
+        if request.if_none_match.contains_weak(key):
+            response.status_code = 304
+            return b''
+
+    if not compressible(response.mimetype, body):
+        return None
+    response.vary.add('Accept-Encoding')
+    coding = negotiate(request.headers.get('Accept-Encoding'))
+    if coding is None:
+        return None
+    response.headers['Content-Encoding'] = coding
+    return encode(body, coding, key)
+
+
+def init_app(app):
+    from flask import request
+
+    @app.after_request
+    def compress_response(response):
+        # Files and streams are left alone, they set their own headers and are never held in memory
+        if response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers:
+            return response
+        body = finish(response, request, response.get_data())
+        if body is not None:
+            response.set_data(body)
+        return response
+
+
+def init_async_app(app):
+    from quart import request
+
+    @app.after_request
+    async def compress_response(response):
+        if 'Content-Encoding' in response.headers:
+            return response
+        body = finish(response, request, await response.get_data())
+        if body is not None:
+            response.set_data(body)
+        return response
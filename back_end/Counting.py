@@ -0,0 +1,218 @@
+import sys
+from array import array
+
+from Models import Candidate, Candidacy, Votes, RankedBallot
+
+# Northern Ireland Assembly constituencies return five members
+DEFAULT_SEATS = 5
+
+# STV ballots carry integer weights in 1/100000ths of a vote so transfers are exact and repeatable
+SCALE = 100000
+
+
+def pack_preferences(preferences):
+    # Rankings are stored as little endian unsigned 32 bit candidate ids
+    packed = array('I', preferences)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_preferences(data):
+    preferences = array('I')
+    preferences.frombytes(data)
+    if sys.byteorder == 'big':
+        preferences.byteswap()
+    return preferences
+
+
+class BallotSet:
+    # Ranked ballots with identical rankings are merged into one group, and every
+    # group's ranking is kept in a single flat array indexed by offsets
+
+    def __init__(self):
+        self.groups = {}
+        self.preferences = array('I')
+        self.offsets = array('I', [0])
+        self.counts = array('q')
+
+    def add(self, preferences, count=1):
+        self.add_packed(pack_preferences(preferences), count)
+
+    def add_packed(self, data, count=1):
+        group = self.groups.get(data)
+        if group is None:
+            group = len(self.counts)
+            self.groups[data] = group
+            self.preferences.extend(unpack_preferences(data))
+            self.offsets.append(len(self.preferences))
+            self.counts.append(0)
+        self.counts[group] += count
+
+    def total(self):
+        return sum(self.counts)
+
+    def __len__(self):
+        return len(self.counts)
+
+
+class CountingMethod:
+    name = None
+
+    def load_ballots(self, session, election_id, constituency_id):
+        raise NotImplementedError
+
+    def count(self, ballots, candidates, seats):
+        # Returns a dict with the elected candidate ids in order of election and
+        # the tallies of every round
+        raise NotImplementedError
+
+    def run(self, session, election_id, constituency_id, seats=DEFAULT_SEATS):
+        candidates = standing_candidates(session, election_id, constituency_id)
+        return self.count(self.load_ballots(session, election_id, constituency_id), candidates, seats)
+
+
+def standing_candidates(session, election_id, constituency_id):
+    # A closed election keeps the candidates who stood in it, the open one uses the current list
+    candidates = [candidate_id for candidate_id, in session.query(Candidacy.candidate_id)
+                  .filter(Candidacy.election_id == election_id, Candidacy.constituency_id == constituency_id)
+                  .order_by(Candidacy.candidate_id)]
+    if candidates:
+        return candidates
+    return [candidate_id for candidate_id, in session.query(Candidate.candidate_id)
+            .filter(Candidate.constituency_id == constituency_id)
+            .order_by(Candidate.candidate_id)]
+
+
+def plus_minus_tallies(votes):
+    # votes as (candidate_id, vote_type) in the order they were stored. A negative vote for a candidate
+    # on zero is dropped, the rule Helpers.apply_vote_to_tally applies as each vote arrives.
+    tallies = {}
+    for candidate_id, vote_type in votes:
+        tallies[candidate_id] = max(tallies.get(candidate_id, 0) + vote_type, 0)
+    return tallies
+
+
+class PlusMinusCount(CountingMethod):
+    # The original scheme, positive votes add one and negative votes take one
+    # away, a candidate can never fall below zero
+    name = 'plus-minus'
+
+    def load_ballots(self, session, election_id, constituency_id):
+        return plus_minus_tallies(session.query(Votes.candidate_id, Votes.vote_type)
+                                  .join(Candidate, Votes.candidate_id == Candidate.candidate_id)
+                                  .filter(Votes.election_id == election_id,
+                                          Candidate.constituency_id == constituency_id)
+                                  .order_by(Votes.vote_id)
+                                  .yield_per(10000))
+
+    def count(self, ballots, candidates, seats):
+        tallies = {candidate: max(0, ballots.get(candidate) or 0) for candidate in candidates}
+        ranking = sorted(candidates, key=lambda candidate: (-tallies[candidate], candidate))
+        return {
+            'method': self.name,
+            'seats': seats,
+            'elected': ranking[:seats],
+            'rounds': [{'round': 1, 'tallies': tallies}]
+        }
+
+
+class STVCount(CountingMethod):
+    # Single transferable vote with a Droop quota. Surpluses are transferred from
+    # every ballot held by the elected candidate at a reduced weight, exclusions
+    # transfer at full weight. A round only touches the ballots being transferred.
+    name = 'stv'
+
+    def load_ballots(self, session, election_id, constituency_id):
+        ballots = BallotSet()
+        query = session.query(RankedBallot.preferences) \
+            .filter(RankedBallot.election_id == election_id, RankedBallot.constituency_id == constituency_id) \
+            .yield_per(10000)
+        for preferences, in query:
+            ballots.add_packed(bytes(preferences))
+        return ballots
+
+    def count(self, ballots, candidates, seats):
+        preferences = ballots.preferences
+        offsets = ballots.offsets
+        weights = array('q', (count * SCALE for count in ballots.counts))
+        position = array('I', offsets[:-1])
+
+        continuing = set(candidates)
+        piles = {candidate: [] for candidate in candidates}
+        tallies = dict.fromkeys(candidates, 0)
+        exhausted = 0
+
+        def next_preference(group):
+            # Moves the group on to its next continuing candidate, None once exhausted
+            current = position[group]
+            end = offsets[group + 1]
+            while current < end and preferences[current] not in continuing:
+                current += 1
+            position[group] = current
+            return preferences[current] if current < end else None
+
+        def transfer(candidate, numerator, denominator):
+            nonlocal exhausted
+            for group in piles.pop(candidate):
+                if numerator != denominator:
+                    weights[group] = weights[group] * numerator // denominator
+                receiver = next_preference(group)
+                if receiver is None:
+                    exhausted += weights[group]
+                else:
+                    piles[receiver].append(group)
+                    tallies[receiver] += weights[group]
+
+        for group in range(len(ballots)):
+            candidate = next_preference(group)
+            if candidate is None:
+                exhausted += weights[group]
+            else:
+                piles[candidate].append(group)
+                tallies[candidate] += weights[group]
+
+        valid_votes = sum(tallies.values()) // SCALE
+        quota = (valid_votes // (seats + 1) + 1) * SCALE
+
+        elected = []
+        rounds = []
+        while len(elected) < seats and continuing:
+            record = {'round': len(rounds) + 1,
+                      'tallies': {candidate: tallies[candidate] / SCALE for candidate in candidates},
+                      'exhausted': exhausted / SCALE,
+                      'elected': [],
+                      'excluded': []}
+            rounds.append(record)
+
+            if len(continuing) <= seats - len(elected):
+                remaining = sorted(continuing, key=lambda candidate: (-tallies[candidate], candidate))
+                elected.extend(remaining)
+                record['elected'] = remaining
+                continuing.clear()
+                break
+
+            leader = max(continuing, key=lambda candidate: (tallies[candidate], -candidate))
+            if tallies[leader] >= quota:
+                continuing.discard(leader)
+                elected.append(leader)
+                record['elected'] = [leader]
+                transfer(leader, tallies[leader] - quota, tallies[leader])
+                tallies[leader] = quota
+            else:
+                lowest = min(continuing, key=lambda candidate: (tallies[candidate], candidate))
+                continuing.discard(lowest)
+                record['excluded'] = [lowest]
+                transfer(lowest, 1, 1)
+                tallies[lowest] = 0
+
+        return {
+            'method': self.name,
+            'seats': seats,
+            'quota': quota / SCALE,
+            'elected': elected,
+            'rounds': rounds
+        }
+
+
+COUNTING_METHODS = {method.name: method for method in (PlusMinusCount(), STVCount())}
@@ -11,16 +11,26 @@ class DBConfig:
     driver = 'ODBC Driver 18 for SQL Server'
 
     def __init__(self):
-        self.connection = pyodbc.connect(
-            'DRIVER={' + self.driver +
-            '};SERVER=tcp:' + self.server +
-            ';PORT=1433;DATABASE=' + self.database +
-            ';UID=' + self.username +
-            ';PWD=' + self.password
-        )
+        # Connecting is deferred so importing the models never opens a connection
+        # in a process that is about to fork
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = pyodbc.connect(
+                'DRIVER={' + self.driver +
+                '};SERVER=tcp:' + self.server +
+                ';PORT=1433;DATABASE=' + self.database +
+                ';UID=' + self.username +
+                ';PWD=' + self.password
+            )
+        return self.connection
 
     def get_cursor(self):
-        return self.connection.cursor()
+        return self.connect().cursor()
 
     def get_conn_string(self):
         return f"mssql+pyodbc://{self.username}:{self.password}@{self.server}/{self.database}?driver={self.driver}"
+
+    def get_async_conn_string(self):
+        return f"mssql+aioodbc://{self.username}:{self.password}@{self.server}/{self.database}?driver={self.driver}"
@@ -0,0 +1,128 @@
+import argparse
+from datetime import datetime
+
+from decouple import config
+from sqlalchemy import insert, select, literal, func
+from sqlalchemy.orm import sessionmaker
+
+import Merkle
+import Turnout
+from Models import Election, Candidacy, Candidate, Votes, RankedBallot, engine
+
+# Name given to the first election when it is opened at deploy time, see open_first_election
+ELECTION_NAME = config('ELECTION_NAME', default='Assembly election')
+
+
+def active_election_id(session):
+    # Read on every vote rather than cached, so no vote lands in an election after it closes.
+    # Only ever reads, None until an election has been opened.
+    return session.query(Election.election_id) \
+        .filter(Election.closed_at.is_(None)) \
+        .order_by(Election.election_id.desc()) \
+        .limit(1).scalar()
+
+
+def latest_election_query():
+    # The open election, or the last one to close, for the pages that show results between elections
+    return select(func.max(Election.election_id))
+
+
+def latest_election_id(session):
+    return session.execute(latest_election_query()).scalar()
+
+
+def close_election(session, election, closed_at=None):
+    # Copies every candidate's tally into Candidacy in one statement, the election's
+    # votes stay where they are under its election_id
+    if election.closed_at is not None:
+        return election
+    election.closed_at = closed_at or datetime.utcnow()
+    session.execute(insert(Candidacy).from_select(
+        ['election_id', 'candidate_id', 'party_id', 'constituency_id', 'vote_count'],
+        select(literal(election.election_id), Candidate.candidate_id, Candidate.party_id,
+               Candidate.constituency_id, func.coalesce(Candidate.vote_count, 0))))
+    return election
+
+
+def start_election(session, name):
+    # Closes the open election and opens a new one. Nothing is deleted, the new
+    # election simply has no votes, ballots or snapshots under its election_id yet.
+    # The caller commits.
+    #
+    # Locking the latest election first makes two starts racing each other run one after
+    # the other, so the second closes the election the first opened.
+    session.query(Election).order_by(Election.election_id.desc()).with_for_update().first()
+    now = datetime.utcnow()
+    for election in session.query(Election).filter(Election.closed_at.is_(None)):
+        close_election(session, election, now)
+    election = Election(name=name, started_at=now)
+    session.add(election)
+    session.query(Candidate).update({Candidate.vote_count: 0}, synchronize_session=False)
+    session.flush()
+    session.add(Merkle.new_tree(election.election_id))
+    # Counts every registered voter into the new election's turnout
+    Turnout.rebuild(session, election.election_id)
+    return election
+
+
+def open_first_election(session, name=ELECTION_NAME):
+    # Run once at deploy time, does nothing on a database that has already had an election
+    if session.query(Election.election_id).limit(1).scalar() is not None:
+        return None
+    return start_election(session, name)
+
+
+def election_to_dict(election):
+    return {
+        "election_id": election.election_id,
+        "name": election.name,
+        "started_at": election.started_at.isoformat(),
+        "closed_at": election.closed_at.isoformat() if election.closed_at else None,
+        "active": election.closed_at is None
+    }
+
+
+def load_results(session, election):
+    # Live tallies for the open election, the tallies frozen in Candidacy for a closed one
+    if election.closed_at is None:
+        rows = session.query(Candidate.candidate_id, Candidate.candidate_firstname, Candidate.candidate_lastname,
+                             Candidate.party_id, Candidate.constituency_id, func.coalesce(Candidate.vote_count, 0))
+    else:
+        rows = session.query(Candidacy.candidate_id, Candidate.candidate_firstname, Candidate.candidate_lastname,
+                             Candidacy.party_id, Candidacy.constituency_id, Candidacy.vote_count) \
+            .join(Candidate, Candidate.candidate_id == Candidacy.candidate_id) \
+            .filter(Candidacy.election_id == election.election_id)
+
+    candidates = [{"candidate_id": candidate_id,
+                   "candidate_firstname": first_name,
+                   "candidate_lastname": last_name,
+                   "party_id": party_id,
+                   "constituency_id": constituency_id,
+                   "vote_count": vote_count}
+                  for candidate_id, first_name, last_name, party_id, constituency_id, vote_count
+                  in rows.order_by(Candidate.candidate_id)]
+    return {"total_votes": sum(candidate["vote_count"] for candidate in candidates),
+            "ballots": session.query(func.count(RankedBallot.ballot_id))
+            .filter(RankedBallot.election_id == election.election_id).scalar(),
+            "votes_cast": session.query(func.count(Votes.vote_id))
+            .filter(Votes.election_id == election.election_id).scalar(),
+            "candidates": candidates}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Close the open election and start a new one")
+    parser.add_argument("name", nargs="?", default=ELECTION_NAME)
+    parser.add_argument("--first", action="store_true",
+                        help="only open an election if the database has never had one, for deploy scripts")
+    args = parser.parse_args()
+
+    session = sessionmaker(bind=engine)()
+    try:
+        election = open_first_election(session, args.name) if args.first else start_election(session, args.name)
+        session.commit()
+        if election is None:
+            print("An election has already been opened")
+        else:
+            print(f"Election {election.election_id} ({election.name}) is open")
+    finally:
+        session.close()
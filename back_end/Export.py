@@ -0,0 +1,139 @@
+import argparse
+import csv
+import io
+import os
+
+from sqlalchemy.orm import sessionmaker
+
+from Models import Votes, Candidate, Party, Voter, engine
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+CHUNK_SIZE = 10000
+
+# Each export is (key column, constituency column, columns). Voter passwords are never exported.
+EXPORTS = {
+    'votes': (Votes.vote_id, Candidate.constituency_id, [
+        Votes.vote_id, Votes.election_id, Votes.voter_id, Votes.candidate_id, Votes.vote_type,
+        Candidate.constituency_id]),
+    'candidates': (Candidate.candidate_id, Candidate.constituency_id, [
+        Candidate.candidate_id, Candidate.candidate_firstname, Candidate.candidate_lastname, Candidate.party_id,
+        Party.party_name, Candidate.constituency_id, Candidate.vote_count]),
+    'voters': (Voter.voter_id, Voter.constituency_id, [
+        Voter.voter_id, Voter.first_name, Voter.last_name, Voter.gov_id, Voter.email, Voter.constituency_id,
+        Voter.isAdmin])
+}
+
+PARQUET_TYPES = {
+    'vote_id': 'int64', 'election_id': 'int32', 'voter_id': 'int64', 'candidate_id': 'int64', 'vote_type': 'int8',
+    'constituency_id': 'int32', 'party_id': 'int32', 'vote_count': 'int64', 'isAdmin': 'bool'
+}
+
+
+def column_names(table):
+    return [column.key for column in EXPORTS[table][2]]
+
+
+def base_query(session, table):
+    query = session.query(*EXPORTS[table][2])
+    if table == 'votes':
+        query = query.join(Candidate, Votes.candidate_id == Candidate.candidate_id)
+    elif table == 'candidates':
+        query = query.join(Party, Candidate.party_id == Party.party_id)
+    return query
+
+
+def iter_chunks(session, table, constituency_id=None, chunk_size=CHUNK_SIZE):
+    # Pages through the table on its primary key, so memory use stays the same
+    # however large the table is and no cursor is held open between chunks
+    key, constituency, _ = EXPORTS[table]
+    query = base_query(session, table)
+    if constituency_id is not None:
+        query = query.filter(constituency == constituency_id)
+
+    last_key = None
+    while True:
+        page = query if last_key is None else query.filter(key > last_key)
+        rows = page.order_by(key).limit(chunk_size).all()
+        if not rows:
+            return
+        yield rows
+        last_key = rows[-1][0]
+
+
+def stream_csv(session, table, constituency_id=None):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(column_names(table))
+    for rows in iter_chunks(session, table, constituency_id):
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def write_csv(session, table, path, constituency_id=None):
+    with open(path, 'w', newline='') as file:
+        for text in stream_csv(session, table, constituency_id):
+            file.write(text)
+
+
+def parquet_schema(table):
+    return pyarrow.schema([(name, PARQUET_TYPES.get(name, 'string')) for name in column_names(table)])
+
+
+def write_parquet(session, table, where, constituency_id=None):
+    # Every chunk is written as its own row group, where can be a path or a binary file
+    if pyarrow is None:
+        raise RuntimeError("Parquet export needs pyarrow installed")
+
+    schema = parquet_schema(table)
+    names = column_names(table)
+    with pyarrow.parquet.ParquetWriter(where, schema, compression='zstd') as writer:
+        for rows in iter_chunks(session, table, constituency_id):
+            columns = zip(*rows)
+            writer.write_batch(pyarrow.record_batch(
+                [pyarrow.array(values, type=schema.field(name).type) for name, values in zip(names, columns)],
+                schema=schema))
+
+
+def export(session, table, file_format, out_dir, partition=False):
+    # Writes out_dir/<table>.<format>, or with partition one file per constituency
+    # under out_dir/<table>/constituency_id=<id>/
+    write = write_parquet if file_format == 'parquet' else write_csv
+    if not partition:
+        path = os.path.join(out_dir, f"{table}.{file_format}")
+        write(session, table, path)
+        return [path]
+
+    constituency = EXPORTS[table][1]
+    paths = []
+    for constituency_id, in base_query(session, table).with_entities(constituency).distinct().order_by(constituency):
+        directory = os.path.join(out_dir, table, f"constituency_id={constituency_id}")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"part.{file_format}")
+        write(session, table, path, constituency_id)
+        paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export election tables to CSV or Parquet")
+    parser.add_argument("table", choices=sorted(EXPORTS))
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--out", default="exports")
+    parser.add_argument("--partition", action="store_true", help="write one file per constituency")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    session = sessionmaker(bind=engine)()
+    try:
+        for written in export(session, args.table, args.format, args.out, args.partition):
+            print(written)
+    finally:
+        session.close()
@@ -1,6 +1,9 @@
 import os
 import pickle
 
+import httplib2
+from decouple import config
+from google_auth_httplib2 import AuthorizedHttp
 # Gmail API utils
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -16,9 +19,11 @@ from mimetypes import guess_type as guess_mime_type
 # Request all access (permission to read/send/receive emails, manage the inbox, and more)
 SCOPES = ['https://mail.google.com/']
 my_email = 'rcoleman1793@gmail.com'
+# Seconds before a call to Gmail is abandoned, the client waits forever by default
+GMAIL_TIMEOUT = config('GMAIL_TIMEOUT', default=10, cast=int)
 
 
-def gmail_authenticate():
+def gmail_credentials():
     creds = None
     # token.pickle file stores user's access tokens
     if os.path.exists("token.pickle"):
@@ -34,7 +39,16 @@ def gmail_authenticate():
         # save the credentials for the next run
         with open("token.pickle", "wb") as token:
             pickle.dump(creds, token)
-    return build('gmail', 'v1', credentials=creds)
+    return creds
+
+
+def gmail_service(creds):
+    # httplib2 is not thread safe, each thread sending mail builds its own service from shared credentials
+    return build('gmail', 'v1', http=AuthorizedHttp(creds, http=httplib2.Http(timeout=GMAIL_TIMEOUT)))
+
+
+def gmail_authenticate():
+    return gmail_service(gmail_credentials())
 
 
 # get the Gmail API service
@@ -0,0 +1,115 @@
+import threading
+import time
+
+from decouple import config
+from sqlalchemy import text
+from sqlalchemy.pool import QueuePool
+
+from Cache import TTLCache
+
+# Requests this worker can run at once, THREADS is the gunicorn setting
+HEALTH_MAX_IN_FLIGHT = config('HEALTH_MAX_IN_FLIGHT', default=config('THREADS', default=4, cast=int), cast=int)
+HEALTH_MAX_MAIL_BACKLOG = config('HEALTH_MAX_MAIL_BACKLOG', default=10000, cast=int)
+# Load balancers poll every few seconds, the database is probed at most this often per worker
+HEALTH_PROBE_TTL = config('HEALTH_PROBE_TTL', default=1, cast=float)
+
+
+class InFlight:
+    # Counts the requests this worker is running
+
+    def __init__(self):
+        self.count = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def enter(self):
+        with self.lock:
+            self.count += 1
+            self.peak = max(self.peak, self.count)
+
+    def leave(self):
+        with self.lock:
+            self.count -= 1
+
+
+def pool_status(engine):
+    # Only a QueuePool has a fixed size to saturate, SQLite's pools report nothing
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {}
+    checked_out = pool.checkedout()
+    return {"size": pool.size(),
+            "checked_out": checked_out,
+            "overflow": max(pool.overflow(), 0),
+            "max_overflow": pool._max_overflow,
+            "saturated": pool._max_overflow >= 0 and checked_out >= pool.size() + pool._max_overflow}
+
+
+class HealthCheck:
+
+    def __init__(self, engine, replica_set=None, notification_sender=None, breakers=(),
+                 max_in_flight=HEALTH_MAX_IN_FLIGHT, max_mail_backlog=HEALTH_MAX_MAIL_BACKLOG):
+        self.engine = engine
+        # Circuit breakers, or callables returning one for breakers created after this
+        self.breakers = breakers
+        self.replica_set = replica_set
+        self.notification_sender = notification_sender
+        self.max_in_flight = max_in_flight
+        self.max_mail_backlog = max_mail_backlog
+        self.in_flight = InFlight()
+        self.probes = TTLCache(ttl=HEALTH_PROBE_TTL, maxsize=1)
+        self.started_at = time.time()
+
+    def probe_database(self):
+        # A saturated pool would make the probe wait for a connection, it is reported instead
+        started = time.perf_counter()
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            return {"reachable": True, "latency_ms": round((time.perf_counter() - started) * 1000, 2)}
+        except Exception as e:
+            return {"reachable": False, "error": str(e).splitlines()[0]}
+
+    def live(self):
+        return {"status": "ok", "uptime": round(time.time() - self.started_at)}
+
+    def ready(self):
+        # Returns the report and whether this worker should be sent traffic
+        pool = pool_status(self.engine)
+        if pool.get("saturated"):
+            database = {"reachable": None, "error": "Connection pool saturated"}
+        else:
+            database = self.probes.get_or_load('database', self.probe_database)
+
+        # The probe itself is one of the requests in flight
+        in_flight = self.in_flight.count - 1
+        mail_backlog = self.notification_sender.backlog if self.notification_sender is not None else 0
+
+        reasons = []
+        if not database["reachable"]:
+            reasons.append(database["error"])
+        if in_flight >= self.max_in_flight:
+            reasons.append("Too many requests in flight")
+        if mail_backlog > self.max_mail_backlog:
+            reasons.append("Mail backlog too large")
+
+        return {
+            "status": "ready" if not reasons else "unavailable",
+            "reasons": reasons,
+            "database": database,
+            "pool": pool,
+            "replicas": self.replica_set.status() if self.replica_set is not None else [],
+            "breakers": [(breaker if hasattr(breaker, 'status') else breaker()).status() for breaker in self.breakers],
+            "in_flight": in_flight,
+            "peak_in_flight": self.in_flight.peak,
+            "mail_backlog": mail_backlog
+        }, not reasons
+
+    def init_app(self, app):
+        @app.before_request
+        def enter_request():
+            self.in_flight.enter()
+
+        @app.teardown_request
+        def leave_request(exception=None):
+            self.in_flight.leave()
@@ -1,15 +1,50 @@
 import json
+import os
 import random
 import re
+from functools import lru_cache
 import bcrypt
+from sqlalchemy import func, select, literal, union_all
+from sqlalchemy.orm import undefer
 from flask import make_response
-from flask_jwt_extended import get_jwt_identity, jwt_required
-from back_end import GoogleAPI
-from back_end.API import postcode_regex
-from back_end.Models import Voter, Verification, Votes
+from flask_jwt_extended import get_jwt, get_jwt_identity, jwt_required
+import GoogleAPI
+from Cache import TTLCache
+from Counting import plus_minus_tallies
+from CircuitBreaker import CircuitBreaker, CircuitOpen
+from ImageStore import thumbnail_url
+from Models import Voter, Votes, Constituency, Party, Candidate
 
 OTP_RANGE_MIN = 100000
 OTP_RANGE_MAX = 999999
+TOKEN_LIFETIME_MINUTES = 10
+IDENTITY_CACHE_TTL = 30
+# Workers read each other's changes through the database, these bound how long they can miss one
+TOKEN_VERSION_CACHE_TTL = 5
+CATALOG_CACHE_TTL = 15
+MAX_EXCERPT_LENGTH = 500
+CONSTITUENCIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'constituencies.json')
+
+# Regular expression for a properly constructed email address
+email_regex = re.compile(r'\b[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b')
+
+# Regular expression that takes the first part of postcode, compiled once at import
+postcode_regex = re.compile(r'^[A-Z0-9]{3}([A-Z0-9](?=\s*[A-Z0-9]{3}|$))?')
+
+# Voter identities loaded from the database, keyed by gov_id. An entry is only used while
+# its token_version is still the voter's current one.
+identity_cache = TTLCache(ttl=IDENTITY_CACHE_TTL)
+
+# gov_id -> Voter.token_version, None once the voter is deleted. A change made by one worker is
+# seen straight away by that worker and within TOKEN_VERSION_CACHE_TTL seconds by every other one.
+token_versions = TTLCache(ttl=TOKEN_VERSION_CACHE_TTL)
+
+# Serialized party and candidate lists. Cleared in the worker where an admin changes them, the
+# other workers serve the old lists for at most CATALOG_CACHE_TTL seconds.
+catalog_cache = TTLCache(ttl=CATALOG_CACHE_TTL)
+
+# Stops waiting on Gmail while it is failing, mail routes answer 503 straight away instead
+mail_breaker = CircuitBreaker('gmail')
 
 
 # Encrypt password using bcrypt
@@ -17,8 +52,57 @@ def encrypt_password(password):
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
 
 
-def get_vote_count(candidate_id, session):
-    return session.query(Votes).filter_by(candidate_id=candidate_id).count()
+def get_vote_count(candidate_id, session, election_id):
+    # The candidate's tally counted again from the stored votes, the same as PlusMinusCount
+    return plus_minus_tallies(session.query(Votes.candidate_id, Votes.vote_type)
+                              .filter_by(election_id=election_id, candidate_id=candidate_id)
+                              .order_by(Votes.vote_id)).get(candidate_id, 0)
+
+
+def used_vote_counts_query(election_id, voter_id):
+    # The number of each type of vote the voter has stored, as (vote_type, count) rows
+    return select(Votes.vote_type, func.count()) \
+        .filter_by(election_id=election_id, voter_id=voter_id) \
+        .group_by(Votes.vote_type)
+
+
+def used_vote_slots(session, election_id, voter_id, vote_type):
+    return {slot for slot, in session.query(Votes.slot)
+            .filter_by(election_id=election_id, voter_id=voter_id, vote_type=vote_type)}
+
+
+def free_vote_slot(session, election_id, voter_id, vote_type, max_votes):
+    # Lowest slot the voter has not used for this vote type, None once all are taken
+    used = used_vote_slots(session, election_id, voter_id, vote_type)
+    return next((slot for slot in range(max_votes) if slot not in used), None)
+
+
+def ballot_state(session, election_id, voter_id, constituency_id, candidate_ids):
+    # One query for which of the chosen candidates stand in the voter's constituency
+    # and which slots the voter has already used in the election, as (standing ids, {vote_type: slots})
+    rows = session.execute(union_all(
+        select(literal(0), Candidate.candidate_id)
+        .where(Candidate.candidate_id.in_(candidate_ids), Candidate.constituency_id == constituency_id),
+        select(Votes.vote_type, Votes.slot).where(Votes.election_id == election_id, Votes.voter_id == voter_id)))
+
+    standing, used = set(), {}
+    for vote_type, value in rows:
+        if vote_type == 0:
+            standing.add(value)
+        else:
+            used.setdefault(vote_type, set()).add(value)
+    return standing, used
+
+
+def apply_vote_to_tally(session, candidate_id, vote_type):
+    # Updated in SQL so concurrent votes for the same candidate are never lost,
+    # and the candidate vote number cannot become a negative value. A recount
+    # applies the same rule through Counting.plus_minus_tallies.
+    query = session.query(Candidate).filter(Candidate.candidate_id == candidate_id)
+    if vote_type < 0:
+        query = query.filter(Candidate.vote_count > 0)
+    query.update({Candidate.vote_count: func.coalesce(Candidate.vote_count, 0) + vote_type},
+                 synchronize_session=False)
 
 
 def gov_id_generator(n):
@@ -27,16 +111,16 @@ def gov_id_generator(n):
     return random.randint(range_start, range_end)
 
 
-def match_postcode_with_constituency(postcode):
-    # Load the JSON dictionary from a file
-    with open('constituencies.json', 'r') as constituencies:
-        constituency_dictionary = json.load(constituencies)
+@lru_cache(maxsize=None)
+def load_constituencies():
+    # The JSON dictionary is read once per process
+    with open(CONSTITUENCIES_FILE, 'r') as constituencies:
+        return json.load(constituencies)
 
+
+def match_postcode_with_constituency(postcode):
     # Look up the value in the dictionary
-    if postcode in constituency_dictionary:
-        return constituency_dictionary[postcode]
-    else:
-        return None
+    return load_constituencies().get(postcode)
 
 
 def generate_otp():
@@ -44,28 +128,15 @@ def generate_otp():
 
 
 def validate_email(email):
-    # Regular expression for a properly constructed email address
-    email_regex = r'\b[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b'
-
-    if re.match(email_regex, email):
-        return True
-    else:
-        return False
+    return email_regex.match(email) is not None
 
 
 def validate_postcode(postcode):
-    if re.search(postcode_regex, postcode):
-        return True
-    else:
-        return False
+    return postcode_regex.search(postcode) is not None
 
 
-def verify_otp(email, otp, session):
-    registration = session.query(Verification).filter_by(email=email, otp=otp).first()
-    if registration:
-        return True
-    else:
-        return False
+def verify_otp(email, otp, store):
+    return store.verify(email, otp)
 
 
 def user_exists(email, session):
@@ -87,15 +158,20 @@ def check_password(password, hashed_password):
     return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
 
 
+@mail_breaker
+def send_mail(email, subject, body):
+    # Raises CircuitOpen without calling Gmail while the breaker is open
+    return GoogleAPI.send_message(GoogleAPI.service, email, subject, body)
+
+
 def send_otp(email, otp):
-    email_sent = GoogleAPI.send_message(GoogleAPI.service, email, "Your OTP", f"Your OTP is: {otp}")
+    email_sent = send_mail(email, "Your OTP", f"Your OTP is: {otp}")
     if not email_sent:
         return make_response("Failed to send email", 500)
 
 
 def send_gov_id(email, gov_id):
-    email_sent = GoogleAPI.send_message(GoogleAPI.service, email, "Your Government ID",
-                                        f"Your Government ID is: {gov_id}")
+    email_sent = send_mail(email, "Your Government ID", f"Your Government ID is: {gov_id}")
     if not email_sent:
         return make_response("Failed to send email", 500)
 
@@ -112,6 +188,232 @@ def get_gov_id(gov_id, session):
     return session.query(Voter).filter_by(gov_id=gov_id).first()
 
 
+# Statements shared by the Flask routes and their async twins in AsyncAPI, each runs on
+# either kind of session
+def party_detail_query(party_id):
+    return select(Party).options(undefer(Party.manifesto)).filter(Party.party_id == party_id)
+
+
+def candidate_detail_query(candidate_id):
+    return select(Candidate, Party, Constituency) \
+        .options(undefer(Candidate.statement)) \
+        .join(Party, Candidate.party_id == Party.party_id) \
+        .join(Constituency, Candidate.constituency_id == Constituency.constituency_id) \
+        .filter(Candidate.candidate_id == candidate_id)
+
+
+def voting_data_query():
+    return select(Candidate, Party).join(Party, Candidate.party_id == Party.party_id)
+
+
+def total_votes_query():
+    return select(func.sum(Candidate.vote_count))
+
+
+def identity_query(gov_id):
+    return select(Voter, Constituency) \
+        .join(Constituency, Voter.constituency_id == Constituency.constituency_id) \
+        .filter(Voter.gov_id == gov_id)
+
+
+def party_to_dict(party):
+    return {
+        "party_id": party.party_id,
+        "party_name": party.party_name,
+        "image": party.image,
+        "thumbnail": thumbnail_url(party.image, 'medium'),
+        "manifesto": party.manifesto
+    }
+
+
+def truncate(text, length):
+    text = text or ""
+    if len(text) <= length:
+        return text
+    return text[:length].rstrip() + "\u2026"
+
+
+def excerpt_length(requested):
+    return min(max(requested or 0, 0), MAX_EXCERPT_LENGTH)
+
+
+def party_summary_query(excerpt=0):
+    # With an excerpt only its first characters are read, plus one to tell whether it was cut short
+    columns = [Party.party_id, Party.party_name, Party.image]
+    if excerpt:
+        columns.append(func.substring(Party.manifesto, 1, excerpt + 1))
+    return select(*columns).order_by(Party.party_id)
+
+
+def candidate_summary_query(excerpt=0):
+    columns = [Candidate.candidate_id, Candidate.candidate_firstname, Candidate.candidate_lastname,
+               Candidate.party_id, Candidate.image, Party.party_name]
+    if excerpt:
+        columns.append(func.substring(Candidate.statement, 1, excerpt + 1))
+    return select(*columns) \
+        .join(Party, Candidate.party_id == Party.party_id) \
+        .order_by(Candidate.candidate_id)
+
+
+def party_summary_to_dict(row, excerpt=0):
+    party = {
+        "party_id": row.party_id,
+        "party_name": row.party_name,
+        "image": row.image,
+        "thumbnail": thumbnail_url(row.image, 'medium')
+    }
+    if excerpt:
+        party["manifesto_excerpt"] = truncate(row[3], excerpt)
+    return party
+
+
+def candidate_summary_to_dict(row, excerpt=0):
+    candidate = {
+        "candidate_id": row.candidate_id,
+        "candidate_firstname": row.candidate_firstname,
+        "candidate_lastname": row.candidate_lastname,
+        "party_id": row.party_id,
+        "image": row.image,
+        "thumbnail": thumbnail_url(row.image, 'medium'),
+        "party_name": row.party_name
+    }
+    if excerpt:
+        candidate["statement_excerpt"] = truncate(row[6], excerpt)
+    return candidate
+
+
+def candidate_detail_to_dict(candidate, party, constituency):
+    return {
+        "candidate_id": candidate.candidate_id,
+        "candidate_firstname": candidate.candidate_firstname,
+        "candidate_lastname": candidate.candidate_lastname,
+        "party_id": party.party_id,
+        "image": candidate.image,
+        "statement": candidate.statement,
+        "party_name": party.party_name,
+        "party_image": party.image,
+        "constituency_name": constituency.constituency_name,
+    }
+
+
+def voting_data_to_dict(candidate, party, total_votes):
+    return {
+        "candidate_id": candidate.candidate_id,
+        "candidate_name": f"{candidate.candidate_firstname} {candidate.candidate_lastname}",
+        "party_id": party.party_id,
+        "party_name": party.party_name,
+        "vote_count": candidate.vote_count,
+        "candidate_image": candidate.image,
+        "candidate_thumbnail": thumbnail_url(candidate.image, 'small'),
+        "vote_percentage": (candidate.vote_count / total_votes) * 100 if total_votes else 0
+    }
+
+
+def voter_summary_to_dict(voter, election_id=None):
+    # Never includes the password hash, has_voted is for the given election
+    return {
+        "voter_id": voter.voter_id,
+        "first_name": voter.first_name,
+        "last_name": voter.last_name,
+        "gov_id": voter.gov_id,
+        "email": voter.email,
+        "constituency_id": voter.constituency_id,
+        "isAdmin": bool(voter.isAdmin),
+        "has_voted": election_id is not None and voter.voted_in == election_id
+    }
+
+
+def load_party_list(session, excerpt=0):
+    return [party_summary_to_dict(row, excerpt) for row in session.execute(party_summary_query(excerpt))]
+
+
+def load_candidate_list(session, excerpt=0):
+    return [candidate_summary_to_dict(row, excerpt) for row in session.execute(candidate_summary_query(excerpt))]
+
+
+def get_party_list(session, excerpt=0):
+    return catalog_cache.get_or_load(('parties', excerpt), lambda: load_party_list(session, excerpt))
+
+
+def get_candidate_list(session, excerpt=0):
+    return catalog_cache.get_or_load(('candidates', excerpt), lambda: load_candidate_list(session, excerpt))
+
+
+def invalidate_catalog():
+    catalog_cache.clear()
+
+
 def get_password(gov_id, session):
     voter = session.query(Voter).filter_by(gov_id=gov_id).first()
     return voter.password
+
+
+def identity_claims(voter):
+    return {
+        'voter_id': voter.voter_id,
+        'constituency_id': voter.constituency_id,
+        'isAdmin': bool(voter.isAdmin),
+        'token_version': voter.token_version
+    }
+
+
+def load_identity(gov_id, session):
+    user = session.execute(identity_query(gov_id)).first()
+
+    if user is None:
+        return None
+
+    return identity_from_row(*user)
+
+
+def identity_from_row(voter, constituency):
+    identity = identity_claims(voter)
+    identity.update({
+        'first_name': voter.first_name,
+        'last_name': voter.last_name,
+        'gov_id': voter.gov_id,
+        'email': voter.email,
+        'constituency_name': constituency.constituency_name
+    })
+    return identity
+
+
+def get_token_version(gov_id, session):
+    return token_versions.get_or_load(
+        gov_id, lambda: session.query(Voter.token_version).filter_by(gov_id=gov_id).scalar())
+
+
+def get_cached_identity(gov_id, session):
+    version = get_token_version(gov_id, session)
+    if version is None:
+        return None
+
+    identity = identity_cache.get(gov_id)
+    if identity is None or identity['token_version'] != version:
+        identity = load_identity(gov_id, session)
+        identity_cache.set(gov_id, identity)
+    return identity
+
+
+def get_identity(session):
+    # Must be called inside a jwt_required request. The claims embedded at login
+    # are used as-is unless the voter has been changed since the token was issued.
+    gov_id = get_jwt_identity()
+    claims = get_jwt()
+
+    if 'voter_id' in claims and claims.get('token_version') == get_token_version(gov_id, session):
+        return {key: claims[key] for key in ('voter_id', 'constituency_id', 'isAdmin')}
+
+    return get_cached_identity(gov_id, session)
+
+
+def expire_token_claims(voter):
+    # Part of the caller's transaction, once it is committed every worker stops trusting the
+    # claims in the voter's existing tokens and reads the voter from the database instead
+    voter.token_version = Voter.token_version + 1
+
+
+def invalidate_identity(gov_id):
+    # After the commit that changed or deleted the voter, this worker sees it straight away
+    token_versions.pop(gov_id)
+    identity_cache.pop(gov_id)
@@ -0,0 +1,119 @@
+import hashlib
+import json
+from datetime import datetime, timedelta
+
+from decouple import config
+
+from Background import run_periodically
+from Cache import TTLCache
+from Models import IdempotencyKey, Votes
+
+IDEMPOTENCY_TTL = config('IDEMPOTENCY_TTL', default=86400, cast=int)
+IDEMPOTENCY_CACHE_SIZE = config('IDEMPOTENCY_CACHE_SIZE', default=100000, cast=int)
+IDEMPOTENCY_SWEEP_INTERVAL = config('IDEMPOTENCY_SWEEP_INTERVAL', default=300, cast=int)
+MAX_KEY_LENGTH = 64
+
+
+class KeyReused(Exception):
+    # The Idempotency-Key was already used by this voter for a request with a different body
+    pass
+
+
+class IdempotencyStore:
+    # Remembers which vote each (voter, Idempotency-Key) pair created and a hash of the
+    # request that created it. A bounded local cache answers most retries, the
+    # IdempotencyKey table is shared by every worker and its unique constraint settles
+    # concurrent retries.
+
+    def __init__(self, session_factory, ttl=IDEMPOTENCY_TTL, maxsize=IDEMPOTENCY_CACHE_SIZE):
+        self.session_factory = session_factory
+        self.ttl = ttl
+        self.cache = TTLCache(ttl=ttl, maxsize=maxsize)
+        self._stop_sweeper = None
+
+    def cached(self, session, voter_id, key, request_hash=None):
+        # The vote the key created if this worker remembers it, raises KeyReused for a different request.
+        # Another worker may have deleted the vote since, so it is only replayed while its row exists.
+        entry = self.cache.get((voter_id, key))
+        if entry is None:
+            return None
+        vote_id, stored_hash = entry
+        check_request(stored_hash, request_hash)
+        if session.query(Votes.vote_id).filter(Votes.vote_id == vote_id).first() is None:
+            self.cache.pop((voter_id, key))
+            return None
+        return vote_id
+
+    def lookup(self, session, voter_id, key, request_hash=None):
+        vote_id = self.cached(session, voter_id, key, request_hash)
+        if vote_id is not None:
+            return vote_id
+
+        entry = session.query(IdempotencyKey.vote_id, IdempotencyKey.request_hash) \
+            .filter(IdempotencyKey.voter_id == voter_id,
+                    IdempotencyKey.key == key,
+                    IdempotencyKey.expires_at > datetime.utcnow()) \
+            .first()
+        if entry is None:
+            return None
+
+        self.cache.set((voter_id, key), (entry.vote_id, entry.request_hash))
+        check_request(entry.request_hash, request_hash)
+        return entry.vote_id
+
+    def record(self, session, voter_id, key, vote_id, request_hash=None, journal_id=None):
+        # Added to the caller's transaction so the key and the vote commit together
+        session.add(IdempotencyKey(voter_id=voter_id, key=key, vote_id=vote_id, request_hash=request_hash,
+                                   journal_id=journal_id,
+                                   expires_at=datetime.utcnow() + timedelta(seconds=self.ttl)))
+
+    def remember(self, voter_id, key, vote_id, request_hash=None):
+        self.cache.set((voter_id, key), (vote_id, request_hash))
+
+    def forget(self, keys):
+        for voter_id, key in keys:
+            self.cache.pop((voter_id, key))
+
+    def delete(self, session, condition):
+        # Added to the caller's transaction, other workers notice when they next replay one of the keys
+        keys = session.query(IdempotencyKey.voter_id, IdempotencyKey.key).filter(condition).all()
+        session.query(IdempotencyKey).filter(condition).delete(synchronize_session=False)
+        self.forget(keys)
+
+    def delete_vote(self, session, vote_id):
+        self.delete(session, IdempotencyKey.vote_id == vote_id)
+
+    def clear(self, session, election_id):
+        # Only the election's keys, run before its votes are deleted
+        self.delete(session, IdempotencyKey.vote_id.in_(
+            session.query(Votes.vote_id).filter(Votes.election_id == election_id)))
+
+    def sweep(self):
+        session = self.session_factory()
+        try:
+            deleted = session.query(IdempotencyKey) \
+                .filter(IdempotencyKey.expires_at <= datetime.utcnow()) \
+                .delete(synchronize_session=False)
+            session.commit()
+            return deleted
+        finally:
+            session.close()
+
+    def start_sweeper(self, interval=IDEMPOTENCY_SWEEP_INTERVAL):
+        if self._stop_sweeper is None:
+            self._stop_sweeper = run_periodically("idempotency-sweeper", interval, self.sweep)
+
+
+def valid_key(key):
+    return 0 < len(key) <= MAX_KEY_LENGTH
+
+
+def request_hash(data):
+    # Of the parsed JSON body, so a retry that only differs in whitespace or key order still matches
+    return hashlib.sha256(json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def check_request(stored_hash, request_hash):
+    # Keys stored before requests were hashed match any request
+    if stored_hash is not None and request_hash is not None and stored_hash != request_hash:
+        raise KeyReused()
@@ -0,0 +1,209 @@
+import argparse
+import base64
+import binascii
+import hashlib
+import io
+import os
+import re
+import tempfile
+
+from decouple import config
+from sqlalchemy.orm import sessionmaker
+
+from Models import Party, Candidate, engine
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+IMAGE_DIR = config('IMAGE_DIR', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'images'))
+# Set to a CDN origin to have image URLs point there instead of at this API
+IMAGE_BASE_URL = config('IMAGE_BASE_URL', default='')
+IMAGE_MAX_BYTES = config('IMAGE_MAX_BYTES', default=5 * 1024 * 1024, cast=int)
+IMAGE_ROUTE = '/api/v1.0/images/'
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Longest side in pixels of each thumbnail
+THUMBNAIL_SIZES = {'small': 96, 'medium': 320}
+
+# Formats are recognised from the file itself, never from what the client says it sent
+SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+]
+CONTENT_TYPES = {'png': 'image/png', 'jpg': 'image/jpeg', 'gif': 'image/gif', 'webp': 'image/webp'}
+PILLOW_FORMATS = {'png': 'PNG', 'jpg': 'JPEG', 'webp': 'WEBP'}
+
+NAME_REGEX = re.compile(r'^(?P<digest>[0-9a-f]{64})(?:-(?P<size>[a-z]+))?\.(?P<ext>png|jpg|gif|webp)$')
+URL_REGEX = re.compile(r'/(?P<digest>[0-9a-f]{64})\.(?P<ext>png|jpg|gif|webp)$')
+DATA_URI_REGEX = re.compile(r'^data:image/[a-z+.-]+;base64,', re.IGNORECASE)
+
+
+class ImageError(ValueError):
+    pass
+
+
+def sniff_format(data):
+    for signature, ext in SIGNATURES:
+        if data.startswith(signature):
+            return ext
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def thumbnail_ext(ext):
+    # Thumbnails of animated GIFs are a still PNG of the first frame
+    return 'png' if ext == 'gif' else ext
+
+
+def thumbnail_url(url, size):
+    # The URL of a thumbnail of an image in this store, any other URL is returned unchanged
+    match = URL_REGEX.search(url or '')
+    if not match or size not in THUMBNAIL_SIZES:
+        return url
+    return f"{url[:match.start()]}/{match['digest']}-{size}.{thumbnail_ext(match['ext'])}"
+
+
+def thumbnail_name(name, size):
+    match = NAME_REGEX.match(name)
+    return f"{match['digest']}-{size}.{thumbnail_ext(match['ext'])}"
+
+
+def render_thumbnail(source, ext, size):
+    # The encoded thumbnail of an image read from a path or a binary file
+    with Image.open(source) as image:
+        image.thumbnail((THUMBNAIL_SIZES[size], THUMBNAIL_SIZES[size]))
+        ext = thumbnail_ext(ext)
+        if ext == 'jpg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        buffer = io.BytesIO()
+        image.save(buffer, PILLOW_FORMATS[ext], optimize=True)
+    return buffer.getvalue()
+
+
+def decode_data_uri(value):
+    try:
+        return base64.b64decode(value[DATA_URI_REGEX.match(value).end():], validate=True)
+    except (binascii.Error, ValueError):
+        raise ImageError("Image data is not valid base64")
+
+
+class ImageStore:
+    # Images are stored once under the sha256 of their content, so a name always
+    # refers to the same bytes and can be cached by browsers and CDNs forever
+
+    def __init__(self, directory=IMAGE_DIR, base_url=IMAGE_BASE_URL):
+        self.directory = directory
+        self.base_url = base_url
+
+    def path(self, name):
+        return os.path.join(self.directory, name[:2], name)
+
+    def url(self, name, host_url=''):
+        return f"{(self.base_url or host_url).rstrip('/')}{IMAGE_ROUTE}{name}"
+
+    def write(self, name, data):
+        # Written to a temporary file first so a half written image is never served
+        path = self.path(name)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def put(self, data):
+        # Stores the image and its thumbnails, returns the name of the original. The
+        # thumbnails are made first, so an image Pillow cannot read leaves no files behind.
+        if len(data) > IMAGE_MAX_BYTES:
+            raise ImageError(f"Images must be smaller than {IMAGE_MAX_BYTES // (1024 * 1024)} MB")
+        ext = sniff_format(data)
+        if ext is None:
+            raise ImageError("Images must be PNG, JPEG, GIF or WebP")
+
+        name = f"{hashlib.sha256(data).hexdigest()}.{ext}"
+        if os.path.exists(self.path(name)):
+            return name
+
+        thumbnails = {}
+        if Image is not None:
+            try:
+                for size in THUMBNAIL_SIZES:
+                    thumbnails[thumbnail_name(name, size)] = render_thumbnail(io.BytesIO(data), ext, size)
+            except Exception as e:
+                raise ImageError(f"Image could not be read: {e}")
+
+        self.write(name, data)
+        for thumbnail, thumbnail_data in thumbnails.items():
+            self.write(thumbnail, thumbnail_data)
+        return name
+
+    def thumbnail(self, name, size):
+        # Returns the name of the thumbnail, creating it if needed, or None without Pillow
+        thumbnail = thumbnail_name(name, size)
+        if os.path.exists(self.path(thumbnail)):
+            return thumbnail
+        if Image is None:
+            return None
+
+        self.write(thumbnail, render_thumbnail(self.path(name), NAME_REGEX.match(name)['ext'], size))
+        return thumbnail
+
+    def resolve(self, name):
+        # Path of a stored file for the image route, thumbnails fall back to the original
+        # when they cannot be generated. None when there is no such image.
+        match = NAME_REGEX.match(name)
+        if not match:
+            return None
+        if os.path.exists(self.path(name)):
+            return self.path(name)
+
+        size = match['size']
+        if size not in THUMBNAIL_SIZES:
+            return None
+        for ext in CONTENT_TYPES:
+            original = f"{match['digest']}.{ext}"
+            if os.path.exists(self.path(original)):
+                thumbnail = self.thumbnail(original, size)
+                return self.path(thumbnail or original)
+        return None
+
+    def ingest(self, value, host_url=''):
+        # Data URIs are moved into the store and replaced with their URL, anything
+        # else (a link to an image hosted elsewhere or in this store) is kept as it is
+        if value and DATA_URI_REGEX.match(value):
+            return self.url(self.put(decode_data_uri(value)), host_url)
+        return value
+
+
+def migrate(session, store, host_url):
+    # Moves data URIs already saved on parties and candidates into the store
+    moved = 0
+    for model in (Party, Candidate):
+        for row in session.query(model).filter(model.image.like('data:%')):
+            row.image = store.ingest(row.image, host_url)
+            moved += 1
+    session.commit()
+    return moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move inline party and candidate images into the image store")
+    parser.add_argument("host_url", nargs="?", default=IMAGE_BASE_URL,
+                        help="origin the API is served from, e.g. https://vote.example.com")
+    args = parser.parse_args()
+
+    session = sessionmaker(bind=engine)()
+    try:
+        print(f"{migrate(session, ImageStore(), args.host_url)} images moved to {IMAGE_DIR}")
+    finally:
+        session.close()
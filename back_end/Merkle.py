@@ -0,0 +1,294 @@
+import argparse
+import hashlib
+import struct
+import threading
+import time
+
+from decouple import config
+from sqlalchemy import and_, or_, insert
+from sqlalchemy.orm import sessionmaker
+
+from Background import run_periodically
+from Models import Votes, MerkleTree, MerkleNode, engine
+
+# Hashed as in RFC 9162 (Certificate Transparency), so any CT inclusion proof verifier can check a vote
+HASH_SIZE = 32
+EMPTY_ROOT = hashlib.sha256(b'').digest()
+AUDIT_CHUNK_SIZE = 10000
+MERKLE_APPEND_INTERVAL = config('MERKLE_APPEND_INTERVAL', default=1, cast=float)
+APPEND_BATCH_SIZE = 1000
+
+
+def hash_leaf(data):
+    return hashlib.sha256(b'\x00' + data).digest()
+
+
+def hash_node(left, right):
+    return hashlib.sha256(b'\x01' + left + right).digest()
+
+
+def vote_leaf(vote):
+    # Fixed width little endian fields, so the same vote always hashes the same
+    return hash_leaf(struct.pack('<qiqqbi', vote.vote_id, vote.election_id, vote.voter_id, vote.candidate_id,
+                                 vote.vote_type, vote.slot))
+
+
+def pack_frontier(frontier):
+    return b''.join(frontier)
+
+
+def unpack_frontier(data):
+    return [bytes(data[i:i + HASH_SIZE]) for i in range(0, len(data), HASH_SIZE)]
+
+
+def fold(hashes):
+    # The root of perfect subtrees that sit side by side, largest first
+    if not hashes:
+        return EMPTY_ROOT
+    root = hashes[-1]
+    for node in reversed(hashes[:-1]):
+        root = hash_node(node, root)
+    return root
+
+
+def append_leaf(size, frontier, leaf):
+    # Adds leaf number size to the frontier in place and returns the nodes it completes,
+    # as (level, position, hash). One hash per completed subtree, two per leaf on average.
+    nodes = [(0, size, leaf)]
+    node, level, position = leaf, 0, size
+    while (size >> level) & 1:
+        node = hash_node(frontier.pop(), node)
+        level += 1
+        position >>= 1
+        nodes.append((level, position, node))
+    frontier.append(node)
+    return nodes
+
+
+def new_tree(election_id, size=0):
+    return MerkleTree(election_id=election_id, size=size, frontier=b'', root=EMPTY_ROOT)
+
+
+def append_pending(session, election_id, batch_size=APPEND_BATCH_SIZE):
+    # Appends up to batch_size of the election's votes that are not in its tree yet, oldest
+    # first, and returns how many. Locking the head row first makes appenders in other
+    # workers take turns, votes themselves never wait for it.
+    head = session.query(MerkleTree).filter(MerkleTree.election_id == election_id).with_for_update().first()
+    if head is None:
+        # Elections get their head when they start, see Elections.start_election
+        head = new_tree(election_id)
+        session.add(head)
+    votes = session.query(Votes) \
+        .filter(Votes.election_id == election_id, Votes.leaf_index.is_(None)) \
+        .order_by(Votes.vote_id) \
+        .limit(batch_size).all()
+    if not votes:
+        return 0
+
+    size, frontier = head.size, unpack_frontier(head.frontier)
+    nodes = []
+    for vote in votes:
+        vote.leaf_index = size
+        nodes += append_leaf(size, frontier, vote_leaf(vote))
+        size += 1
+
+    session.execute(insert(MerkleNode), [{"election_id": election_id, "level": level, "position": position,
+                                          "hash": node} for level, position, node in nodes])
+    head.size, head.frontier, head.root = size, pack_frontier(frontier), fold(frontier)
+    return len(votes)
+
+
+class MerkleAppender:
+    # Adds committed votes to their election's tree in the background, so casting a
+    # vote never serialises on the tree. A vote's proof is available once it has run.
+
+    def __init__(self, session_factory, batch_size=APPEND_BATCH_SIZE):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self._stop = None
+
+    def append(self):
+        # Returns the number of votes appended
+        with self.lock:
+            session = self.session_factory()
+            try:
+                election_ids = [election_id for election_id, in session.query(Votes.election_id)
+                                .filter(Votes.leaf_index.is_(None)).distinct()]
+                appended = 0
+                for election_id in election_ids:
+                    while True:
+                        count = append_pending(session, election_id, self.batch_size)
+                        session.commit()
+                        appended += count
+                        if count < self.batch_size:
+                            break
+                return appended
+            finally:
+                session.close()
+
+    def start(self, interval=MERKLE_APPEND_INTERVAL):
+        if self._stop is None:
+            self._stop = run_periodically("merkle-appender", interval, self.append)
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+
+def range_peaks(start, end):
+    # The perfect subtrees covering leaves start up to end, largest first, as (level, position)
+    peaks = []
+    while start < end:
+        level = 0
+        while start % (2 << level) == 0 and start + (2 << level) <= end:
+            level += 1
+        peaks.append((level, start >> level))
+        start += 1 << level
+    return peaks
+
+
+def proof_coordinates(index, size):
+    # The RFC 9162 inclusion path of leaf index in a tree of size leaves. Each step is
+    # the list of stored subtrees that fold into it, the step nearest the leaf first.
+    steps = []
+    start = 0
+    while size > 1:
+        split = 1 << ((size - 1).bit_length() - 1)
+        if index < split:
+            steps.append(range_peaks(start + split, start + size))
+            size = split
+        else:
+            level = split.bit_length() - 1
+            steps.append([(level, start >> level)])
+            start, index, size = start + split, index - split, size - split
+    return list(reversed(steps))
+
+
+def load_nodes(session, election_id, coordinates):
+    if not coordinates:
+        return {}
+    rows = session.query(MerkleNode.level, MerkleNode.position, MerkleNode.hash) \
+        .filter(MerkleNode.election_id == election_id,
+                or_(*(and_(MerkleNode.level == level, MerkleNode.position == position)
+                      for level, position in coordinates)))
+    return {(level, position): bytes(node) for level, position, node in rows}
+
+
+def load_root(session, election_id):
+    head = session.query(MerkleTree.size, MerkleTree.root).filter(MerkleTree.election_id == election_id).first()
+    if head is None:
+        return {"election_id": election_id, "size": 0, "root": EMPTY_ROOT.hex()}
+    return {"election_id": election_id, "size": head.size, "root": bytes(head.root).hex()}
+
+
+def inclusion_proof(session, vote):
+    # O(log n) stored hashes prove the vote is in the election's published root
+    head = session.query(MerkleTree.size, MerkleTree.root) \
+        .filter(MerkleTree.election_id == vote.election_id).first()
+    if head is None or vote.leaf_index is None or vote.leaf_index >= head.size:
+        return None
+
+    steps = proof_coordinates(vote.leaf_index, head.size)
+    nodes = load_nodes(session, vote.election_id,
+                       {(0, vote.leaf_index)} | {coordinate for step in steps for coordinate in step})
+    return {"vote_id": vote.vote_id,
+            "election_id": vote.election_id,
+            "leaf_index": vote.leaf_index,
+            "leaf": nodes[(0, vote.leaf_index)].hex(),
+            "matches_vote": nodes[(0, vote.leaf_index)] == vote_leaf(vote),
+            "tree_size": head.size,
+            "root": bytes(head.root).hex(),
+            "path": [fold([nodes[coordinate] for coordinate in step]).hex() for step in steps]}
+
+
+def verify_inclusion(leaf, index, size, path, root):
+    # RFC 9162 section 2.1.3.2, what an auditor runs against a published root
+    if index >= size:
+        return False
+    fn, sn = index, size - 1
+    node = leaf
+    for sibling in path:
+        if sn == 0:
+            return False
+        if fn & 1 or fn == sn:
+            node = hash_node(sibling, node)
+            while fn and not fn & 1:
+                fn >>= 1
+                sn >>= 1
+        else:
+            node = hash_node(node, sibling)
+        fn >>= 1
+        sn >>= 1
+    return sn == 0 and node == root
+
+
+def audit(session, election_id, checkpoint=None, chunk_size=AUDIT_CHUNK_SIZE):
+    # Checks the leaves appended since checkpoint against the votes they were made from
+    # and the stored root, so a continuous audit only reads what is new. Returns the
+    # report and the checkpoint for the next run.
+    size, frontier = checkpoint or (0, [])
+    frontier = list(frontier)
+    head = session.query(MerkleTree.size, MerkleTree.root).filter(MerkleTree.election_id == election_id).first()
+    if head is None:
+        return {"election_id": election_id, "size": 0, "checked": 0, "mismatched": [], "missing": [],
+                "root_matches": True}, (size, frontier)
+
+    checked, mismatched, missing = 0, [], []
+    while size < head.size:
+        end = min(size + chunk_size, head.size)
+        leaves = dict(session.query(MerkleNode.position, MerkleNode.hash)
+                      .filter(MerkleNode.election_id == election_id, MerkleNode.level == 0,
+                              MerkleNode.position >= size, MerkleNode.position < end))
+        votes = {vote.leaf_index: vote for vote in session.query(Votes)
+                 .filter(Votes.election_id == election_id, Votes.leaf_index >= size, Votes.leaf_index < end)}
+        for index in range(size, end):
+            # A deleted leaf cannot be rebuilt, the root will not match from here on
+            leaf = bytes(leaves.get(index, b''))
+            vote = votes.get(index)
+            if vote is None:
+                missing.append(index)
+            elif vote_leaf(vote) != leaf:
+                mismatched.append(vote.vote_id)
+            append_leaf(index, frontier, leaf)
+            checked += 1
+        size = end
+
+    return {"election_id": election_id,
+            "size": head.size,
+            "checked": checked,
+            "mismatched": mismatched,
+            "missing": missing,
+            "root_matches": fold(frontier) == bytes(head.root)}, (size, frontier)
+
+
+def reset(session, election_id):
+    # Empties the tree along with the election's votes
+    session.query(MerkleNode).filter(MerkleNode.election_id == election_id).delete(synchronize_session=False)
+    session.query(MerkleTree).filter(MerkleTree.election_id == election_id) \
+        .update({MerkleTree.size: 0, MerkleTree.frontier: b'', MerkleTree.root: EMPTY_ROOT},
+                synchronize_session=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Audit an election's votes against its Merkle tree")
+    parser.add_argument("election_id", type=int)
+    parser.add_argument("--follow", type=float, metavar="SECONDS",
+                        help="keep auditing new votes at this interval")
+    args = parser.parse_args()
+
+    session_factory = sessionmaker(bind=engine)
+    checkpoint = None
+    while True:
+        session = session_factory()
+        try:
+            report, checkpoint = audit(session, args.election_id, checkpoint)
+        finally:
+            session.close()
+        print(f"{report['checked']} of {report['size']} votes checked, root "
+              f"{'matches' if report['root_matches'] else 'DOES NOT MATCH'}, "
+              f"{len(report['mismatched'])} altered, {len(report['missing'])} deleted")
+        if args.follow is None:
+            break
+        time.sleep(args.follow)
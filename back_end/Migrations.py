@@ -0,0 +1,216 @@
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, insert, select, update, \
+    bindparam, text
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateColumn
+
+import Merkle
+import Turnout
+from Elections import ELECTION_NAME
+from Models import Base, Election, Votes, Verification, MerkleTree, IdempotencyKey, engine
+
+# Brings a database created from the original models up to the current ones. Every step
+# checks what is already there, so running it again, or on a new database, changes nothing.
+
+
+def table_columns(connection, table):
+    return {column['name'] for column in inspect(connection).get_columns(table)}
+
+
+def quote(connection, name):
+    return connection.dialect.identifier_preparer.quote(name)
+
+
+def add_column(connection, table, column):
+    # Only NOT NULL and a server default are added with the column, which SQLite accepts too
+    Table(table, MetaData(), column)
+    connection.execute(text(f"ALTER TABLE {quote(connection, table)} "
+                            f"ADD {CreateColumn(column).compile(dialect=connection.dialect)}"))
+
+
+def has_unique(connection, table, columns):
+    inspector = inspect(connection)
+    return any(set(constraint['column_names']) == set(columns)
+               for constraint in inspector.get_unique_constraints(table)) or \
+        any(index['unique'] and set(index['column_names']) == set(columns)
+            for index in inspector.get_indexes(table))
+
+
+def create_tables(connection):
+    # Tables that did not exist before, existing tables are left alone
+    existing = set(inspect(connection).get_table_names())
+    missing = [table for name, table in Base.metadata.tables.items() if name not in existing]
+    Base.metadata.create_all(connection, tables=missing)
+    return bool(missing)
+
+
+def expire_verifications(connection):
+    # Only pending OTPs live here, they are dropped rather than given an expiry and voters ask for a new one
+    if 'expires_at' in table_columns(connection, 'Verification'):
+        return False
+    Verification.__table__.drop(connection)
+    Verification.__table__.create(connection)
+    return True
+
+
+def add_voted_in(connection):
+    if 'voted_in' in table_columns(connection, 'Voter'):
+        return False
+    # Filled in with the turnout when the first election is opened
+    add_column(connection, 'Voter', Column('voted_in', Integer, nullable=True))
+    return True
+
+
+def add_vote_columns(connection):
+    existing = table_columns(connection, 'Votes')
+    if {'election_id', 'slot', 'leaf_index'} <= existing:
+        return False
+
+    if 'election_id' not in existing:
+        # Nullable until the votes are moved into the first election
+        add_column(connection, 'Votes', Column('election_id', Integer, nullable=True))
+    if 'leaf_index' not in existing:
+        # Votes cast so far are added to the tree by Merkle.MerkleAppender
+        add_column(connection, 'Votes', Column('leaf_index', Integer, nullable=True))
+    if 'slot' not in existing:
+        add_column(connection, 'Votes', Column('slot', Integer, nullable=False, server_default='0'))
+        # Numbered in the order the votes were cast, a voter over the limit keeps the extra votes
+        votes = Votes.__table__
+        next_slot, slots = {}, []
+        for vote_id, voter_id, vote_type in connection.execute(
+                select(votes.c.vote_id, votes.c.voter_id, votes.c.vote_type).order_by(votes.c.vote_id)):
+            slot = next_slot.get((voter_id, vote_type), 0)
+            next_slot[(voter_id, vote_type)] = slot + 1
+            if slot:
+                slots.append({"b_vote_id": vote_id, "b_slot": slot})
+        if slots:
+            connection.execute(update(votes).where(votes.c.vote_id == bindparam('b_vote_id'))
+                               .values(slot=bindparam('b_slot')), slots)
+    return True
+
+
+def open_first_election(connection):
+    # Votes cast before elections existed belong to the first one. Unlike Elections.start_election
+    # the candidates keep their counts, they are that election's tallies.
+    election_id = connection.execute(select(Election.election_id).order_by(Election.election_id.desc())
+                                     .limit(1)).scalar()
+    changed = False
+    if election_id is None:
+        election_id = connection.execute(insert(Election).values(name=ELECTION_NAME, started_at=datetime.utcnow())) \
+            .inserted_primary_key[0]
+        connection.execute(insert(MerkleTree).values(election_id=election_id, size=0, frontier=b'',
+                                                     root=Merkle.EMPTY_ROOT))
+        changed = True
+
+    moved = connection.execute(update(Votes.__table__).where(Votes.__table__.c.election_id.is_(None))
+                               .values(election_id=election_id)).rowcount
+    if changed or moved:
+        session = Session(bind=connection)
+        Turnout.rebuild(session, election_id)
+        session.flush()
+        session.close()
+    return changed or bool(moved)
+
+
+def add_notification_leases(connection):
+    existing = table_columns(connection, 'NotificationJob')
+    if {'lease_owner', 'lease_expires_at'} <= existing:
+        return False
+    # Jobs left running by an older process have no lease, the first worker to poll picks them up
+    if 'lease_owner' not in existing:
+        add_column(connection, 'NotificationJob', Column('lease_owner', String(64), nullable=True))
+    if 'lease_expires_at' not in existing:
+        add_column(connection, 'NotificationJob', Column('lease_expires_at', DateTime, nullable=True))
+    return True
+
+
+def add_token_version(connection):
+    if 'token_version' in table_columns(connection, 'Voter'):
+        return False
+    add_column(connection, 'Voter', Column('token_version', Integer, nullable=False, server_default='0'))
+    return True
+
+
+def add_request_hash(connection):
+    if 'request_hash' in table_columns(connection, 'IdempotencyKey'):
+        return False
+    # Keys stored before this match any retry until they expire
+    add_column(connection, 'IdempotencyKey', Column('request_hash', String(64), nullable=True))
+    return True
+
+
+def add_journal_id(connection):
+    if 'journal_id' in table_columns(connection, 'IdempotencyKey'):
+        return False
+    add_column(connection, 'IdempotencyKey', Column('journal_id', String(32), nullable=True))
+    next(index for index in IdempotencyKey.__table__.indexes
+         if index.name == 'ix_IdempotencyKey_journal_id').create(connection)
+    return True
+
+
+def add_vote_slot_index(connection):
+    columns = ['election_id', 'voter_id', 'vote_type', 'slot']
+    if has_unique(connection, 'Votes', columns):
+        return False
+    connection.execute(text(f"CREATE UNIQUE INDEX uq_Votes_election_voter_type_slot ON {quote(connection, 'Votes')} "
+                            f"({', '.join(quote(connection, column) for column in columns)})"))
+    return True
+
+
+def add_constraints(connection):
+    # SQLite cannot alter a column or add a foreign key to an existing table, the app always sets them
+    if connection.dialect.name == 'sqlite':
+        return False
+
+    changed = False
+    votes = {column['name']: column for column in inspect(connection).get_columns('Votes')}
+    if votes['election_id']['nullable']:
+        if connection.dialect.name == 'mssql':
+            connection.execute(text("ALTER TABLE [Votes] ALTER COLUMN [election_id] INTEGER NOT NULL"))
+        else:
+            connection.execute(text(f"ALTER TABLE {quote(connection, 'Votes')} ALTER COLUMN election_id SET NOT NULL"))
+        changed = True
+
+    for table, column in (('Votes', 'election_id'), ('Voter', 'voted_in')):
+        if any(key['constrained_columns'] == [column] for key in inspect(connection).get_foreign_keys(table)):
+            continue
+        connection.execute(text(f"ALTER TABLE {quote(connection, table)} ADD CONSTRAINT fk_{table}_{column} "
+                                f"FOREIGN KEY ({quote(connection, column)}) REFERENCES {quote(connection, 'Election')} "
+                                f"({quote(connection, 'election_id')})"))
+        changed = True
+    return changed
+
+
+# In order, later steps rely on the earlier ones
+MIGRATIONS = [
+    ("create new tables", create_tables),
+    ("give pending OTPs an expiry", expire_verifications),
+    ("add Voter.voted_in", add_voted_in),
+    ("add Votes.election_id, slot and leaf_index", add_vote_columns),
+    ("open the first election and move existing votes into it", open_first_election),
+    # SQL Server cannot alter a column once an index uses it
+    ("add NOT NULL and foreign key constraints", add_constraints),
+    ("make vote slots unique", add_vote_slot_index),
+    ("add NotificationJob leases", add_notification_leases),
+    ("add Voter.token_version", add_token_version),
+    ("add IdempotencyKey.request_hash", add_request_hash),
+    ("add IdempotencyKey.journal_id", add_journal_id),
+]
+
+
+def migrate(engine):
+    # Each step commits on its own, returns the names of the steps that changed something
+    applied = []
+    for name, step in MIGRATIONS:
+        with engine.begin() as connection:
+            if step(connection):
+                applied.append(name)
+    return applied
+
+
+if __name__ == "__main__":
+    applied = migrate(engine)
+    for name in applied:
+        print(f"Applied: {name}")
+    print(f"{len(applied)} of {len(MIGRATIONS)} migrations applied")
@@ -1,12 +1,39 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, create_engine, Boolean
+from sqlalchemy import Column, Integer, String, ForeignKey, create_engine, Boolean, DateTime, UniqueConstraint, \
+    LargeBinary, event, Index
 from enum import Enum
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, Session
+from sqlalchemy.orm import relationship, deferred, Session
+
+from decouple import config
 
 from DBConfig import DBConfig
 
-# Create the engine
-engine = create_engine(DBConfig().get_conn_string())
+# Seconds to wait for a pooled connection, to open a new one and for a statement to finish,
+# so a slow database fails requests quickly instead of holding every worker thread
+DB_POOL_TIMEOUT = config('DB_POOL_TIMEOUT', default=5, cast=int)
+DB_CONNECT_TIMEOUT = config('DB_CONNECT_TIMEOUT', default=10, cast=int)
+DB_QUERY_TIMEOUT = config('DB_QUERY_TIMEOUT', default=10, cast=int)
+
+
+def connect_args(url):
+    # pyodbc and aioodbc both take the login timeout as timeout
+    return {'timeout': DB_CONNECT_TIMEOUT} if url.startswith('mssql') else {}
+
+
+# Create the engine, DATABASE_URL overrides the Azure connection for other environments
+database_url = config('DATABASE_URL', default='') or DBConfig().get_conn_string()
+engine = create_engine(database_url,
+                       pool_size=config('DB_POOL_SIZE', default=5, cast=int),
+                       max_overflow=config('DB_MAX_OVERFLOW', default=10, cast=int),
+                       pool_timeout=DB_POOL_TIMEOUT,
+                       pool_pre_ping=True,
+                       connect_args=connect_args(database_url))
+
+if engine.dialect.name == 'mssql':
+    @event.listens_for(engine, 'connect')
+    def set_query_timeout(dbapi_connection, connection_record):
+        # pyodbc cancels any statement still running after this many seconds
+        dbapi_connection.timeout = DB_QUERY_TIMEOUT
 
 # Create a base class for the model
 Base = declarative_base()
@@ -23,6 +50,11 @@ class Voter(Base):
     constituency_id = Column(Integer, ForeignKey('Constituency.constituency_id'), nullable=False)
     email = Column(String, unique=True, nullable=False)
     isAdmin = Column(Boolean, default=False)
+    # Copied into every token at login, Helpers.expire_token_claims bumps it so older tokens are not trusted
+    token_version = Column(Integer, nullable=False, default=0, server_default='0')
+    # The last election the voter cast a vote or ballot in, see Turnout.record_vote.
+    # Compared with the active election, so a new election never has to reset it.
+    voted_in = Column(Integer, ForeignKey('Election.election_id'), nullable=True)
 
     votes = relationship("Votes", back_populates="voter")
 
@@ -34,12 +66,35 @@ class Constituency(Base):
     constituency_name = Column(String)
 
 
+class Election(Base):
+    __tablename__ = 'Election'
+
+    election_id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    started_at = Column(DateTime, nullable=False)
+    # Set when the election closes, at most one election is open at a time
+    closed_at = Column(DateTime, nullable=True, index=True)
+
+
+class Turnout(Base):
+    __tablename__ = 'Turnout'
+
+    # Kept up to date as voters register and cast their first vote, so turnout
+    # never needs a join across Voter and Votes
+    election_id = Column(Integer, ForeignKey('Election.election_id'), primary_key=True)
+    constituency_id = Column(Integer, ForeignKey('Constituency.constituency_id'), primary_key=True)
+    registered = Column(Integer, nullable=False, default=0)
+    voted = Column(Integer, nullable=False, default=0)
+
+
 class Verification(Base):
     __tablename__ = 'Verification'
 
     id = Column(Integer, primary_key=True)
     email = Column(String, unique=True, nullable=False)
-    otp = Column(String, unique=True, nullable=False)
+    otp = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    attempts = Column(Integer, nullable=False, default=0)
 
 
 class Party(Base):
@@ -48,7 +103,8 @@ class Party(Base):
     party_id = Column(Integer, primary_key=True)
     party_name = Column(String, unique=True, nullable=False)
     image = Column(String, unique=False, nullable=False)
-    manifesto = Column(String, unique=False, nullable=False)
+    # Long text is only loaded when asked for, list queries never read it
+    manifesto = deferred(Column(String, unique=False, nullable=False))
 
 
 class Candidate(Base):
@@ -61,13 +117,25 @@ class Candidate(Base):
     vote_count = Column(Integer, unique=False, nullable=True)
     image = Column(String, unique=False, nullable=False)
     constituency_id = Column(Integer, ForeignKey('Constituency.constituency_id'), nullable=False)
-    statement = Column(String, unique=False, nullable=False)
+    statement = deferred(Column(String, unique=False, nullable=False))
 
     party = relationship("Party")
     constituency = relationship("Constituency")
     votes = relationship("Votes", back_populates="candidate")
 
 
+class Candidacy(Base):
+    __tablename__ = 'Candidacy'
+
+    # A candidate's standing and final tally in a closed election. The open election
+    # counts in Candidate.vote_count, these rows are written once when it closes.
+    election_id = Column(Integer, ForeignKey('Election.election_id'), primary_key=True)
+    candidate_id = Column(Integer, ForeignKey('Candidate.candidate_id'), primary_key=True)
+    party_id = Column(Integer, ForeignKey('Party.party_id'), nullable=False)
+    constituency_id = Column(Integer, ForeignKey('Constituency.constituency_id'), nullable=False)
+    vote_count = Column(Integer, nullable=False, default=0)
+
+
 class VoteType(Enum):
     POSITIVE = 1
     NEGATIVE = -1
@@ -75,11 +143,127 @@ class VoteType(Enum):
 
 class Votes(Base):
     __tablename__ = 'Votes'
+    # Each vote takes one numbered slot per election, voter and vote type, so the database
+    # rejects any vote beyond the limit even when requests race each other. The index
+    # leads with election_id so the open election's votes sit together.
+    __table_args__ = (UniqueConstraint('election_id', 'voter_id', 'vote_type', 'slot'),)
 
     vote_id = Column(Integer, primary_key=True)
+    election_id = Column(Integer, ForeignKey('Election.election_id'), nullable=False)
     voter_id = Column(Integer, ForeignKey('Voter.voter_id'), nullable=False)
     candidate_id = Column(Integer, ForeignKey('Candidate.candidate_id'), nullable=False)
     vote_type = Column(Integer, nullable=False)
+    slot = Column(Integer, nullable=False, default=0)
+    # Position of the vote's leaf in its election's MerkleTree, None until Merkle.MerkleAppender adds it
+    leaf_index = Column(Integer, nullable=True)
 
     voter = relationship("Voter", back_populates="votes")
     candidate = relationship("Candidate", back_populates="votes")
+
+
+class RankedBallot(Base):
+    __tablename__ = 'RankedBallot'
+    # One ballot per voter in each election
+    __table_args__ = (UniqueConstraint('election_id', 'voter_id'),
+                      Index('ix_RankedBallot_election_constituency', 'election_id', 'constituency_id'))
+
+    ballot_id = Column(Integer, primary_key=True)
+    election_id = Column(Integer, ForeignKey('Election.election_id'), nullable=False)
+    voter_id = Column(Integer, ForeignKey('Voter.voter_id'), nullable=False)
+    constituency_id = Column(Integer, ForeignKey('Constituency.constituency_id'), nullable=False)
+    # Candidate ids in order of preference, packed by Counting.pack_preferences
+    preferences = Column(LargeBinary, nullable=False)
+
+
+class MerkleTree(Base):
+    __tablename__ = 'MerkleTree'
+
+    # The head of an election's append only tree of votes. frontier holds the root
+    # hash of each perfect subtree on the right edge, largest first, which is all
+    # an append needs to read.
+    election_id = Column(Integer, ForeignKey('Election.election_id'), primary_key=True)
+    size = Column(Integer, nullable=False, default=0)
+    frontier = Column(LargeBinary, nullable=False, default=b'')
+    root = Column(LargeBinary(32), nullable=False)
+
+
+class MerkleNode(Base):
+    __tablename__ = 'MerkleNode'
+
+    # Leaves are level 0, a node at level k covers leaves position * 2^k up to (position + 1) * 2^k.
+    # Only complete subtrees are stored, about two rows per vote.
+    election_id = Column(Integer, ForeignKey('Election.election_id'), primary_key=True)
+    level = Column(Integer, primary_key=True)
+    position = Column(Integer, primary_key=True)
+    hash = Column(LargeBinary(32), nullable=False)
+
+
+class IdempotencyKey(Base):
+    __tablename__ = 'IdempotencyKey'
+    __table_args__ = (UniqueConstraint('voter_id', 'key'),)
+
+    id = Column(Integer, primary_key=True)
+    voter_id = Column(Integer, nullable=False)
+    key = Column(String(64), nullable=False)
+    vote_id = Column(Integer, nullable=False)
+    # sha256 of the request body, a different request under the same key is refused
+    request_hash = Column(String(64), nullable=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    # The journal entry the vote was replayed from, so a voter holding a journal_id can look it up
+    journal_id = Column(String(32), nullable=True, index=True)
+
+
+class RejectedVote(Base):
+    __tablename__ = 'RejectedVote'
+
+    # A journaled vote the replayer could not write, because the voter had already used
+    # every slot or the election closed first
+    journal_id = Column(String(32), primary_key=True)
+    voter_id = Column(Integer, nullable=False, index=True)
+    election_id = Column(Integer, nullable=False)
+    candidate_id = Column(Integer, nullable=False)
+    vote_type = Column(Integer, nullable=False)
+    reason = Column(String(255), nullable=False)
+    rejected_at = Column(DateTime, nullable=False)
+
+
+class TallySnapshot(Base):
+    __tablename__ = 'TallySnapshot'
+    __table_args__ = (Index('ix_TallySnapshot_election_taken_at', 'election_id', 'taken_at'),)
+
+    snapshot_id = Column(Integer, primary_key=True)
+    election_id = Column(Integer, ForeignKey('Election.election_id'), nullable=False)
+    taken_at = Column(DateTime, nullable=False)
+    total_votes = Column(Integer, nullable=False)
+    # Every candidate's vote_count, packed by Snapshots.pack_tallies
+    tallies = Column(LargeBinary, nullable=False)
+
+
+class ReplicaHeartbeat(Base):
+    __tablename__ = 'ReplicaHeartbeat'
+
+    # A single row the primary updates every few seconds, a replica is as far
+    # behind as its copy of beat_at is old
+    id = Column(Integer, primary_key=True)
+    beat_at = Column(DateTime, nullable=False)
+
+
+class NotificationJob(Base):
+    __tablename__ = 'NotificationJob'
+
+    job_id = Column(Integer, primary_key=True)
+    subject = Column(String, nullable=False)
+    body = Column(String, nullable=False)
+    constituency_id = Column(Integer, ForeignKey('Constituency.constituency_id'), nullable=True)
+    # queued, running, pausing, paused, failed or done. pausing asks the worker holding the job to stop.
+    status = Column(String(16), nullable=False)
+    total = Column(Integer, nullable=False, default=0)
+    # Every voter up to last_voter_id has been sent the message or counted as failed
+    last_voter_id = Column(Integer, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+    # The worker sending the job and when its claim runs out unless it saves progress again
+    lease_owner = Column(String(64), nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
@@ -0,0 +1,413 @@
+import argparse
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from string import Template
+
+from decouple import config
+from sqlalchemy import select, update, or_
+from sqlalchemy.orm import sessionmaker
+
+from Background import run_periodically
+from CircuitBreaker import CircuitBreaker, CircuitOpen
+from Models import Voter, Constituency, NotificationJob, engine
+from RateLimiter import create_bucket_store
+
+NOTIFY_TRANSPORT = config('NOTIFY_TRANSPORT', default='gmail')
+NOTIFY_WORKERS = config('NOTIFY_WORKERS', default=8, cast=int)
+# Messages per second, shared by every worker on the host when RATE_LIMIT_STORE is set and per
+# process without it. Gmail allows far fewer than a mail service would.
+NOTIFY_RATE = config('NOTIFY_RATE', default=10, cast=float)
+NOTIFY_CHUNK_SIZE = config('NOTIFY_CHUNK_SIZE', default=500, cast=int)
+NOTIFY_RETRIES = 3
+# Seconds a worker holds a job without saving progress, longer than one chunk takes at NOTIFY_RATE
+NOTIFY_LEASE_SECONDS = config('NOTIFY_LEASE_SECONDS', default=300, cast=int)
+# Seconds between looks for queued jobs and jobs whose worker stopped
+NOTIFY_POLL_INTERVAL = config('NOTIFY_POLL_INTERVAL', default=30, cast=int)
+
+# Subject and body of each announcement, $first_name, $last_name and $constituency_name are filled in per voter
+TEMPLATES = {
+    'polls-open': ("Polls are now open",
+                   "Hello $first_name,\n\nPolls are now open for $constituency_name. "
+                   "Log in with your Government ID to cast your votes.\n"),
+    'polls-closing': ("Polls close soon",
+                      "Hello $first_name,\n\nPolls for $constituency_name close soon. "
+                      "If you have not voted yet, log in with your Government ID to cast your votes.\n"),
+    'results-published': ("Election results published",
+                          "Hello $first_name,\n\nThe results for $constituency_name have been published. "
+                          "Log in to see them.\n")
+}
+
+
+class SinkTransport:
+    # Accepts every message without sending it, latency stands in for the time a real mail API takes
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    def send(self, destination, subject, body):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.sent += 1
+
+
+class GmailTransport:
+    # The Gmail client is not thread safe, so every sending thread builds its own from
+    # credentials loaded once per process. Bulk sends have their own breaker so hitting
+    # a quota never blocks OTP emails.
+
+    def __init__(self):
+        import GoogleAPI
+        self.google = GoogleAPI
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.credentials = None
+        self.breaker = CircuitBreaker('gmail-notifications')
+
+    def load_credentials(self):
+        # Every pool thread starts at once, only the first reads and refreshes token.pickle
+        with self.lock:
+            if self.credentials is None:
+                self.credentials = self.google.gmail_credentials()
+            return self.credentials
+
+    def send(self, destination, subject, body):
+        with self.breaker:
+            service = getattr(self.local, 'service', None)
+            if service is None:
+                service = self.local.service = self.google.gmail_service(self.load_credentials())
+            self.google.send_message(service, destination, subject, body)
+
+
+def create_transport(kind=NOTIFY_TRANSPORT):
+    if kind == 'gmail':
+        return GmailTransport()
+    if kind == 'sink':
+        return SinkTransport()
+    raise ValueError(f"Unknown notification transport: {kind}")
+
+
+def recipients_query(session, constituency_id=None):
+    query = session.query(Voter.voter_id, Voter.email, Voter.first_name, Voter.last_name,
+                          Constituency.constituency_name) \
+        .join(Constituency, Voter.constituency_id == Constituency.constituency_id)
+    if constituency_id is not None:
+        query = query.filter(Voter.constituency_id == constituency_id)
+    return query
+
+
+def iter_recipients(session, after=0, constituency_id=None, chunk_size=NOTIFY_CHUNK_SIZE):
+    # Pages through voters on voter_id, so only one chunk is ever held in memory
+    query = recipients_query(session, constituency_id)
+    while True:
+        chunk = query.filter(Voter.voter_id > after).order_by(Voter.voter_id).limit(chunk_size).all()
+        if not chunk:
+            return
+        yield chunk
+        after = chunk[-1].voter_id
+
+
+class NotificationSender:
+    # Sends a job's message to every matching voter through a pool of threads that
+    # share one rate limit. Progress is saved after each chunk of voters, a job
+    # that is paused or interrupted resumes from the last saved chunk, so at most
+    # one chunk can be sent twice.
+    # The job's state lives in its row, so any worker process can pause or resume it.
+    # A worker claims a job by taking its lease and renews the lease each time it saves
+    # progress, once a lease runs out the next worker to poll carries the job on.
+
+    def __init__(self, session_factory, transport, workers=NOTIFY_WORKERS, rate=NOTIFY_RATE,
+                 chunk_size=NOTIFY_CHUNK_SIZE, lease_seconds=NOTIFY_LEASE_SECONDS, limiter=None):
+        self.session_factory = session_factory
+        self.transport = transport
+        self.workers = workers
+        self.rate = rate
+        self.chunk_size = chunk_size
+        self.lease_seconds = lease_seconds
+        self.instance = uuid.uuid4().hex[:8]
+        self.limiter = limiter or create_bucket_store()
+        self.lock = threading.Lock()
+        self._stop_poller = None
+        # Messages handed to the pool that have not been sent or given up on yet
+        self.backlog = 0
+
+    @property
+    def owner(self):
+        # Read at every claim, workers forked from one process each hold their own leases
+        return f"{self.instance}:{os.getpid()}:{socket.gethostname()}"[:64]
+
+    def create_job(self, session, subject, body, constituency_id=None):
+        now = datetime.utcnow()
+        job = NotificationJob(subject=subject, body=body, constituency_id=constituency_id, status='queued',
+                              total=recipients_query(session, constituency_id).count(),
+                              last_voter_id=0, sent=0, failed=0, created_at=now, updated_at=now)
+        session.add(job)
+        session.commit()
+        return job
+
+    def throttle(self):
+        capacity = max(self.rate, 1)
+        while True:
+            allowed, wait = self.limiter.take('notifications', capacity, capacity / self.rate)
+            if allowed:
+                return
+            time.sleep(wait)
+
+    def deliver(self, recipient, subject, body):
+        try:
+            return self.send(recipient, subject, body)
+        finally:
+            with self.lock:
+                self.backlog -= 1
+
+    def send(self, recipient, subject, body):
+        values = {'first_name': recipient.first_name, 'last_name': recipient.last_name,
+                  'constituency_name': recipient.constituency_name}
+        for attempt in range(NOTIFY_RETRIES):
+            self.throttle()
+            try:
+                self.transport.send(recipient.email, subject.safe_substitute(values), body.safe_substitute(values))
+                return True
+            except CircuitOpen as e:
+                # Waits for the transport to recover rather than failing every remaining voter at once
+                time.sleep(e.retry_after)
+            except Exception as e:
+                print(f"An error occurred sending to voter {recipient.voter_id}: {e}")
+                time.sleep(0.5 * 2 ** attempt)
+        return False
+
+    def claim(self, session, job_id):
+        # Only one worker wins a job, a lease that is still running is never taken over
+        now = datetime.utcnow()
+        claimed = session.execute(
+            update(NotificationJob)
+            .where(NotificationJob.job_id == job_id, NotificationJob.status.in_(('queued', 'running')),
+                   or_(NotificationJob.lease_expires_at.is_(None), NotificationJob.lease_expires_at < now))
+            .values(status='running', lease_owner=self.owner,
+                    lease_expires_at=now + timedelta(seconds=self.lease_seconds), updated_at=now)).rowcount
+        session.commit()
+        return claimed == 1
+
+    def save_progress(self, session, job_id, sent, failed, last_voter_id):
+        # Returns the job's status, or None once another worker has taken over the job
+        now = datetime.utcnow()
+        saved = session.execute(
+            update(NotificationJob)
+            .where(NotificationJob.job_id == job_id, NotificationJob.lease_owner == self.owner)
+            .values(sent=NotificationJob.sent + sent, failed=NotificationJob.failed + failed,
+                    last_voter_id=last_voter_id, updated_at=now,
+                    lease_expires_at=now + timedelta(seconds=self.lease_seconds))).rowcount
+        session.commit()
+        if not saved:
+            return None
+        return session.execute(select(NotificationJob.status).filter_by(job_id=job_id)).scalar()
+
+    def renew(self, session, job_id):
+        # Keeps the lease while a chunk is still sending, False once another worker has taken over
+        now = datetime.utcnow()
+        renewed = session.execute(
+            update(NotificationJob)
+            .where(NotificationJob.job_id == job_id, NotificationJob.lease_owner == self.owner)
+            .values(lease_expires_at=now + timedelta(seconds=self.lease_seconds), updated_at=now)).rowcount
+        session.commit()
+        return renewed == 1
+
+    def wait_for_chunk(self, session, job_id, futures):
+        # A chunk can outlast the lease, when the mail breaker is open the senders wait for it to close
+        while wait(futures, timeout=self.lease_seconds / 3).not_done:
+            try:
+                self.renew(session, job_id)
+            except Exception as e:
+                session.rollback()
+                print(f"An error occurred renewing the lease on notification job {job_id}: {e}")
+        return [future.result() for future in futures]
+
+    def release(self, session, job_id, status):
+        session.execute(update(NotificationJob)
+                        .where(NotificationJob.job_id == job_id, NotificationJob.lease_owner == self.owner)
+                        .values(status=status, lease_owner=None, lease_expires_at=None,
+                                updated_at=datetime.utcnow()))
+        session.commit()
+        return session.execute(select(NotificationJob.status).filter_by(job_id=job_id)).scalar()
+
+    def run(self, job_id, stop=None):
+        # Sends the job on this thread, None if another worker holds it
+        session = self.session_factory()
+        try:
+            claimed = self.claim(session, job_id)
+        finally:
+            session.close()
+        return self.work(job_id, stop) if claimed else None
+
+    def work(self, job_id, stop=None):
+        session = self.session_factory()
+        try:
+            job = session.get(NotificationJob, job_id)
+            # Templates are parsed once per job, not once per voter
+            subject, body = Template(job.subject), Template(job.body)
+            status = 'running'
+            try:
+                with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="notify") as pool:
+                    for chunk in iter_recipients(session, job.last_voter_id, job.constituency_id, self.chunk_size):
+                        if stop is not None and stop.is_set():
+                            status = 'paused'
+                            break
+                        with self.lock:
+                            self.backlog += len(chunk)
+                        futures = [pool.submit(self.deliver, recipient, subject, body) for recipient in chunk]
+                        delivered = self.wait_for_chunk(session, job_id, futures)
+                        status = self.save_progress(session, job_id, sum(delivered),
+                                                    len(delivered) - sum(delivered), chunk[-1].voter_id)
+                        if status != 'running':
+                            break
+            except Exception:
+                session.rollback()
+                status = 'failed'
+                raise
+            finally:
+                # Nothing is written once the lease has been lost, the worker holding it now owns the row
+                if status is not None:
+                    status = self.release(session, job_id, {'running': 'done', 'pausing': 'paused'}.get(status, status))
+            return status
+        finally:
+            session.close()
+
+    def start(self, job_id):
+        # Claims the job and sends it on a background thread, False if another worker holds it
+        session = self.session_factory()
+        try:
+            if not self.claim(session, job_id):
+                return False
+        finally:
+            session.close()
+
+        def run():
+            try:
+                self.work(job_id)
+            except Exception as e:
+                print(f"An error occurred in notification job {job_id}: {e}")
+
+        threading.Thread(target=run, name=f"notification-job-{job_id}", daemon=True).start()
+        return True
+
+    def pause(self, session, job_id):
+        # A queued job is paused straight away, a running one once its worker finishes the chunk it is on
+        now = datetime.utcnow()
+        for status, paused in (('queued', 'paused'), ('running', 'pausing')):
+            if session.execute(update(NotificationJob)
+                               .where(NotificationJob.job_id == job_id, NotificationJob.status == status)
+                               .values(status=paused, updated_at=now)).rowcount:
+                session.commit()
+                return True
+        return False
+
+    def requeue(self, session, job_id):
+        # Puts a paused or failed job back in the queue, and a pausing one whose worker stopped
+        queued = session.execute(update(NotificationJob)
+                                 .where(NotificationJob.job_id == job_id,
+                                        NotificationJob.status.in_(('pausing', 'paused', 'failed')))
+                                 .values(status='queued', lease_owner=None, lease_expires_at=None,
+                                         updated_at=datetime.utcnow())).rowcount
+        session.commit()
+        return queued == 1
+
+    def resume(self, session, job_id):
+        # A job that has not stopped yet just carries on, otherwise it is queued and claimed here if no
+        # other worker gets to it first. Also restarts a job left running by a worker that stopped.
+        now = datetime.utcnow()
+        if session.execute(update(NotificationJob)
+                           .where(NotificationJob.job_id == job_id, NotificationJob.status == 'pausing',
+                                  NotificationJob.lease_expires_at >= now)
+                           .values(status='running', updated_at=now)).rowcount:
+            session.commit()
+            return True
+        queued = self.requeue(session, job_id)
+        return self.start(job_id) or queued
+
+    def poll(self):
+        # Claims queued jobs and jobs whose worker stopped without releasing them
+        session = self.session_factory()
+        try:
+            now = datetime.utcnow()
+            expired = or_(NotificationJob.lease_expires_at.is_(None), NotificationJob.lease_expires_at < now)
+            session.execute(update(NotificationJob)
+                            .where(NotificationJob.status == 'pausing', expired)
+                            .values(status='paused', lease_owner=None, lease_expires_at=None, updated_at=now))
+            session.commit()
+            job_ids = session.execute(select(NotificationJob.job_id)
+                                      .where(NotificationJob.status.in_(('queued', 'running')), expired)) \
+                .scalars().all()
+        finally:
+            session.close()
+        return [job_id for job_id in job_ids if self.start(job_id)]
+
+    def start_poller(self, interval=NOTIFY_POLL_INTERVAL):
+        if self._stop_poller is None:
+            self._stop_poller = run_periodically("notification-poller", interval, self.poll)
+
+    def stop_poller(self):
+        if self._stop_poller is not None:
+            self._stop_poller.set()
+            self._stop_poller = None
+
+
+def job_to_dict(job):
+    return {
+        "job_id": job.job_id,
+        "subject": job.subject,
+        "constituency_id": job.constituency_id,
+        "status": job.status,
+        "total": job.total,
+        "sent": job.sent,
+        "failed": job.failed,
+        "last_voter_id": job.last_voter_id,
+        "created_at": job.created_at.isoformat(),
+        "updated_at": job.updated_at.isoformat()
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send an announcement to every registered voter")
+    parser.add_argument("template", nargs="?", choices=sorted(TEMPLATES))
+    parser.add_argument("--resume", type=int, metavar="JOB_ID", help="carry on with an interrupted job")
+    parser.add_argument("--constituency", type=int)
+    parser.add_argument("--transport", choices=["gmail", "sink"], default=NOTIFY_TRANSPORT)
+    parser.add_argument("--workers", type=int, default=NOTIFY_WORKERS)
+    parser.add_argument("--rate", type=float, default=NOTIFY_RATE)
+    args = parser.parse_args()
+    if args.template is None and args.resume is None:
+        parser.error("a template or --resume is required")
+
+    session_factory = sessionmaker(bind=engine)
+    sender = NotificationSender(session_factory, create_transport(args.transport), args.workers, args.rate)
+
+    job_id = args.resume
+    session = session_factory()
+    try:
+        if job_id is None:
+            job_id = sender.create_job(session, *TEMPLATES[args.template], args.constituency).job_id
+        else:
+            sender.requeue(session, job_id)
+    finally:
+        session.close()
+
+    started = time.perf_counter()
+    status = sender.run(job_id)
+    elapsed = time.perf_counter() - started
+    if status is None:
+        parser.exit(1, f"Job {job_id} is being sent by another worker or is not queued\n")
+
+    session = session_factory()
+    try:
+        job = session.get(NotificationJob, job_id)
+        print(f"Job {job_id} {status}: {job.sent} sent, {job.failed} failed of {job.total} "
+              f"in {elapsed:.1f}s ({job.sent / elapsed:.0f} per second)")
+    finally:
+        session.close()
@@ -0,0 +1,161 @@
+import hmac
+import threading
+import time
+from datetime import datetime, timedelta
+
+from decouple import config
+
+from Background import run_periodically
+from Models import Verification
+
+OTP_STORE = config('OTP_STORE', default='database')
+OTP_TTL_SECONDS = config('OTP_TTL_SECONDS', default=600, cast=int)
+OTP_MAX_ATTEMPTS = config('OTP_MAX_ATTEMPTS', default=5, cast=int)
+OTP_SWEEP_INTERVAL = config('OTP_SWEEP_INTERVAL', default=60, cast=int)
+
+
+class OTPStore:
+    # Base class for OTP storage. Every entry expires after ttl seconds and is
+    # invalidated once max_attempts wrong codes have been submitted for it.
+
+    def __init__(self, ttl=OTP_TTL_SECONDS, max_attempts=OTP_MAX_ATTEMPTS):
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self._stop_sweeper = None
+
+    def put(self, email, otp):
+        raise NotImplementedError
+
+    def verify(self, email, otp):
+        raise NotImplementedError
+
+    def discard(self, email):
+        raise NotImplementedError
+
+    def sweep(self):
+        raise NotImplementedError
+
+    def start_sweeper(self, interval=OTP_SWEEP_INTERVAL):
+        if self._stop_sweeper is None:
+            self._stop_sweeper = run_periodically("otp-sweeper", interval, self.sweep)
+
+    def stop_sweeper(self):
+        if self._stop_sweeper is not None:
+            self._stop_sweeper.set()
+            self._stop_sweeper = None
+
+
+class MemoryOTPStore(OTPStore):
+
+    def __init__(self, ttl=OTP_TTL_SECONDS, max_attempts=OTP_MAX_ATTEMPTS, clock=time.monotonic):
+        super().__init__(ttl, max_attempts)
+        self.clock = clock
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def put(self, email, otp):
+        with self.lock:
+            # A new otp overwrites the old one and resets the attempt counter
+            self.entries[email] = [str(otp), self.clock() + self.ttl, 0]
+
+    def verify(self, email, otp):
+        with self.lock:
+            entry = self.entries.get(email)
+            if entry is None:
+                return False
+
+            if entry[1] <= self.clock():
+                del self.entries[email]
+                return False
+
+            if hmac.compare_digest(entry[0], str(otp)):
+                return True
+
+            entry[2] += 1
+            if entry[2] >= self.max_attempts:
+                del self.entries[email]
+            return False
+
+    def discard(self, email):
+        with self.lock:
+            self.entries.pop(email, None)
+
+    def sweep(self):
+        now = self.clock()
+        with self.lock:
+            expired = [email for email, entry in self.entries.items() if entry[1] <= now]
+            for email in expired:
+                del self.entries[email]
+        return len(expired)
+
+
+class DatabaseOTPStore(OTPStore):
+    # Stores entries in the Verification table, lookups go through the unique
+    # email index and the sweeper deletes through the expires_at index.
+
+    def __init__(self, session_factory, ttl=OTP_TTL_SECONDS, max_attempts=OTP_MAX_ATTEMPTS):
+        super().__init__(ttl, max_attempts)
+        self.session_factory = session_factory
+
+    def put(self, email, otp):
+        session = self.session_factory()
+        try:
+            expires_at = datetime.utcnow() + timedelta(seconds=self.ttl)
+            updated = session.query(Verification) \
+                .filter_by(email=email) \
+                .update({'otp': str(otp), 'expires_at': expires_at, 'attempts': 0})
+            if not updated:
+                session.add(Verification(email=email, otp=str(otp), expires_at=expires_at, attempts=0))
+            session.commit()
+        finally:
+            session.close()
+
+    def verify(self, email, otp):
+        session = self.session_factory()
+        try:
+            entry = session.query(Verification) \
+                .filter(Verification.email == email, Verification.expires_at > datetime.utcnow()) \
+                .first()
+            if entry is None:
+                return False
+
+            if hmac.compare_digest(entry.otp, str(otp)):
+                return True
+
+            if entry.attempts + 1 >= self.max_attempts:
+                session.delete(entry)
+            else:
+                session.query(Verification) \
+                    .filter_by(id=entry.id) \
+                    .update({'attempts': Verification.attempts + 1})
+            session.commit()
+            return False
+        finally:
+            session.close()
+
+    def discard(self, email):
+        session = self.session_factory()
+        try:
+            session.query(Verification).filter_by(email=email).delete()
+            session.commit()
+        finally:
+            session.close()
+
+    def sweep(self):
+        session = self.session_factory()
+        try:
+            deleted = session.query(Verification) \
+                .filter(Verification.expires_at <= datetime.utcnow()) \
+                .delete(synchronize_session=False)
+            session.commit()
+            return deleted
+        finally:
+            session.close()
+
+
+def create_otp_store(session_factory, kind=OTP_STORE):
+    if kind == 'memory':
+        return MemoryOTPStore()
+    if kind == 'database':
+        return DatabaseOTPStore(session_factory)
+    raise ValueError(f"Unknown OTP store: {kind}")
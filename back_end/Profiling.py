@@ -0,0 +1,127 @@
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from decouple import config
+from flask import g, request
+from flask_jwt_extended import get_jwt, verify_jwt_in_request
+from sqlalchemy import event
+
+PROFILE_DIR = config('PROFILE_DIR', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+PROFILE_SAMPLE_RATE = config('PROFILE_SAMPLE_RATE', default=0.0, cast=float)
+PROFILE_INTERVAL = config('PROFILE_INTERVAL', default=0.005, cast=float)
+PROFILE_HEADER = 'X-Profile'
+
+# Set only on the thread of a request that is being profiled, so the SQL
+# listeners do nothing for every other request
+_local = threading.local()
+
+
+class StackSampler:
+    # Samples the stack of one thread at a fixed interval and counts each
+    # distinct stack in collapsed form, outermost frame first
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+
+class RequestProfile:
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.queries = []
+        self.sampler = StackSampler(threading.get_ident())
+
+    def write(self, directory):
+        # Writes <name>.folded for flamegraph tools and <name>.sql with each query's duration
+        os.makedirs(directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{self.endpoint}-{os.getpid()}-{threading.get_ident()}"
+        path = os.path.join(directory, name)
+
+        with open(path + ".folded", "w") as folded:
+            for stack, count in self.sampler.stacks.most_common():
+                folded.write(f"{stack} {count}\n")
+
+        with open(path + ".sql", "w") as sql:
+            elapsed = time.perf_counter() - self.started
+            sql.write(f"# {self.endpoint} {elapsed * 1000:.1f} ms, {len(self.queries)} queries, "
+                      f"{sum(duration for _, duration in self.queries) * 1000:.1f} ms in SQL\n")
+            for statement, duration in self.queries:
+                sql.write(f"{duration * 1000:.2f} ms\t{' '.join(statement.split())}\n")
+
+        return name
+
+
+def requested_by_admin():
+    if PROFILE_HEADER not in request.headers:
+        return False
+    try:
+        verify_jwt_in_request(optional=True)
+        return bool(get_jwt().get('isAdmin'))
+    except Exception:
+        return False
+
+
+def before_request():
+    if requested_by_admin() or (PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE):
+        profile = RequestProfile(request.endpoint or "unknown")
+        profile.sampler.start()
+        _local.profile = profile
+        g.profile = profile
+
+
+def after_request(response):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        _local.profile = None
+        profile.sampler.stop()
+        try:
+            response.headers['X-Profile-Id'] = profile.write(PROFILE_DIR)
+        except OSError as e:
+            print(f"An error occurred: {e}")
+    return response
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_local, 'profile', None) is not None:
+        conn.info.setdefault('profile_started', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = getattr(_local, 'profile', None)
+    if profile is not None and conn.info.get('profile_started'):
+        profile.queries.append((statement, time.perf_counter() - conn.info['profile_started'].pop()))
+
+
+def init_app(app, engine):
+    app.before_request(before_request)
+    app.after_request(after_request)
+    if not event.contains(engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
@@ -0,0 +1,193 @@
+import math
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from decouple import config
+from flask import request, jsonify, make_response
+from flask_jwt_extended import get_jwt_identity
+
+from Background import run_periodically
+
+# Path of an SQLite file shared by every worker on the host, leave empty to keep buckets per process
+RATE_LIMIT_STORE = config('RATE_LIMIT_STORE', default='')
+# Seconds between sweeps of the buckets that have refilled
+RATE_LIMIT_SWEEP_INTERVAL = config('RATE_LIMIT_SWEEP_INTERVAL', default=60, cast=int)
+LOCK_STRIPES = 64
+
+
+class MemoryBucketStore:
+    # Token buckets held in this process. Keys are spread over striped locks, each
+    # guarding its own dict, so requests for different clients never wait on each other.
+    # A bucket is stored with the time it will be full again, from then on it is the
+    # same as a missing bucket and sweep drops it.
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.buckets = [{} for _ in range(LOCK_STRIPES)]
+        self.locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def take(self, key, capacity, period):
+        rate = capacity / period
+        stripe = hash(key) % LOCK_STRIPES
+        buckets = self.buckets[stripe]
+        with self.locks[stripe]:
+            now = self.clock()
+            tokens, updated, _ = buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+    def sweep(self):
+        removed = 0
+        for buckets, lock in zip(self.buckets, self.locks):
+            with lock:
+                now = self.clock()
+                full = [key for key, (_, _, full_at) in buckets.items() if full_at <= now]
+                for key in full:
+                    del buckets[key]
+            removed += len(full)
+        return removed
+
+    def clear(self):
+        for buckets, lock in zip(self.buckets, self.locks):
+            with lock:
+                buckets.clear()
+
+
+class SQLiteBucketStore:
+    # Token buckets in a local SQLite file so pre-forked workers share one budget per client
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.local = threading.local()
+        conn = self.connection()
+        # The buckets only hold a few minutes of state, a file from before full_at is started again
+        if 'full_at' not in {row[1] for row in conn.execute("PRAGMA table_info(buckets)")}:
+            conn.execute("DROP TABLE IF EXISTS buckets")
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets "
+                     "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, full_at REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_buckets_full_at ON buckets (full_at)")
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        return conn
+
+    def take(self, key, capacity, period):
+        rate = capacity / period
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = self.clock()
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens = min(capacity, tokens + (now - updated) * rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)",
+                         (key, tokens, now, now + (capacity - tokens) / rate))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+    def sweep(self):
+        return self.connection().execute("DELETE FROM buckets WHERE full_at <= ?", (self.clock(),)).rowcount
+
+    def clear(self):
+        self.connection().execute("DELETE FROM buckets")
+
+
+def client_ip():
+    # Behind TRUSTED_PROXIES proxies ProxyFix has already replaced it with the address they forwarded
+    return request.remote_addr
+
+
+def form_gov_id():
+    return request.form.get('gov_id')
+
+
+def json_email():
+    data = request.get_json(silent=True) or {}
+    email = data.get('email')
+    return email.strip().lower() if email else None
+
+
+def token_identity():
+    return get_jwt_identity()
+
+
+KEY_FUNCTIONS = {
+    'ip': client_ip,
+    'gov_id': form_gov_id,
+    'email': json_email,
+    'identity': token_identity
+}
+
+
+class RateLimiter:
+
+    def __init__(self, store=None):
+        self.store = store or create_bucket_store()
+        self.enabled = True
+        self._stop_sweeper = None
+
+    def hit(self, name, key, capacity, period):
+        if not self.enabled:
+            return True, 0
+        return self.store.take(f"{name}:{key}", capacity, period)
+
+    def sweep(self):
+        # Buckets that have refilled, every client that stopped sending requests ends up here
+        return self.store.sweep()
+
+    def start_sweeper(self, interval=RATE_LIMIT_SWEEP_INTERVAL):
+        if self._stop_sweeper is None:
+            self._stop_sweeper = run_periodically("rate-limit-sweeper", interval, self.sweep)
+
+    def stop_sweeper(self):
+        if self._stop_sweeper is not None:
+            self._stop_sweeper.set()
+            self._stop_sweeper = None
+
+    def limit(self, name, capacity, period, key='ip'):
+        # Allows capacity requests per period seconds for each value of key,
+        # checked before the wrapped handler does any work
+        key_function = KEY_FUNCTIONS[key]
+
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                value = key_function()
+                if value is not None:
+                    allowed, retry_after = self.hit(name, value, capacity, period)
+                    if not allowed:
+                        response = make_response(jsonify({"message": "Too many requests, try again later"}), 429)
+                        response.headers['Retry-After'] = str(math.ceil(retry_after))
+                        return response
+                return f(*args, **kwargs)
+
+            return decorated_function
+
+        return decorator
+
+
+def create_bucket_store(path=RATE_LIMIT_STORE):
+    if path:
+        return SQLiteBucketStore(path)
+    return MemoryBucketStore()
@@ -0,0 +1,193 @@
+import itertools
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from decouple import config, Csv
+from sqlalchemy import create_engine, Insert, Update, Delete
+from sqlalchemy.orm import Session
+
+from Background import run_periodically
+from Cache import TTLCache
+from Models import ReplicaHeartbeat, DB_POOL_TIMEOUT
+
+REPLICA_URLS = config('REPLICA_URLS', default='', cast=Csv())
+REPLICA_MAX_LAG = config('REPLICA_MAX_LAG', default=5, cast=int)
+REPLICA_CHECK_INTERVAL = config('REPLICA_CHECK_INTERVAL', default=5, cast=int)
+# Path of an SQLite file shared by every worker on the host, so a voter's next request reads their
+# own writes whichever worker answers it. Kept next to the rate limit buckets unless set.
+REPLICA_WRITERS_STORE = config('REPLICA_WRITERS_STORE', default=config('RATE_LIMIT_STORE', default=''))
+
+
+class Replica:
+
+    def __init__(self, url):
+        self.url = url
+        self.engine = create_engine(url,
+                                    pool_size=config('DB_POOL_SIZE', default=5, cast=int),
+                                    max_overflow=config('DB_MAX_OVERFLOW', default=10, cast=int),
+                                    pool_timeout=DB_POOL_TIMEOUT,
+                                    pool_pre_ping=True)
+        self.lag = None
+        self.healthy = False
+        self.error = None
+
+
+class MemoryWriterStore:
+    # Voters who wrote in the last ttl seconds, seen only by this process
+
+    def __init__(self, ttl):
+        self.writers = TTLCache(ttl=ttl)
+
+    def wrote(self, identity):
+        self.writers.set(identity, time.monotonic())
+
+    def recently_wrote(self, identity):
+        return identity in self.writers
+
+    def sweep(self):
+        return 0
+
+
+class SQLiteWriterStore:
+    # Voters who wrote in the last ttl seconds, in a local SQLite file every worker reads
+
+    def __init__(self, path, ttl, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.clock = clock
+        self.local = threading.local()
+        self.connection().execute("CREATE TABLE IF NOT EXISTS writers (identity TEXT PRIMARY KEY, until REAL NOT NULL)")
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        return conn
+
+    def wrote(self, identity):
+        self.connection().execute("INSERT OR REPLACE INTO writers (identity, until) VALUES (?, ?)",
+                                  (identity, self.clock() + self.ttl))
+
+    def recently_wrote(self, identity):
+        return self.connection().execute("SELECT 1 FROM writers WHERE identity = ? AND until > ?",
+                                         (identity, self.clock())).fetchone() is not None
+
+    def sweep(self):
+        return self.connection().execute("DELETE FROM writers WHERE until <= ?", (self.clock(),)).rowcount
+
+
+def create_writer_store(ttl, path=REPLICA_WRITERS_STORE):
+    if path:
+        return SQLiteWriterStore(path, ttl)
+    return MemoryWriterStore(ttl)
+
+
+class ReplicaSet:
+    # Read only sessions are sent to a replica whose copy of the heartbeat row is
+    # less than max_lag seconds old. A replica that is unreachable, stale or has
+    # not been checked yet is skipped, and with none left reads use the primary.
+
+    def __init__(self, primary, urls=REPLICA_URLS, max_lag=REPLICA_MAX_LAG, writers=None):
+        self.primary = primary
+        self.replicas = [Replica(url) for url in urls if url]
+        self.max_lag = max_lag
+        self.rotation = itertools.count()
+        # Voters who changed something in the last max_lag seconds read from the primary,
+        # after that every healthy replica is guaranteed to have their write
+        self.recent_writers = writers or create_writer_store(ttl=max(max_lag, 1))
+        self._stop = None
+
+    def healthy(self):
+        return [replica for replica in self.replicas if replica.healthy]
+
+    def choose_replica(self):
+        # The next healthy replica in turn, None when reads have to use the primary
+        healthy = self.healthy()
+        if not healthy:
+            return None
+        return healthy[next(self.rotation) % len(healthy)]
+
+    def choose(self):
+        replica = self.choose_replica()
+        return replica.engine if replica else self.primary
+
+    def beat(self):
+        # The heartbeat is written on the primary and replicated like any other row
+        with self.primary.begin() as connection:
+            updated = connection.execute(Update(ReplicaHeartbeat)
+                                         .where(ReplicaHeartbeat.id == 1)
+                                         .values(beat_at=datetime.utcnow())).rowcount
+            if not updated:
+                connection.execute(Insert(ReplicaHeartbeat).values(id=1, beat_at=datetime.utcnow()))
+
+    def check(self):
+        if not self.replicas:
+            return
+        self.beat()
+        self.recent_writers.sweep()
+        for replica in self.replicas:
+            try:
+                with replica.engine.connect() as connection:
+                    beat_at = connection.execute(ReplicaHeartbeat.__table__.select()
+                                                 .with_only_columns(ReplicaHeartbeat.beat_at)
+                                                 .where(ReplicaHeartbeat.id == 1)).scalar()
+                replica.lag = (datetime.utcnow() - beat_at).total_seconds() if beat_at else None
+                replica.healthy = replica.lag is not None and replica.lag <= self.max_lag
+                replica.error = None
+            except Exception as e:
+                replica.lag = None
+                replica.healthy = False
+                replica.error = str(e).splitlines()[0]
+
+    def status(self):
+        return [{"url": replica.engine.url.render_as_string(hide_password=True),
+                 "healthy": replica.healthy,
+                 "lag": replica.lag,
+                 "error": replica.error} for replica in self.replicas]
+
+    def wrote(self, identity):
+        # Without replicas every read goes to the primary anyway
+        if self.replicas:
+            self.recent_writers.wrote(identity)
+
+    def recently_wrote(self, identity):
+        return bool(self.replicas) and self.recent_writers.recently_wrote(identity)
+
+    def start(self, interval=REPLICA_CHECK_INTERVAL):
+        if self.replicas and self._stop is None:
+            self.check()
+            self._stop = run_periodically("replica-health", interval, self.check)
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose(close=False)
+
+
+class RoutingSession(Session):
+    # Sessions marked read_only run their queries on a replica. Flushes and
+    # INSERT, UPDATE and DELETE statements always go to the primary and mark the
+    # session as having written.
+
+    def __init__(self, replicas=None, **kwargs):
+        super().__init__(**kwargs)
+        self.replicas = replicas
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, (Insert, Update, Delete)):
+            self.info['wrote'] = True
+            return super().get_bind(mapper, clause=clause, **kwargs)
+        if self.replicas is not None and self.info.get('read_only'):
+            # Every query in a session reads the same replica so they see one consistent state
+            if 'replica' not in self.info:
+                self.info['replica'] = self.replicas.choose()
+            return self.info['replica']
+        return super().get_bind(mapper, clause=clause, **kwargs)
@@ -0,0 +1,53 @@
+from flask_talisman import Talisman
+
+# One security policy for both serving modes. Talisman applies it to the Flask app,
+# init_async_app sends the same headers and HTTPS redirect from the Quart app.
+CONTENT_SECURITY_POLICY = "default-src 'self'; object-src 'none'"
+PERMISSIONS_POLICY = "browsing-topics=()"
+FRAME_OPTIONS = 'SAMEORIGIN'
+REFERRER_POLICY = 'strict-origin-when-cross-origin'
+HSTS_MAX_AGE = 31556926
+
+
+def init_app(app, force_https):
+    return Talisman(app, force_https=force_https,
+                    content_security_policy=CONTENT_SECURITY_POLICY,
+                    permissions_policy=PERMISSIONS_POLICY,
+                    frame_options=FRAME_OPTIONS,
+                    referrer_policy=REFERRER_POLICY,
+                    strict_transport_security_max_age=HSTS_MAX_AGE)
+
+
+def is_secure(scheme, headers):
+    # Like Talisman, a proxy that terminated TLS says so in X-Forwarded-Proto
+    return scheme == 'https' or headers.get('X-Forwarded-Proto', 'http') == 'https'
+
+
+def security_headers(secure):
+    headers = {
+        'Permissions-Policy': PERMISSIONS_POLICY,
+        'X-Frame-Options': FRAME_OPTIONS,
+        'X-Content-Type-Options': 'nosniff',
+        'Content-Security-Policy': CONTENT_SECURITY_POLICY,
+        'Referrer-Policy': REFERRER_POLICY
+    }
+    # Browsers ignore HSTS sent over plain HTTP
+    if secure:
+        headers['Strict-Transport-Security'] = f"max-age={HSTS_MAX_AGE}; includeSubDomains"
+    return headers
+
+
+def init_async_app(app, force_https, debug=False):
+    from quart import request
+
+    @app.before_request
+    async def redirect_to_https():
+        if force_https and not debug and not is_secure(request.scheme, request.headers) \
+                and request.url.startswith('http://'):
+            return "", 302, {"Location": request.url.replace('http://', 'https://', 1)}
+        return None
+
+    @app.after_request
+    async def add_security_headers(response):
+        response.headers.update(security_headers(is_secure(request.scheme, request.headers)))
+        return response
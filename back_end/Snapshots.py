@@ -0,0 +1,121 @@
+import sys
+import time
+from array import array
+from datetime import datetime
+
+from decouple import config
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+
+from Background import run_periodically
+from Elections import active_election_id
+from Models import Candidate, TallySnapshot, engine
+
+SNAPSHOT_INTERVAL = config('SNAPSHOT_INTERVAL', default=60, cast=int)
+MAX_HISTORY_POINTS = 1000
+
+
+def pack_tallies(tallies):
+    # Stored as little endian (candidate_id, vote_count) pairs of unsigned 32 bit ints
+    packed = array('I')
+    for candidate_id, vote_count in sorted(tallies.items()):
+        packed.append(candidate_id)
+        packed.append(max(0, vote_count or 0))
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_tallies(data):
+    packed = array('I')
+    packed.frombytes(data)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return dict(zip(packed[0::2], packed[1::2]))
+
+
+def take_snapshot(session, election_id, previous=None):
+    # Appends the current tallies to the open election's history unless they are
+    # unchanged since previous, returns the packed tallies that are now the latest
+    tallies = pack_tallies(dict(session.query(Candidate.candidate_id, Candidate.vote_count)))
+    if tallies == previous:
+        return previous
+
+    total_votes = session.query(func.sum(Candidate.vote_count)).scalar() or 0
+    session.add(TallySnapshot(election_id=election_id, taken_at=datetime.utcnow(), total_votes=total_votes,
+                              tallies=tallies))
+    session.commit()
+    return tallies
+
+
+def downsample(snapshots, start, end, points):
+    # Splits the range into equal buckets and keeps the last snapshot in each one
+    step = max((end - start).total_seconds() / points, 1e-6)
+    buckets = {}
+    for snapshot in snapshots:
+        buckets[int((snapshot.taken_at - start).total_seconds() // step)] = snapshot
+    return [buckets[bucket] for bucket in sorted(buckets)]
+
+
+def get_history(session, election_id, start, end, points):
+    snapshots = session.query(TallySnapshot) \
+        .filter(TallySnapshot.election_id == election_id,
+                TallySnapshot.taken_at >= start, TallySnapshot.taken_at <= end) \
+        .order_by(TallySnapshot.taken_at) \
+        .all()
+
+    history = {"timestamps": [], "total_votes": [], "series": {}}
+    for snapshot in downsample(snapshots, start, end, points):
+        index = len(history["timestamps"])
+        history["timestamps"].append(snapshot.taken_at.isoformat())
+        history["total_votes"].append(snapshot.total_votes)
+        for candidate_id, vote_count in unpack_tallies(snapshot.tallies).items():
+            series = history["series"].setdefault(candidate_id, [None] * index)
+            series.append(vote_count)
+        for series in history["series"].values():
+            if len(series) <= index:
+                series.append(None)
+    return history
+
+
+class Snapshotter:
+
+    def __init__(self, session_factory, interval=SNAPSHOT_INTERVAL):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.latest = None
+        self.election_id = None
+        self._stop = None
+
+    def snapshot(self):
+        session = self.session_factory()
+        try:
+            election_id = active_election_id(session)
+            if election_id is None:
+                return
+            if election_id != self.election_id:
+                # A new election always gets a first snapshot, even of the same tallies
+                self.latest, self.election_id = None, election_id
+            self.latest = take_snapshot(session, election_id, self.latest)
+        finally:
+            session.close()
+
+    def start(self):
+        if self._stop is None:
+            self._stop = run_periodically("tally-snapshotter", self.interval, self.snapshot)
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+
+if __name__ == "__main__":
+    # Runs as its own process so only one snapshotter writes no matter how many workers serve the API
+    snapshotter = Snapshotter(sessionmaker(bind=engine))
+    while True:
+        try:
+            snapshotter.snapshot()
+        except Exception as e:
+            print(f"An error occurred: {e}")
+        time.sleep(snapshotter.interval)
@@ -0,0 +1,116 @@
+from decouple import config
+from sqlalchemy import func, select, union, case, or_, and_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from Cache import TTLCache
+from Models import Voter, Constituency, Votes, RankedBallot, Turnout, engine
+
+TURNOUT_CACHE_TTL = config('TURNOUT_CACHE_TTL', default=5, cast=int)
+
+turnout_cache = TTLCache(ttl=TURNOUT_CACHE_TTL)
+
+
+def add(session, election_id, constituency_id, registered=0, voted=0):
+    # Updated in SQL so concurrent registrations and votes are never lost
+    updated = session.query(Turnout) \
+        .filter(Turnout.election_id == election_id, Turnout.constituency_id == constituency_id) \
+        .update({Turnout.registered: Turnout.registered + registered, Turnout.voted: Turnout.voted + voted},
+                synchronize_session=False)
+    if updated:
+        return
+    try:
+        with session.begin_nested():
+            session.add(Turnout(election_id=election_id, constituency_id=constituency_id,
+                                registered=registered, voted=voted))
+    except IntegrityError:
+        # Another request created the row first
+        add(session, election_id, constituency_id, registered, voted)
+
+
+def record_registration(session, election_id, constituency_id):
+    # Between elections there is nothing to count, the next election counts everyone when it starts
+    if election_id is not None:
+        add(session, election_id, constituency_id, registered=1)
+
+
+def record_vote(session, voter_id, election_id):
+    # Only the request that moves voted_in to this election counts the voter,
+    # however many of their votes race each other. Part of the caller's transaction.
+    first = session.query(Voter) \
+        .filter(Voter.voter_id == voter_id, or_(Voter.voted_in.is_(None), Voter.voted_in != election_id)) \
+        .update({Voter.voted_in: election_id}, synchronize_session=False)
+    if first:
+        constituency_id = session.query(Voter.constituency_id).filter(Voter.voter_id == voter_id).scalar()
+        add(session, election_id, constituency_id, voted=1)
+
+
+def record_removal(session, voter, election_id):
+    if election_id is not None:
+        add(session, election_id, voter.constituency_id, registered=-1,
+            voted=-1 if voter.voted_in == election_id else 0)
+
+
+def rebuild(session, election_id):
+    # Recounts an election from Voter, Votes and RankedBallot. Used to fill the table when
+    # an election starts and after it is reset, the caller commits.
+    voted = union(select(Votes.voter_id).where(Votes.election_id == election_id),
+                  select(RankedBallot.voter_id).where(RankedBallot.election_id == election_id)).subquery()
+    session.query(Voter).filter(Voter.voted_in == election_id, Voter.voter_id.not_in(select(voted.c.voter_id))) \
+        .update({Voter.voted_in: None}, synchronize_session=False)
+    session.query(Voter).filter(Voter.voter_id.in_(select(voted.c.voter_id))) \
+        .update({Voter.voted_in: election_id}, synchronize_session=False)
+
+    counts = session.query(Voter.constituency_id, func.count(Voter.voter_id),
+                           func.sum(case((Voter.voted_in == election_id, 1), else_=0))) \
+        .group_by(Voter.constituency_id).all()
+    session.query(Turnout).filter(Turnout.election_id == election_id).delete(synchronize_session=False)
+    session.add_all(Turnout(election_id=election_id, constituency_id=constituency_id, registered=registered,
+                            voted=voted or 0)
+                    for constituency_id, registered, voted in counts)
+    turnout_cache.clear()
+
+
+def percentage(voted, registered):
+    return round(100 * voted / registered, 2) if registered else 0.0
+
+
+def load_turnout(session, election_id):
+    # One row per constituency, so the cost does not grow with the electorate
+    rows = session.query(Constituency.constituency_id, Constituency.constituency_name,
+                         func.coalesce(Turnout.registered, 0), func.coalesce(Turnout.voted, 0)) \
+        .outerjoin(Turnout, and_(Turnout.election_id == election_id,
+                                 Turnout.constituency_id == Constituency.constituency_id)) \
+        .order_by(Constituency.constituency_id) \
+        .all()
+
+    constituencies = [{"constituency_id": constituency_id,
+                       "constituency_name": name,
+                       "registered": registered,
+                       "voted": voted,
+                       "turnout": percentage(voted, registered)}
+                      for constituency_id, name, registered, voted in rows]
+    registered = sum(row["registered"] for row in constituencies)
+    voted = sum(row["voted"] for row in constituencies)
+    return {"election_id": election_id, "registered": registered, "voted": voted,
+            "turnout": percentage(voted, registered), "constituencies": constituencies}
+
+
+def get_turnout(session, election_id):
+    return turnout_cache.get_or_load(election_id, lambda: load_turnout(session, election_id))
+
+
+if __name__ == "__main__":
+    from Elections import active_election_id
+
+    session = sessionmaker(bind=engine)()
+    try:
+        election_id = active_election_id(session)
+        if election_id is None:
+            raise SystemExit("No election is open")
+        rebuild(session, election_id)
+        session.commit()
+        turnout = load_turnout(session, election_id)
+        print(f"{turnout['voted']} of {turnout['registered']} registered voters have voted ({turnout['turnout']}%)")
+    finally:
+        session.close()
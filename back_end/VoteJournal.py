@@ -0,0 +1,445 @@
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime
+
+from decouple import config
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from Background import run_periodically
+from Cache import TTLCache
+from Models import Votes, IdempotencyKey, Election, Candidate, RejectedVote, engine
+from Turnout import record_vote
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Votes are journaled only when a directory is set, otherwise they are written straight to the database
+VOTE_JOURNAL_DIR = config('VOTE_JOURNAL_DIR', default='')
+VOTE_JOURNAL_REPLAY_INTERVAL = config('VOTE_JOURNAL_REPLAY_INTERVAL', default=1, cast=float)
+# How long a process remembers the slots it handed out after their votes were replayed, only
+# needs to cover a read of the database made before the replay, the database is read again after
+VOTE_JOURNAL_CLAIM_TTL = config('VOTE_JOURNAL_CLAIM_TTL', default=60, cast=int)
+# How long the slots a voter has used in the database are trusted before they are read again
+VOTE_JOURNAL_STORED_TTL = config('VOTE_JOURNAL_STORED_TTL', default=5, cast=int)
+REPLAY_BATCH_SIZE = 500
+
+
+def encode(entry):
+    # One record per line, prefixed with the crc32 of the JSON so a torn write is recognised
+    data = json.dumps(entry, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    return b"%08x %s\n" % (zlib.crc32(data), data)
+
+
+def decode(line):
+    try:
+        checksum, data = line.rstrip(b'\n').split(b' ', 1)
+        if int(checksum, 16) != zlib.crc32(data):
+            return None
+        return json.loads(data)
+    except ValueError:
+        return None
+
+
+def read_entries(path, offset=0):
+    # Yields each entry with the offset just past it. A last line without a newline
+    # was being written when the process died and was never acknowledged.
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        for line in file:
+            if not line.endswith(b'\n'):
+                return
+            offset += len(line)
+            entry = decode(line)
+            if entry is None:
+                print(f"Skipping corrupt journal record in {path} before offset {offset}")
+                continue
+            yield entry, offset
+
+
+def process_alive(pid):
+    # Only checked on POSIX, elsewhere a segment left open is recovered by running this module by hand
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class AppendError(Exception):
+    pass
+
+
+class Rejected(Exception):
+    pass
+
+
+class VoteJournal:
+    # Accepted votes are appended to a local file and fsynced before the voter is
+    # answered. A single writer thread writes and fsyncs whatever has queued up
+    # while the previous fsync ran, so concurrent votes share one fsync.
+    #
+    # Each process appends to its own <time>-<pid>-<n>.open segment. Segments are
+    # renamed to .journal when rotated, after which the replayer drains them.
+    #
+    # The open election and the candidates are refreshed by the replayer. Slots are
+    # counted from the voter's slots in the database, read at most every few seconds,
+    # and what this process has journaled since. Another worker may hand out the same
+    # slot in between, so the slot in an entry is only a claim and the replayer gives
+    # the vote the next free one, or rejects it where the voter can look it up.
+
+    def __init__(self, directory=VOTE_JOURNAL_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.queue = []
+        self.file = None
+        self.sequence = 0
+        # Entries appended by this process that have not been replayed yet, by id
+        self.pending = {}
+        # Slots handed out by this process, by (election_id, voter_id, vote_type)
+        self.claimed = TTLCache(ttl=VOTE_JOURNAL_CLAIM_TTL)
+        # Slots the database had for each voter when it was last read, keyed the same way
+        self.stored = TTLCache(ttl=VOTE_JOURNAL_STORED_TTL)
+        # Set by refresh, None until it has run once
+        self.election_id = None
+        self.candidate_ids = None
+        self._writer = None
+
+    @property
+    def ready(self):
+        return self.candidate_ids is not None
+
+    def refresh(self, session):
+        election_id = session.query(Election.election_id) \
+            .filter(Election.closed_at.is_(None)) \
+            .order_by(Election.election_id.desc()) \
+            .limit(1).scalar()
+        candidate_ids = {candidate_id for candidate_id, in session.query(Candidate.candidate_id)}
+        with self.lock:
+            self.election_id, self.candidate_ids = election_id, candidate_ids
+
+    def standing(self, candidate_id):
+        try:
+            return int(candidate_id) in self.candidate_ids
+        except (TypeError, ValueError):
+            return False
+
+    def segment_name(self):
+        self.sequence += 1
+        return os.path.join(self.directory, f"{time.time_ns():020d}-{os.getpid()}-{self.sequence}.open")
+
+    def start(self):
+        if self._writer is None:
+            self._writer = threading.Thread(target=self.run, name="vote-journal", daemon=True)
+            self._writer.start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.lock.wait()
+                batch, self.queue = self.queue, []
+
+            error = None
+            with self.write_lock:
+                try:
+                    if self.file is None:
+                        self.file = open(self.segment_name(), 'ab')
+                    self.file.write(b''.join(data for data, _ in batch))
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                except OSError as e:
+                    error = e
+            for _, waiter in batch:
+                waiter.error = error
+                waiter.set()
+
+    def append(self, entry):
+        # Returns once the entry is on disk, raises AppendError if it could not be written
+        self.start()
+        waiter = threading.Event()
+        with self.lock:
+            self.pending[entry['id']] = entry
+            self.queue.append((encode(entry), waiter))
+            self.lock.notify()
+        waiter.wait()
+        if waiter.error is not None:
+            self.forget([entry['id']])
+            raise AppendError(str(waiter.error))
+        return entry
+
+    def has_stored_slots(self, election_id, voter_id, vote_type):
+        return (election_id, voter_id, vote_type) in self.stored
+
+    def stored_slots(self, session, election_id, voter_id, vote_type):
+        # The slots the voter has used in the database, read outside the lock so
+        # other voters are not held up while it runs
+        return self.stored.get_or_load((election_id, voter_id, vote_type), lambda: {
+            slot for slot, in session.query(Votes.slot)
+            .filter_by(election_id=election_id, voter_id=voter_id, vote_type=vote_type)})
+
+    def accept(self, election_id, voter_id, candidate_id, vote_type, max_votes, stored, key=None,
+               request_hash=None):
+        # Claims the lowest slot that is neither in stored, the slots the voter has used in
+        # the database, nor handed out by this process, then journals the vote. None once
+        # the voter has no slots left.
+        with self.lock:
+            # A retry of a vote that is still pending gets the same entry back
+            if key is not None and self.find_key(voter_id, key) is not None:
+                return self.find_key(voter_id, key)
+            taken = self.claimed_slots(election_id, voter_id, vote_type) | set(stored)
+            slot = next((slot for slot in range(max_votes) if slot not in taken), None)
+            if slot is None:
+                return None
+            entry_id = uuid.uuid4().hex
+            entry = {'id': entry_id, 'election_id': election_id, 'voter_id': voter_id, 'candidate_id': candidate_id,
+                     'vote_type': vote_type, 'slot': slot, 'max_votes': max_votes, 'key': key or f"journal-{entry_id}",
+                     'request_hash': request_hash, 'accepted_at': datetime.utcnow().isoformat()}
+            # Claimed before the lock is released so a concurrent vote cannot take the same slot
+            self.pending[entry_id] = entry
+            self.claimed.set((election_id, voter_id, vote_type),
+                             self.claimed.get((election_id, voter_id, vote_type), set()) | {slot})
+        return self.append(entry)
+
+    def pending_slots(self, election_id, voter_id, vote_type):
+        return {entry['slot'] for entry in list(self.pending.values())
+                if entry['voter_id'] == voter_id and entry['vote_type'] == vote_type
+                and entry['election_id'] == election_id}
+
+    def claimed_slots(self, election_id, voter_id, vote_type):
+        return self.claimed.get((election_id, voter_id, vote_type), set()) | \
+            self.pending_slots(election_id, voter_id, vote_type)
+
+    def find_key(self, voter_id, key):
+        for entry in list(self.pending.values()):
+            if entry['voter_id'] == voter_id and entry['key'] == key:
+                return entry
+        return None
+
+    def forget_slots(self):
+        # After votes are deleted from the database, other workers catch up within VOTE_JOURNAL_CLAIM_TTL
+        self.claimed.clear()
+        self.stored.clear()
+
+    def forget(self, entry_ids):
+        with self.lock:
+            for entry_id in entry_ids:
+                self.pending.pop(entry_id, None)
+
+    def rotate(self):
+        # Closes the active segment so the replayer can take it
+        with self.write_lock:
+            if self.file is None:
+                return
+            self.file.close()
+            os.rename(self.file.name, self.file.name[:-len('.open')] + '.journal')
+            self.file = None
+
+
+class JournalReplayer:
+    # Drains closed segments into Votes and Candidate.vote_count. Every vote is
+    # committed together with its idempotency key, so a segment that is replayed
+    # again after a crash skips the votes that were already applied. Each vote gets
+    # the voter's next free slot, it is only rejected once all of them are taken.
+
+    def __init__(self, directory, session_factory, idempotency_store, apply_vote, journal=None,
+                 batch_size=REPLAY_BATCH_SIZE):
+        self.directory = directory
+        self.session_factory = session_factory
+        self.idempotency_store = idempotency_store
+        self.apply_vote = apply_vote
+        self.journal = journal
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self._stop = None
+
+    def recover(self):
+        # Segments left open by a process that has died will never be rotated by it
+        for path in glob.glob(os.path.join(self.directory, '*.open')):
+            pid = int(os.path.basename(path).split('-')[1])
+            if pid != os.getpid() and not process_alive(pid):
+                os.rename(path, path[:-len('.open')] + '.journal')
+
+    def refresh(self):
+        # Reads what the journal checks new votes against
+        session = self.session_factory()
+        try:
+            self.journal.refresh(session)
+        finally:
+            session.close()
+
+    def replay(self):
+        # Returns the number of votes applied
+        with self.lock:
+            if self.journal is not None:
+                self.refresh()
+                self.journal.rotate()
+            self.recover()
+            applied = 0
+            for path in sorted(glob.glob(os.path.join(self.directory, '*.journal'))):
+                applied += self.replay_segment(path)
+            return applied
+
+    def replay_segment(self, path):
+        try:
+            segment = open(path, 'rb')
+        except FileNotFoundError:
+            return 0
+
+        with segment:
+            # Another process replaying the same directory holds the lock while it works
+            if fcntl is not None:
+                try:
+                    fcntl.flock(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return 0
+            if not os.path.exists(path):
+                return 0
+
+            applied = 0
+            batch = []
+            offset = self.read_checkpoint(path)
+            for entry, offset in read_entries(path, offset):
+                batch.append(entry)
+                if len(batch) >= self.batch_size:
+                    applied += self.apply(batch)
+                    self.write_checkpoint(path, offset)
+                    batch = []
+            if batch:
+                applied += self.apply(batch)
+
+            os.remove(path)
+            if os.path.exists(path + '.offset'):
+                os.remove(path + '.offset')
+            return applied
+
+    def read_checkpoint(self, path):
+        try:
+            with open(path + '.offset', 'r') as checkpoint:
+                return int(checkpoint.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def write_checkpoint(self, path, offset):
+        with open(path + '.offset.tmp', 'w') as checkpoint:
+            checkpoint.write(str(offset))
+        os.replace(path + '.offset.tmp', path + '.offset')
+
+    def apply(self, batch):
+        session = self.session_factory()
+        try:
+            try:
+                applied = self.apply_entries(session, batch)
+                session.commit()
+                self.remember(applied)
+            except (IntegrityError, Rejected):
+                # Some vote in the batch cannot be applied, apply them one at a time to find it
+                session.rollback()
+                applied = []
+                for entry in batch:
+                    try:
+                        entry_applied = self.apply_entries(session, [entry])
+                        session.commit()
+                        self.remember(entry_applied)
+                        applied += entry_applied
+                    except (IntegrityError, Rejected) as e:
+                        session.rollback()
+                        self.reject(session, entry, e)
+        finally:
+            session.close()
+
+        if self.journal is not None:
+            self.journal.forget([entry['id'] for entry in batch])
+        return len(applied)
+
+    def remember(self, applied):
+        # A retry that reaches this worker after the replay is answered from the cache
+        for entry, vote_id in applied:
+            self.idempotency_store.remember(entry['voter_id'], entry['key'], vote_id, entry.get('request_hash'))
+
+    def apply_entries(self, session, entries):
+        # Returns each entry applied with the id of its vote
+        done = set(session.query(IdempotencyKey.voter_id, IdempotencyKey.key)
+                   .filter(IdempotencyKey.key.in_({entry['key'] for entry in entries})))
+        open_elections = {election_id for election_id, in session.query(Election.election_id)
+                          .filter(Election.closed_at.is_(None))}
+        used = {}
+        for election_id, voter_id, vote_type, slot in session.query(Votes.election_id, Votes.voter_id,
+                                                                   Votes.vote_type, Votes.slot) \
+                .filter(Votes.voter_id.in_({entry['voter_id'] for entry in entries})):
+            used.setdefault((election_id, voter_id, vote_type), set()).add(slot)
+
+        applied = []
+        for entry in entries:
+            if (entry['voter_id'], entry['key']) in done:
+                continue
+            if entry['election_id'] not in open_elections:
+                raise Rejected(f"election {entry['election_id']} has closed")
+            taken = used.setdefault((entry['election_id'], entry['voter_id'], entry['vote_type']), set())
+            # Entries journaled before max_votes was recorded keep the slot they were given
+            slot = next((slot for slot in range(entry.get('max_votes', entry['slot'] + 1)) if slot not in taken),
+                        None)
+            if slot is None:
+                raise Rejected("no free slot")
+            taken.add(slot)
+
+            vote = Votes(election_id=entry['election_id'], voter_id=entry['voter_id'],
+                         candidate_id=entry['candidate_id'], vote_type=entry['vote_type'], slot=slot)
+            session.add(vote)
+            self.apply_vote(session, entry['candidate_id'], entry['vote_type'])
+            record_vote(session, entry['voter_id'], entry['election_id'])
+            session.flush()
+            self.idempotency_store.record(session, entry['voter_id'], entry['key'], vote.vote_id,
+                                          entry.get('request_hash'), entry['id'])
+            applied.append((entry, vote.vote_id))
+        return applied
+
+    def reject(self, session, entry, reason):
+        # The voter had already used every slot or the election closed first. Stored so the
+        # voter can look up what became of the vote, and logged for an admin to review.
+        print(f"Rejected journaled vote {entry['id']} for voter {entry['voter_id']}: {reason}")
+        with open(os.path.join(self.directory, 'rejected.log'), 'ab') as rejected:
+            rejected.write(encode(entry))
+        # Merged, a segment replayed again after a crash rejects the same votes again
+        session.merge(RejectedVote(journal_id=entry['id'], voter_id=entry['voter_id'],
+                                   election_id=entry['election_id'], candidate_id=entry['candidate_id'],
+                                   vote_type=entry['vote_type'], reason=str(reason)[:255],
+                                   rejected_at=datetime.utcnow()))
+        session.commit()
+
+    def start(self, interval=VOTE_JOURNAL_REPLAY_INTERVAL):
+        if self._stop is None:
+            self._stop = run_periodically("vote-journal-replayer", interval, self.replay)
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay journaled votes into the database")
+    parser.add_argument("directory", nargs="?", default=VOTE_JOURNAL_DIR)
+    args = parser.parse_args()
+
+    from Helpers import apply_vote_to_tally
+    from Idempotency import IdempotencyStore
+
+    session_factory = sessionmaker(bind=engine)
+    replayer = JournalReplayer(args.directory, session_factory, IdempotencyStore(session_factory),
+                               apply_vote_to_tally)
+    print(f"{replayer.replay()} votes replayed")
@@ -0,0 +1,191 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import timeit
+import types
+from datetime import datetime
+
+from decouple import config
+
+# Models builds its engine from DATABASE_URL on import, a scratch file keeps the
+# suite offline, every benchmark itself runs against the in-memory database below
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'benchmarks.db'))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+# GoogleAPI signs in to Gmail when it is imported, no benchmark sends mail so a transport
+# that only records messages stands in for it and the suite runs without credentials
+mail_transport = types.ModuleType('GoogleAPI')
+mail_transport.service = None
+mail_transport.sent = []
+mail_transport.send_message = lambda service, destination, obj, body, attachments=[]: \
+    mail_transport.sent.append((destination, obj, body))
+sys.modules.setdefault('GoogleAPI', mail_transport)
+
+import Helpers
+from Models import Base, Constituency, Party, Candidate, Voter, Votes, Election
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baselines.json')
+BENCHMARK_THRESHOLD = config('BENCHMARK_THRESHOLD', default=1.25, cast=float)
+# Odd, so the median is one of the runs
+REPEATS = config('BENCHMARK_REPEATS', default=15, cast=int)
+
+CONSTITUENCIES = 18
+PARTIES = 10
+CANDIDATES_PER_CONSTITUENCY = 8
+VOTERS = 2000
+
+
+def create_session():
+    # A seeded in-memory database the size of one busy constituency count
+    engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+
+    session.add(Election(election_id=1, name="Election", started_at=datetime(2024, 5, 2)))
+    session.add_all(Constituency(constituency_id=c, constituency_name=f"Constituency {c}")
+                    for c in range(1, CONSTITUENCIES + 1))
+    session.add_all(Party(party_id=p, party_name=f"Party {p}", image="", manifesto="Manifesto " * 200)
+                    for p in range(1, PARTIES + 1))
+    candidates = CONSTITUENCIES * CANDIDATES_PER_CONSTITUENCY
+    session.add_all(Candidate(candidate_id=c, candidate_firstname="First", candidate_lastname=f"Last {c}",
+                              party_id=c % PARTIES + 1, vote_count=0, image="",
+                              constituency_id=c % CONSTITUENCIES + 1, statement="Statement " * 100)
+                    for c in range(1, candidates + 1))
+    session.add_all(Voter(voter_id=v, first_name="First", last_name="Last", gov_id=str(10000000 + v),
+                          password="", constituency_id=v % CONSTITUENCIES + 1, email=f"voter{v}@example.com",
+                          isAdmin=False)
+                    for v in range(1, VOTERS + 1))
+    session.flush()
+    session.add_all(Votes(election_id=1, voter_id=v, candidate_id=(v + slot) % candidates + 1, vote_type=1,
+                          slot=slot)
+                    for v in range(1, VOTERS + 1) for slot in range(2))
+    session.commit()
+    return session
+
+
+def calibration():
+    # Pure interpreter work, every result is stored relative to it so baselines
+    # recorded on one machine can be compared on another, and so can two runs on a busy one
+    total = 0
+    for number in range(1000):
+        total += number * number
+    return total
+
+
+def build_benchmarks(session):
+    # The cheap validators run over a batch per call, a single call is too short to time steadily
+    emails = [f"voter{v}@example.com" for v in range(100)] + [f"not-an-email-{v}" for v in range(100)]
+    postcodes = [f"BT{v} {v}AB" for v in range(1, 101)] + [f"XX{v}" for v in range(100)]
+    hashed_password = Helpers.encrypt_password("password123").decode('utf-8')
+    candidates = session.query(Candidate, Party).join(Party, Candidate.party_id == Party.party_id).all()
+
+    def apply_vote_to_tally():
+        Helpers.apply_vote_to_tally(session, 1, 1)
+        session.rollback()
+
+    return {
+        'calibration': calibration,
+        'encrypt_password': lambda: Helpers.encrypt_password("password123"),
+        'check_password': lambda: Helpers.check_password("password123", hashed_password),
+        'validate_email': lambda: [Helpers.validate_email(email) for email in emails],
+        'validate_postcode': lambda: [Helpers.validate_postcode(postcode) for postcode in postcodes],
+        'match_postcode_with_constituency': lambda: [Helpers.match_postcode_with_constituency(postcode[:4])
+                                                     for postcode in postcodes],
+        'gov_id_generator': lambda: [Helpers.gov_id_generator(8) for _ in range(200)],
+        'generate_otp': lambda: [Helpers.generate_otp() for _ in range(200)],
+        'user_exists': lambda: Helpers.user_exists("voter1500@example.com", session),
+        'load_identity': lambda: Helpers.load_identity("10001500", session),
+        'free_vote_slot': lambda: Helpers.free_vote_slot(session, 1, 1500, 1, 2),
+        'apply_vote_to_tally': apply_vote_to_tally,
+        'load_candidate_list': lambda: Helpers.load_candidate_list(session),
+        'voting_data_to_dict': lambda: [Helpers.voting_data_to_dict(candidate, party, 1000)
+                                        for candidate, party in candidates]
+    }
+
+
+def measure(function):
+    # Median time per call and median ratio to the calibration loop over REPEATS runs. Every run is
+    # timed right next to a calibration run, so a machine that slows down or speeds up part way
+    # through moves both and the ratio holds, and one noisy run does not move the median.
+    timer, reference = timeit.Timer(function), timeit.Timer(calibration)
+    number, _ = timer.autorange()
+    reference_number, _ = reference.autorange()
+    seconds, relative = [], []
+    for _ in range(REPEATS):
+        per_call = timer.timeit(number) / number
+        seconds.append(per_call)
+        relative.append(per_call / (reference.timeit(reference_number) / reference_number))
+    return {'seconds': statistics.median(seconds), 'relative': statistics.median(relative)}
+
+
+def run(names=None):
+    session = create_session()
+    try:
+        benchmarks = build_benchmarks(session)
+        selected = [name for name in benchmarks if not names or name in names]
+        return {name: measure(benchmarks[name]) for name in selected}
+    finally:
+        session.close()
+
+
+def compare(results, baselines, threshold):
+    # Returns the names of benchmarks that are more than threshold times slower than their baseline.
+    # Only the ratios to the calibration loop are compared, the times per call differ between machines.
+    regressions = []
+    print(f"{'benchmark':<34}{'per call':>14}{'relative':>12}{'baseline':>12}{'change':>10}")
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        line = f"{name:<34}{result['seconds'] * 1e6:>11.2f} us{result['relative']:>12.2f}"
+        if baseline is None:
+            print(f"{line}{'new':>12}")
+            continue
+
+        ratio = result['relative'] / baseline['relative']
+        line += f"{baseline['relative']:>12.2f}{(ratio - 1) * 100:>+9.1f}%"
+        if name != 'calibration' and ratio > threshold:
+            regressions.append(name)
+            line += "  REGRESSION"
+        print(line)
+    return regressions
+
+
+def load_baselines(path=BASELINE_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as baselines:
+        return json.load(baselines)
+
+
+def save_baselines(results, path=BASELINE_FILE):
+    # Only the ratios are kept, a time per call is only meaningful on the machine that measured it
+    with open(path, 'w') as baselines:
+        json.dump({name: {'relative': result['relative']} for name, result in results.items()}, baselines,
+                  indent=2, sort_keys=True)
+        baselines.write("\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the registration and voting hot paths")
+    parser.add_argument("names", nargs="*", help="only run these benchmarks")
+    parser.add_argument("--update", action="store_true", help="store the results as the new baselines")
+    parser.add_argument("--threshold", type=float, default=BENCHMARK_THRESHOLD,
+                        help="slowdown relative to the baseline that counts as a regression")
+    args = parser.parse_args()
+
+    results = run(args.names)
+    regressions = compare(results, load_baselines(), args.threshold)
+
+    if args.update:
+        baselines = load_baselines()
+        baselines.update(results)
+        save_baselines(baselines)
+        print(f"Baselines written to {BASELINE_FILE}")
+    elif regressions:
+        print(f"{len(regressions)} benchmark(s) slower than {args.threshold}x baseline: {', '.join(regressions)}")
+        sys.exit(1)
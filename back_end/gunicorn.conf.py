@@ -0,0 +1,20 @@
+import multiprocessing
+
+from decouple import config
+
+# Production entrypoint: gunicorn -c gunicorn.conf.py
+# The app and its read mostly data are loaded once in the master process and
+# shared with the forked workers, each worker then opens its own connections.
+
+wsgi_app = "API:create_production_app()"
+bind = config('BIND', default='0.0.0.0:5000')
+workers = config('WORKERS', default=multiprocessing.cpu_count() * 2 + 1, cast=int)
+threads = config('THREADS', default=4, cast=int)
+worker_class = 'gthread'
+timeout = config('WORKER_TIMEOUT', default=30, cast=int)
+preload_app = True
+
+
+def post_fork(server, worker):
+    import API
+    API.init_worker()
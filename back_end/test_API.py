@@ -1,17 +1,46 @@
+import io
+import os
+import sys
+import tempfile
+import time
 import unittest
-from unittest.mock import MagicMock
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
 
 import bcrypt
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
+from flask_jwt_extended import create_access_token, verify_jwt_in_request
 
 import API
+import Helpers
+from Models import Base, Constituency, Voter
+from OTPStore import MemoryOTPStore
+from Cache import TTLCache
+from CircuitBreaker import CircuitBreaker, CircuitOpen
+from Compression import negotiate, cache_policy
+from Health import pool_status
+from ImageStore import Image, ImageStore, ImageError, THUMBNAIL_SIZES, thumbnail_name, thumbnail_url
+from Profiling import RequestProfile
+from Replicas import ReplicaSet, SQLiteWriterStore
+from Snapshots import pack_tallies, unpack_tallies, downsample
+from RateLimiter import MemoryBucketStore, SQLiteBucketStore, client_ip
 from Helpers import encrypt_password, gov_id_generator, match_postcode_with_constituency, generate_otp, validate_email, \
-    validate_postcode, verify_otp, user_exists, get_user_by_gov_id, get_user_by_email, check_password
+    validate_postcode, verify_otp, user_exists, get_user_by_gov_id, get_user_by_email, check_password, \
+    identity_claims, free_vote_slot, voter_summary_to_dict, ballot_state, Candidate, Votes
 
 
 class TestApp(unittest.TestCase):
-    postcode_regex = API.postcode_regex
+    postcode_regex = API.Helpers.postcode_regex
     session = API.Session()
 
+    def test_modules_are_only_loaded_once(self):
+        # A module imported under two names would open a second engine and hook it twice
+        self.assertEqual([name for name in sys.modules if name.startswith('back_end.')], [])
+        self.assertIs(API.Helpers.Voter, API.Voter)
+        self.assertEqual(len(API.engine.dispatch.after_cursor_execute), 2)
+
     def test_encrypt_password(self):
         password = "test_password"
         encrypted_password = encrypt_password(password)
@@ -82,20 +111,47 @@ class TestApp(unittest.TestCase):
         self.assertFalse(result)
 
     def test_verify_otp_valid(self):
-        mock_query = MagicMock()
-        mock_query.filter_by.return_value.first.return_value = {'email': 'johnsmith@example.com', 'otp': '123456'}
+        store = MemoryOTPStore()
+        store.put('johnsmith@example.com', '123456')
 
-        with unittest.mock.patch('API.session.query', return_value=mock_query):
-            result = verify_otp('', '123456', session=API.session)
-            self.assertTrue(result)
+        result = verify_otp('johnsmith@example.com', '123456', store)
+        self.assertTrue(result)
 
     def test_verify_otp_invalid(self):
-        mock_query = MagicMock()
-        mock_query.filter_by.return_value.first.return_value = None
+        store = MemoryOTPStore()
+        store.put('johnsmith@example.com', '123456')
 
-        with unittest.mock.patch('API.session.query', return_value=mock_query):
-            result = verify_otp('johnsmith@example.com', '000000', session=API.session)
-            self.assertFalse(result)
+        result = verify_otp('johnsmith@example.com', '000000', store)
+        self.assertFalse(result)
+
+    def test_verify_otp_expired(self):
+        now = [0]
+        store = MemoryOTPStore(ttl=60, clock=lambda: now[0])
+        store.put('johnsmith@example.com', '123456')
+        now[0] = 61
+
+        result = verify_otp('johnsmith@example.com', '123456', store)
+        self.assertFalse(result)
+
+    def test_verify_otp_too_many_attempts(self):
+        store = MemoryOTPStore(max_attempts=3)
+        store.put('johnsmith@example.com', '123456')
+        for _ in range(3):
+            verify_otp('johnsmith@example.com', '000000', store)
+
+        result = verify_otp('johnsmith@example.com', '123456', store)
+        self.assertFalse(result)
+
+    def test_otp_store_sweep_removes_expired(self):
+        now = [0]
+        store = MemoryOTPStore(ttl=60, clock=lambda: now[0])
+        store.put('old@example.com', '123456')
+        now[0] = 30
+        store.put('new@example.com', '654321')
+        now[0] = 61
+
+        self.assertEqual(store.sweep(), 1)
+        self.assertTrue(verify_otp('new@example.com', '654321', store))
 
     def test_user_exists_true(self):
         mock_query = MagicMock()
@@ -159,6 +215,297 @@ class TestApp(unittest.TestCase):
         result = check_password('wrong_password', hashed_password.decode('utf-8'))
         self.assertFalse(result)
 
+    def test_token_bucket_rejects_when_empty(self):
+        store = MemoryBucketStore(clock=lambda: 0)
+
+        results = [store.take('login:123', 3, 60)[0] for _ in range(4)]
+        self.assertEqual(results, [True, True, True, False])
+
+    def test_token_bucket_refills_over_time(self):
+        now = [0]
+        store = MemoryBucketStore(clock=lambda: now[0])
+        store.take('login:123', 1, 60)
+        self.assertFalse(store.take('login:123', 1, 60)[0])
+
+        now[0] = 60
+        self.assertTrue(store.take('login:123', 1, 60)[0])
+
+    def test_token_bucket_keys_are_independent(self):
+        store = MemoryBucketStore(clock=lambda: 0)
+        store.take('login:123', 1, 60)
+
+        self.assertTrue(store.take('login:456', 1, 60)[0])
+
+    def test_sqlite_bucket_store_is_shared(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'buckets.db')
+            first = SQLiteBucketStore(path, clock=lambda: 0)
+            second = SQLiteBucketStore(path, clock=lambda: 0)
+
+            self.assertTrue(first.take('email:a@b.com', 1, 600)[0])
+            allowed, retry_after = second.take('email:a@b.com', 1, 600)
+            self.assertFalse(allowed)
+            self.assertEqual(retry_after, 600)
+
+    def test_token_bucket_sweep_drops_refilled_buckets(self):
+        now = [0]
+        store = MemoryBucketStore(clock=lambda: now[0])
+        store.take('login:123', 2, 60)
+        store.take('login:456', 2, 60)
+        store.take('login:456', 2, 60)
+
+        now[0] = 30
+        self.assertEqual(store.sweep(), 1)
+        now[0] = 60
+        self.assertEqual(store.sweep(), 1)
+        self.assertEqual(sum(len(buckets) for buckets in store.buckets), 0)
+
+    def test_sqlite_bucket_store_sweeps_refilled_buckets(self):
+        with tempfile.TemporaryDirectory() as directory:
+            now = [0]
+            store = SQLiteBucketStore(os.path.join(directory, 'buckets.db'), clock=lambda: now[0])
+            store.take('email:a@b.com', 3, 600)
+            store.take('email:c@d.com', 1, 600)
+
+            now[0] = 200
+            self.assertEqual(store.sweep(), 1)
+            self.assertFalse(store.take('email:c@d.com', 1, 600)[0])
+
+    def test_client_ip_is_read_behind_trusted_proxies(self):
+        def client_ip_seen(trusted_proxies):
+            app = API.create_app({'TRUSTED_PROXIES': trusted_proxies, 'FORCE_HTTPS': False})
+            app.add_url_rule('/client-ip', 'client_ip', client_ip)
+            return app.test_client().get('/client-ip', headers={'X-Forwarded-For': '203.0.113.7, 10.0.0.2'},
+                                         environ_base={'REMOTE_ADDR': '10.0.0.1'}).get_data(as_text=True)
+
+        self.assertEqual(client_ip_seen(0), '10.0.0.1')
+        self.assertEqual(client_ip_seen(1), '10.0.0.2')
+        self.assertEqual(client_ip_seen(2), '203.0.113.7')
+
+    def test_ttl_cache_expires_entries(self):
+        now = [0]
+        cache = TTLCache(ttl=30, clock=lambda: now[0])
+        cache.set('12345678', {'isAdmin': True})
+        self.assertEqual(cache.get('12345678'), {'isAdmin': True})
+
+        now[0] = 30
+        self.assertIsNone(cache.get('12345678'))
+
+    def test_ttl_cache_evicts_least_recently_used(self):
+        cache = TTLCache(ttl=30, maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+
+    def test_identity_claims(self):
+        voter = MagicMock(voter_id=7, constituency_id=3, isAdmin=None, token_version=2)
+
+        claims = identity_claims(voter)
+        self.assertEqual(claims, {'voter_id': 7, 'constituency_id': 3, 'isAdmin': False, 'token_version': 2})
+
+    def test_token_claims_stop_being_trusted_when_another_worker_changes_the_voter(self):
+        engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        session.add(Constituency(constituency_id=1, constituency_name="Belfast South"))
+        voter = Voter(voter_id=1, first_name="F", last_name="L", gov_id="87654321", password="", constituency_id=1,
+                      email="admin@example.com", isAdmin=True)
+        session.add(voter)
+        session.commit()
+        Helpers.invalidate_identity("87654321")
+        app = API.create_app()
+
+        def identity():
+            with app.test_request_context(headers={"Authorization": f"Bearer {token}"}):
+                verify_jwt_in_request()
+                return Helpers.get_identity(session)
+
+        with app.app_context():
+            token = create_access_token(identity="87654321", additional_claims=identity_claims(voter))
+        self.assertTrue(identity()['isAdmin'])
+
+        # Committed by another worker, this one only finds out once its cached token_version runs out
+        voter.isAdmin = False
+        Helpers.expire_token_claims(voter)
+        session.commit()
+        Helpers.token_versions.clear()
+        self.assertFalse(identity()['isAdmin'])
+
+        session.delete(voter)
+        session.commit()
+        Helpers.token_versions.clear()
+        self.assertIsNone(identity())
+        session.close()
+
+    def test_free_vote_slot_returns_lowest_unused(self):
+        mock_session = MagicMock()
+        mock_session.query.return_value.filter_by.return_value = [(1,)]
+
+        result = free_vote_slot(mock_session, 1, 1, 1, 2)
+        self.assertEqual(result, 0)
+
+    def test_free_vote_slot_none_when_limit_reached(self):
+        mock_session = MagicMock()
+        mock_session.query.return_value.filter_by.return_value = [(0,), (1,)]
+
+        result = free_vote_slot(mock_session, 1, 1, 1, 2)
+        self.assertIsNone(result)
+
+    def test_pack_tallies_round_trip(self):
+        tallies = {3: 10, 1: 0, 2: 7}
+
+        result = unpack_tallies(pack_tallies(tallies))
+        self.assertEqual(result, tallies)
+
+    def test_downsample_keeps_last_snapshot_per_bucket(self):
+        start = datetime(2024, 5, 2, 7)
+        snapshots = [MagicMock(taken_at=start + timedelta(minutes=minute)) for minute in range(60)]
+
+        result = downsample(snapshots, start, start + timedelta(hours=1), 4)
+        self.assertEqual([snapshot.taken_at.minute for snapshot in result], [14, 29, 44, 59])
+
+    def test_request_profile_writes_folded_stacks(self):
+        profile = RequestProfile('api.login')
+        profile.sampler.stacks['API.py:login:1;Helpers.py:get_identity:2'] = 3
+        profile.queries.append(('SELECT 1', 0.002))
+
+        with tempfile.TemporaryDirectory() as directory:
+            name = profile.write(directory)
+            with open(os.path.join(directory, name + '.folded')) as folded:
+                self.assertEqual(folded.read(), 'API.py:login:1;Helpers.py:get_identity:2 3\n')
+            with open(os.path.join(directory, name + '.sql')) as sql:
+                self.assertIn('2.00 ms\tSELECT 1', sql.read())
+
+    def test_thumbnail_url(self):
+        digest = 'ab' * 32
+
+        self.assertEqual(thumbnail_url(f'http://localhost/api/v1.0/images/{digest}.gif', 'small'),
+                         f'http://localhost/api/v1.0/images/{digest}-small.png')
+        self.assertEqual(thumbnail_url('https://example.com/logo.png', 'small'), 'https://example.com/logo.png')
+
+    def test_image_store_is_content_addressed(self):
+        data = b'GIF89a' + b'\x00' * 32
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = ImageStore(directory)
+            with patch('ImageStore.Image', None):
+                name = store.put(data)
+
+            self.assertTrue(name.endswith('.gif'))
+            self.assertEqual(store.put(data), name)
+            with open(store.resolve(name), 'rb') as image:
+                self.assertEqual(image.read(), data)
+            self.assertRaises(ImageError, store.put, b'not an image')
+
+    @unittest.skipIf(Image is None, "needs Pillow installed")
+    def test_image_store_writes_nothing_for_an_unreadable_image(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (640, 480)).save(buffer, 'PNG')
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = ImageStore(directory)
+            self.assertRaises(ImageError, store.put, b'\x89PNG\r\n\x1a\n' + b'\x00' * 32)
+            self.assertEqual(os.listdir(directory), [])
+
+            name = store.put(buffer.getvalue())
+            self.assertEqual(sorted(os.listdir(os.path.dirname(store.path(name)))),
+                             sorted([name] + [thumbnail_name(name, size) for size in THUMBNAIL_SIZES]))
+
+    def test_replica_set_reads_from_healthy_replicas_only(self):
+        replicas = ReplicaSet('primary', urls=[])
+        self.assertEqual(replicas.choose(), 'primary')
+
+        replicas.replicas = [MagicMock(healthy=True, engine='a'), MagicMock(healthy=False, engine='b'),
+                             MagicMock(healthy=True, engine='c')]
+        self.assertEqual({replicas.choose() for _ in range(4)}, {'a', 'c'})
+
+    def test_recent_writers_are_seen_by_every_worker(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'writers.db')
+            workers = [ReplicaSet('primary', urls=[], writers=SQLiteWriterStore(path, ttl=5)) for _ in range(2)]
+            for worker in workers:
+                worker.replicas = [MagicMock(healthy=True, engine='replica')]
+
+            workers[0].wrote('12345678')
+            self.assertTrue(workers[1].recently_wrote('12345678'))
+            self.assertFalse(workers[1].recently_wrote('87654321'))
+
+            workers[1].recent_writers.clock = lambda: time.time() + 10
+            self.assertFalse(workers[1].recently_wrote('12345678'))
+            self.assertEqual(workers[1].recent_writers.sweep(), 1)
+
+    def test_voter_summary_leaves_out_password(self):
+        voter = MagicMock(voter_id=1, first_name='A', last_name='B', gov_id='12345678', email='a@b.com',
+                          constituency_id=3, isAdmin=None, voted_in=4, password='hash')
+        summary = voter_summary_to_dict(voter, 4)
+
+        self.assertNotIn('password', summary)
+        self.assertEqual((summary['isAdmin'], summary['has_voted']), (False, True))
+
+    def test_ballot_state_reads_standing_candidates_and_used_slots(self):
+        engine = create_engine('sqlite://')
+        Candidate.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        session.add_all(Candidate(candidate_id=c, candidate_firstname="F", candidate_lastname="L", party_id=1,
+                                  vote_count=0, image="", constituency_id=1 if c < 3 else 2, statement="")
+                        for c in (1, 2, 3))
+        session.add_all([Votes(election_id=1, voter_id=1, candidate_id=1, vote_type=1, slot=0),
+                         Votes(election_id=1, voter_id=1, candidate_id=2, vote_type=-1, slot=0),
+                         Votes(election_id=1, voter_id=2, candidate_id=1, vote_type=1, slot=1),
+                         Votes(election_id=2, voter_id=1, candidate_id=1, vote_type=1, slot=1)])
+        session.commit()
+
+        self.assertEqual(ballot_state(session, 1, 1, 1, {1, 3, 4}), ({1}, {1: {0}, -1: {0}}))
+        session.close()
+
+    def test_negotiate_respects_quality(self):
+        self.assertEqual(negotiate('gzip, deflate'), 'gzip')
+        self.assertIsNone(negotiate('gzip;q=0, identity'))
+        self.assertIsNone(negotiate(None))
+        self.assertEqual(negotiate('*'), negotiate('br, gzip'))
+
+    def test_cache_policy_defaults_to_no_store(self):
+        self.assertTrue(cache_policy('/api/v1.0/parties', 'GET', 200).startswith('public'))
+        self.assertEqual(cache_policy('/api/v1.0/parties', 'POST', 200), 'no-store')
+        self.assertEqual(cache_policy('/api/v1.0/parties/<id>', 'GET', 404), 'no-store')
+        self.assertEqual(cache_policy('/api/v1.0/profile', 'GET', 200), 'no-store')
+
+    def test_pool_status_reports_saturation(self):
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f'sqlite:///{directory}/pool.db', poolclass=QueuePool, pool_size=1, max_overflow=0)
+            connection = engine.connect()
+            self.assertTrue(pool_status(engine)['saturated'])
+            connection.close()
+            self.assertFalse(pool_status(engine)['saturated'])
+            engine.dispose()
+
+    def test_circuit_breaker_opens_and_probes(self):
+        now = [0.0]
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=10, errors=(IOError,),
+                                 clock=lambda: now[0])
+
+        @breaker
+        def call(error=None):
+            if error:
+                raise error
+            return 'ok'
+
+        self.assertRaises(ValueError, call, ValueError())
+        self.assertRaises(IOError, call, IOError())
+        self.assertRaises(IOError, call, IOError())
+        self.assertRaises(CircuitOpen, call)
+
+        now[0] = 10
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.success()
+        self.assertEqual(call(), 'ok')
+        self.assertEqual(breaker.status()['state'], 'closed')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,219 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from sqlalchemy import text, create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.exc import OperationalError
+
+import Models
+
+# The async engine reads the same SQLite file as the Flask app when the tests run against one
+if Models.engine.dialect.name == 'sqlite':
+    os.environ.setdefault('ASYNC_DB_URL', Models.engine.url.set(drivername='sqlite+aiosqlite')
+                          .render_as_string(hide_password=False))
+
+import API
+import AsyncAPI
+import Elections
+import Helpers
+from CircuitBreaker import CircuitBreaker, CircuitOpen
+from Models import Base, Constituency, Party, Candidate, Voter, Votes
+from RateLimiter import create_bucket_store
+from VoteJournal import VoteJournal
+
+
+def run_lifespan(application):
+    # Starts and stops an ASGI app the way hypercorn does, returns the messages it sent back
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message["type"])
+
+    asyncio.run(application({"type": "lifespan", "asgi": {"version": "3.0", "spec_version": "2.0"}}, receive, send))
+    return sent
+
+
+class TestAsyncAPI(unittest.TestCase):
+
+    def test_background_tasks_start_with_the_asgi_app(self):
+        with patch.object(API, 'start_background_tasks') as start_background_tasks:
+            sent = run_lifespan(AsyncAPI.application)
+
+        start_background_tasks.assert_called_once_with()
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+
+
+@unittest.skipUnless(Models.engine.dialect.name == 'sqlite', "needs DATABASE_URL to be a SQLite file")
+class TestAsyncRoutesMatchFlask(unittest.TestCase):
+    # Every async route is called next to its Flask twin and has to answer the same
+
+    @classmethod
+    def setUpClass(cls):
+        Base.metadata.create_all(Models.engine)
+        session = API.Session()
+        session.add(Constituency(constituency_id=1, constituency_name="Belfast South"))
+        session.add(Party(party_id=1, party_name="Party", image="party.png", manifesto="Manifesto"))
+        session.add_all(Candidate(candidate_id=c, candidate_firstname="F", candidate_lastname=str(c), party_id=1,
+                                  vote_count=c, image="candidate.png", constituency_id=1, statement="Statement")
+                        for c in (1, 2))
+        session.add(Voter(voter_id=1, first_name="F", last_name="L", gov_id="12345678", email="a@b.com",
+                          password=Helpers.encrypt_password("password1").decode('utf-8'), constituency_id=1))
+        session.flush()
+        cls.election_id = Elections.open_first_election(session).election_id
+        session.add(Votes(election_id=cls.election_id, voter_id=1, candidate_id=1, vote_type=1, slot=0))
+        session.commit()
+        API.Session.remove()
+
+        cls.flask_client = AsyncAPI.flask_app.test_client()
+        with AsyncAPI.flask_app.app_context():
+            cls.token = API.create_access_token(identity="12345678",
+                                                additional_claims={'voter_id': 1, 'constituency_id': 1,
+                                                                   'isAdmin': False})
+
+    @classmethod
+    def tearDownClass(cls):
+        Base.metadata.drop_all(Models.engine)
+
+    def setUp(self):
+        API.limiter.store = create_bucket_store()
+        Helpers.catalog_cache.clear()
+        Helpers.identity_cache.clear()
+
+    def flask(self, method, path, scheme='https', **kwargs):
+        response = self.flask_client.open(path, method=method, base_url=f"{scheme}://localhost", **kwargs)
+        return response.status_code, response.get_json(silent=True), response.headers
+
+    def quart(self, method, path, scheme='https', **kwargs):
+        async def call():
+            try:
+                response = await AsyncAPI.app.test_client().open(path, method=method, scheme=scheme, **kwargs)
+                return response.status_code, await response.get_json(), response.headers
+            finally:
+                # Each call runs on its own event loop
+                await AsyncAPI.async_engine.dispose()
+
+        return asyncio.run(call())
+
+    def assertSameResponse(self, method, path, flask_kwargs=None, quart_kwargs=None, **kwargs):
+        flask_status, flask_body, _ = self.flask(method, path, **dict(kwargs, **(flask_kwargs or {})))
+        quart_status, quart_body, _ = self.quart(method, path, **dict(kwargs, **(quart_kwargs or {})))
+        self.assertEqual((quart_status, quart_body), (flask_status, flask_body), path)
+        return flask_body
+
+    def auth(self):
+        return {"Authorization": f"Bearer {self.token}"}
+
+    def test_read_routes(self):
+        for path in ("/api/v1.0/parties", "/api/v1.0/parties?excerpt=4", "/api/v1.0/parties/1",
+                     "/api/v1.0/parties/9", "/api/v1.0/candidates", "/api/v1.0/candidates/1",
+                     "/api/v1.0/candidates/9", "/api/v1.0/voting-data"):
+            self.assertSameResponse("GET", path)
+
+    def test_profile(self):
+        self.assertEqual(self.assertSameResponse("GET", "/api/v1.0/profile", headers=self.auth())["gov_id"],
+                         "12345678")
+
+    def test_remaining_votes_count_journaled_votes(self):
+        directory = tempfile.mkdtemp()
+        try:
+            journal = VoteJournal(directory)
+            journal.accept(self.election_id, 1, 2, 1, 2, set())
+            with patch.object(API, 'vote_journal', journal):
+                body = self.assertSameResponse("GET", "/api/v1.0/remaining-votes/1", headers=self.auth())
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(body, {"remaining_positive_votes": 0, "remaining_negative_votes": 1})
+
+    def test_login(self):
+        form = {"gov_id": "12345678", "password": "password1"}
+        flask_status, flask_body, _ = self.flask("POST", "/api/v1.0/login", data=form)
+        quart_status, quart_body, _ = self.quart("POST", "/api/v1.0/login", form=form)
+        self.assertEqual((quart_status, quart_body["user_data"]), (flask_status, flask_body["user_data"]))
+
+        self.assertSameResponse("POST", "/api/v1.0/login", flask_kwargs={"data": dict(form, password="wrong")},
+                                quart_kwargs={"form": dict(form, password="wrong")})
+
+    def test_verification(self):
+        self.assertSameResponse("POST", "/api/v1.0/verification", json={"email": "a@b.com"})
+
+        with patch.object(Helpers, 'send_otp', side_effect=CircuitOpen("gmail", 30)):
+            flask_status, flask_body, flask_headers = self.flask("POST", "/api/v1.0/verification",
+                                                                 json={"email": "new@b.com"})
+            quart_status, quart_body, quart_headers = self.quart("POST", "/api/v1.0/verification",
+                                                                 json={"email": "new@b.com"})
+        self.assertEqual((quart_status, quart_body), (flask_status, flask_body))
+        self.assertEqual((quart_status, quart_headers["Retry-After"]), (503, flask_headers["Retry-After"]))
+
+    def test_open_database_breaker_fails_fast(self):
+        breaker = CircuitBreaker("database", failure_threshold=1)
+        breaker.failure(Exception("down"))
+        with patch.object(API, 'database_breaker', breaker):
+            body = self.assertSameResponse("GET", "/api/v1.0/voting-data")
+            quart_status, _, quart_headers = self.quart("GET", "/api/v1.0/voting-data")
+        self.assertEqual(quart_status, 503)
+        self.assertIn("database is unavailable", body["message"])
+        self.assertIn("Retry-After", quart_headers)
+
+    def test_async_engine_errors_count_towards_the_breaker(self):
+        async def failing_query():
+            try:
+                async with AsyncAPI.AsyncSession() as session:
+                    await session.execute(text("SELECT * FROM missing_table"))
+            finally:
+                await AsyncAPI.async_engine.dispose()
+
+        failures = API.database_breaker.failures
+        try:
+            with self.assertRaises(OperationalError):
+                asyncio.run(failing_query())
+            self.assertEqual(API.database_breaker.failures, failures + 1)
+        finally:
+            API.database_breaker.success()
+
+    def test_reads_use_a_replica_unless_the_caller_just_wrote(self):
+        directory = tempfile.mkdtemp()
+        url = f"sqlite:///{os.path.join(directory, 'replica.db')}"
+        replica_engine = create_engine(url)
+        Base.metadata.create_all(replica_engine)
+        with replica_engine.begin() as connection:
+            connection.execute(Party.__table__.insert()
+                               .values(party_id=1, party_name="Replica", image="", manifesto=""))
+        replica_engine.dispose()
+
+        async_engine = AsyncAPI.make_async_engine(AsyncAPI.async_url(url))
+        replica = SimpleNamespace(url=url)
+        sessions = {url: async_sessionmaker(async_engine, expire_on_commit=False)}
+        try:
+            with patch.object(API.replica_set, 'choose_replica', return_value=replica), \
+                    patch.dict(AsyncAPI.ReplicaSessions, sessions):
+                self.assertEqual(self.quart("GET", "/api/v1.0/parties/1")[1]["party_name"], "Replica")
+                with patch.object(API.replica_set, 'recently_wrote', return_value=True):
+                    _, body, _ = self.quart("GET", "/api/v1.0/parties/1", headers=self.auth())
+                self.assertEqual(body["party_name"], "Party")
+        finally:
+            asyncio.run(async_engine.dispose())
+            shutil.rmtree(directory)
+
+    def test_security_headers_and_https_redirect(self):
+        _, _, flask_headers = self.flask("GET", "/api/v1.0/parties")
+        _, _, quart_headers = self.quart("GET", "/api/v1.0/parties")
+        for header in ("Strict-Transport-Security", "X-Frame-Options", "X-Content-Type-Options",
+                       "Content-Security-Policy", "Referrer-Policy", "Permissions-Policy"):
+            self.assertEqual(quart_headers.get(header), flask_headers.get(header), header)
+
+        flask_status, _, flask_headers = self.flask("GET", "/api/v1.0/parties", scheme='http')
+        quart_status, _, quart_headers = self.quart("GET", "/api/v1.0/parties", scheme='http')
+        self.assertEqual((quart_status, quart_headers.get("Location")), (flask_status, flask_headers.get("Location")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import random
+import time
+import unittest
+
+from Counting import BallotSet, PlusMinusCount, STVCount, pack_preferences, unpack_preferences
+from Helpers import apply_vote_to_tally, get_vote_count
+from Models import Candidate, Votes
+from testing_db import create_session_factory, add_election, add_constituencies, add_party, add_candidate, add_voters
+
+
+class TestCounting(unittest.TestCase):
+
+    def test_pack_preferences_round_trip(self):
+        preferences = [4, 1, 70000]
+
+        result = list(unpack_preferences(pack_preferences(preferences)))
+        self.assertEqual(result, preferences)
+
+    def test_ballot_set_merges_identical_rankings(self):
+        ballots = BallotSet()
+        ballots.add([1, 2, 3])
+        ballots.add([1, 2, 3])
+        ballots.add([2, 1])
+
+        self.assertEqual(len(ballots), 2)
+        self.assertEqual(ballots.total(), 3)
+
+    def test_plus_minus_count_floors_at_zero(self):
+        result = PlusMinusCount().count({1: 5, 2: -3, 3: 2}, [1, 2, 3], 2)
+
+        self.assertEqual(result['elected'], [1, 3])
+        self.assertEqual(result['rounds'][0]['tallies'][2], 0)
+
+    def test_plus_minus_recount_matches_the_live_tally(self):
+        # The negative vote arrives while the candidate is on zero, so it is dropped live and on recount
+        session = create_session_factory()()
+        add_election(session)
+        add_constituencies(session)
+        add_party(session)
+        add_candidate(session, 1)
+        add_voters(session, (1, 2, 3))
+        session.flush()
+        for voter_id, vote_type in ((1, -1), (2, 1), (3, 1)):
+            session.add(Votes(election_id=1, voter_id=voter_id, candidate_id=1, vote_type=vote_type, slot=0))
+            apply_vote_to_tally(session, 1, vote_type)
+        session.commit()
+
+        live = session.get(Candidate, 1).vote_count
+        self.assertEqual(live, 2)
+        self.assertEqual(PlusMinusCount().run(session, 1, 1)['rounds'][0]['tallies'], {1: live})
+        self.assertEqual(get_vote_count(1, session, 1), live)
+        session.close()
+
+    def test_stv_elects_on_first_preferences(self):
+        ballots = BallotSet()
+        ballots.add([1], 60)
+        ballots.add([2], 30)
+        ballots.add([3], 10)
+
+        result = STVCount().count(ballots, [1, 2, 3], 1)
+        self.assertEqual(result['quota'], 51)
+        self.assertEqual(result['elected'], [1])
+
+    def test_stv_transfers_surplus(self):
+        # Candidate 1 has a surplus of 9 which all goes to candidate 3, lifting
+        # them above candidate 2 for the second seat
+        ballots = BallotSet()
+        ballots.add([1, 3], 30)
+        ballots.add([2], 11)
+        ballots.add([3], 7)
+        ballots.add([4], 12)
+
+        result = STVCount().count(ballots, [1, 2, 3, 4], 2)
+        self.assertEqual(result['quota'], 21)
+        self.assertEqual(result['elected'], [1, 3])
+        self.assertEqual(result['rounds'][1]['tallies'][3], 16)
+
+    def test_stv_transfers_excluded_ballots(self):
+        ballots = BallotSet()
+        ballots.add([1], 40)
+        ballots.add([2], 35)
+        ballots.add([3, 2], 25)
+
+        result = STVCount().count(ballots, [1, 2, 3], 1)
+        self.assertEqual(result['rounds'][0]['excluded'], [3])
+        self.assertEqual(result['elected'], [2])
+
+    def test_stv_exhausted_ballots(self):
+        ballots = BallotSet()
+        ballots.add([1], 40)
+        ballots.add([2], 35)
+        ballots.add([3], 25)
+
+        result = STVCount().count(ballots, [1, 2, 3], 1)
+        self.assertEqual(result['rounds'][1]['exhausted'], 25)
+        self.assertEqual(result['elected'], [1])
+
+    def test_stv_fills_remaining_seats(self):
+        ballots = BallotSet()
+        ballots.add([1], 3)
+        ballots.add([2], 2)
+
+        result = STVCount().count(ballots, [1, 2], 2)
+        self.assertEqual(result['elected'], [1, 2])
+
+    def test_stv_large_count_finishes_quickly(self):
+        generator = random.Random(1)
+        candidates = list(range(1, 16))
+        ballots = BallotSet()
+        for _ in range(300000):
+            ballots.add(generator.sample(candidates, generator.randint(1, 6)))
+
+        start = time.perf_counter()
+        result = STVCount().count(ballots, candidates, 5)
+        self.assertEqual(len(result['elected']), 5)
+        self.assertLess(time.perf_counter() - start, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+
+from Counting import PlusMinusCount
+from Elections import active_election_id, latest_election_id, start_election, close_election, load_results, \
+    open_first_election
+from Models import Candidate, Votes, Election
+from Turnout import record_vote, record_registration, load_turnout
+from testing_db import create_session_factory, add_constituencies, add_party, add_candidate, add_voter, add_voters
+
+
+class TestElections(unittest.TestCase):
+
+    def setUp(self):
+        self.session = create_session_factory()()
+        add_constituencies(self.session)
+        add_party(self.session)
+        for candidate_id in (1, 2):
+            add_candidate(self.session, candidate_id)
+        add_voters(self.session, (1, 2))
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def vote(self, election_id, voter_id, candidate_id):
+        self.session.add(Votes(election_id=election_id, voter_id=voter_id, candidate_id=candidate_id,
+                               vote_type=1, slot=0))
+        self.session.query(Candidate).filter(Candidate.candidate_id == candidate_id) \
+            .update({Candidate.vote_count: Candidate.vote_count + 1})
+        record_vote(self.session, voter_id, election_id)
+        self.session.commit()
+
+    def open_first(self):
+        election_id = open_first_election(self.session, "Assembly election").election_id
+        self.session.commit()
+        return election_id
+
+    def test_first_election_is_only_opened_explicitly(self):
+        self.assertIsNone(active_election_id(self.session))
+        self.assertEqual(self.session.query(Election).count(), 0)
+
+        first = self.open_first()
+        self.assertIsNone(open_first_election(self.session, "Again"))
+
+        # A registration is counted once, looking up the election never commits the new voter
+        add_voter(self.session, 3)
+        record_registration(self.session, active_election_id(self.session), 1)
+        self.session.rollback()
+        self.assertEqual(load_turnout(self.session, first)["registered"], 2)
+
+    def test_new_election_starts_empty_and_keeps_the_old_one(self):
+        first = self.open_first()
+        self.vote(first, 1, 1)
+        self.vote(first, 2, 1)
+
+        second = start_election(self.session, "By-election").election_id
+        self.session.commit()
+        self.vote(second, 1, 2)
+
+        self.assertEqual(active_election_id(self.session), second)
+        self.assertEqual([(row["registered"], row["voted"])
+                          for row in load_turnout(self.session, second)["constituencies"]], [(2, 1)])
+        self.assertEqual(load_turnout(self.session, first)["voted"], 2)
+        self.assertEqual(PlusMinusCount().run(self.session, first, 1, 1)["elected"], [1])
+        self.assertEqual(PlusMinusCount().run(self.session, second, 1, 1)["elected"], [2])
+        self.assertEqual([c["vote_count"] for c in load_results(self.session, self.session.get(Election, first))
+                          ["candidates"]], [2, 0])
+        self.assertEqual(self.session.query(Votes).count(), 3)
+
+    def test_no_election_is_open_after_closing(self):
+        election = self.session.get(Election, self.open_first())
+        close_election(self.session, election)
+        self.session.commit()
+
+        self.assertIsNone(active_election_id(self.session))
+        self.assertEqual(latest_election_id(self.session), election.election_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
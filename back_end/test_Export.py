@@ -0,0 +1,96 @@
+import csv
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import Export
+from Models import Votes
+from testing_db import create_session_factory, add_election, add_constituencies, add_party, add_candidate, add_voter
+
+# The columns every consumer of the exports reads, in order. Changing these is a breaking change.
+COLUMNS = {
+    'votes': ['vote_id', 'election_id', 'voter_id', 'candidate_id', 'vote_type', 'constituency_id'],
+    'candidates': ['candidate_id', 'candidate_firstname', 'candidate_lastname', 'party_id', 'party_name',
+                   'constituency_id', 'vote_count'],
+    'voters': ['voter_id', 'first_name', 'last_name', 'gov_id', 'email', 'constituency_id', 'isAdmin']
+}
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.session = create_session_factory()()
+        self.out_dir = tempfile.mkdtemp()
+
+        add_election(self.session)
+        add_constituencies(self.session, 2)
+        add_party(self.session, party_name="Party, with a comma")
+        for candidate_id in range(1, 4):
+            add_candidate(self.session, candidate_id, 1 if candidate_id < 3 else 2, vote_count=candidate_id)
+        for voter_id in range(1, 6):
+            add_voter(self.session, voter_id, 1 if voter_id < 4 else 2, password="secret", isAdmin=voter_id == 1)
+            self.session.add(Votes(election_id=1, voter_id=voter_id, candidate_id=1 if voter_id < 4 else 3,
+                                   vote_type=1 if voter_id % 2 else -1, slot=0))
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+        shutil.rmtree(self.out_dir)
+
+    def rows(self, table, constituency_id=None):
+        # What the export should contain, straight from the database
+        query = Export.base_query(self.session, table)
+        if constituency_id is not None:
+            query = query.filter(Export.EXPORTS[table][1] == constituency_id)
+        return [tuple(row) for row in query.order_by(Export.EXPORTS[table][0])]
+
+    def read_csv(self, text):
+        return list(csv.reader(io.StringIO(text)))
+
+    def test_column_set_is_stable(self):
+        self.assertEqual({table: Export.column_names(table) for table in Export.EXPORTS}, COLUMNS)
+        for table, columns in COLUMNS.items():
+            self.assertEqual(self.read_csv("".join(Export.stream_csv(self.session, table)))[0], columns)
+            self.assertNotIn('password', columns)
+
+    def test_chunks_cover_every_row_once(self):
+        for table in COLUMNS:
+            chunks = list(Export.iter_chunks(self.session, table, chunk_size=2))
+            self.assertTrue(all(len(chunk) <= 2 for chunk in chunks))
+            self.assertEqual([tuple(row) for chunk in chunks for row in chunk], self.rows(table))
+
+    def test_csv_matches_database_rows(self):
+        for table in COLUMNS:
+            path = Export.export(self.session, table, 'csv', self.out_dir)[0]
+            with open(path, newline='') as file:
+                written = self.read_csv(file.read())
+            self.assertEqual(written[1:], [[str(value) for value in row] for row in self.rows(table)], table)
+
+    def test_partitioned_csv_matches_each_constituency(self):
+        paths = Export.export(self.session, 'votes', 'csv', self.out_dir, partition=True)
+
+        self.assertEqual(paths, [os.path.join(self.out_dir, 'votes', f"constituency_id={constituency_id}",
+                                              'part.csv') for constituency_id in (1, 2)])
+        for constituency_id, path in zip((1, 2), paths):
+            with open(path, newline='') as file:
+                written = self.read_csv(file.read())
+            self.assertEqual(written[0], COLUMNS['votes'])
+            self.assertEqual(written[1:], [[str(value) for value in row]
+                                           for row in self.rows('votes', constituency_id)])
+
+    @unittest.skipIf(Export.pyarrow is None, "needs pyarrow installed")
+    def test_parquet_matches_database_rows(self):
+        for table, columns in COLUMNS.items():
+            path = Export.export(self.session, table, 'parquet', self.out_dir)[0]
+            written = Export.pyarrow.parquet.read_table(path)
+
+            self.assertEqual(written.schema, Export.parquet_schema(table))
+            self.assertEqual(written.column_names, columns)
+            self.assertEqual([tuple(row[name] for name in columns) for row in written.to_pylist()],
+                             self.rows(table), table)
+
+
+if __name__ == '__main__':
+    unittest.main()
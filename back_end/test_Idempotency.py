@@ -0,0 +1,156 @@
+import unittest
+
+import API
+import Elections
+import Helpers
+import Models
+from Idempotency import IdempotencyStore, KeyReused, request_hash
+from Models import Base, Candidate, Votes, IdempotencyKey
+from RateLimiter import create_bucket_store
+from testing_db import create_session_factory, add_constituencies, add_party, add_candidate, add_voter
+
+
+class TestIdempotencyStore(unittest.TestCase):
+
+    def setUp(self):
+        self.session_factory = create_session_factory()
+        self.session = self.session_factory()
+        self.session.add_all([Votes(vote_id=7, election_id=1, voter_id=1, candidate_id=1, vote_type=1, slot=0),
+                              Votes(vote_id=8, election_id=2, voter_id=1, candidate_id=1, vote_type=1, slot=0)])
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def record(self, store, key, vote_id, body):
+        store.record(self.session, 1, key, vote_id, request_hash(body))
+        self.session.commit()
+
+    def test_request_hash_ignores_key_order(self):
+        self.assertEqual(request_hash({"candidate_id": 1, "vote_type": 1}),
+                         request_hash({"vote_type": 1, "candidate_id": 1}))
+        self.assertNotEqual(request_hash({"candidate_id": 1, "vote_type": 1}),
+                            request_hash({"candidate_id": 2, "vote_type": 1}))
+
+    def test_repeated_key_returns_the_same_vote(self):
+        self.record(IdempotencyStore(self.session_factory), "key-1", 7, {"candidate_id": 1})
+
+        # Another worker only has the table to go on, then answers from its cache
+        store = IdempotencyStore(self.session_factory)
+        self.assertEqual(store.lookup(self.session, 1, "key-1", request_hash({"candidate_id": 1})), 7)
+        self.assertEqual(store.cached(self.session, 1, "key-1", request_hash({"candidate_id": 1})), 7)
+        self.assertIsNone(store.lookup(self.session, 2, "key-1", request_hash({"candidate_id": 1})))
+
+    def test_different_request_under_the_same_key_is_refused(self):
+        self.record(IdempotencyStore(self.session_factory), "key-1", 7, {"candidate_id": 1})
+
+        store = IdempotencyStore(self.session_factory)
+        with self.assertRaises(KeyReused):
+            store.lookup(self.session, 1, "key-1", request_hash({"candidate_id": 2}))
+        with self.assertRaises(KeyReused):
+            store.cached(self.session, 1, "key-1", request_hash({"candidate_id": 2}))
+
+    def test_keys_stored_before_hashing_match_any_request(self):
+        store = IdempotencyStore(self.session_factory)
+        store.record(self.session, 1, "key-1", 7)
+        self.session.commit()
+
+        self.assertEqual(store.lookup(self.session, 1, "key-1", request_hash({"candidate_id": 2})), 7)
+
+    def test_deleted_vote_is_not_replayed_from_another_workers_cache(self):
+        deleting, other = IdempotencyStore(self.session_factory), IdempotencyStore(self.session_factory)
+        self.record(deleting, "key-1", 7, {"candidate_id": 1})
+        self.record(deleting, "key-2", 8, {"candidate_id": 1})
+        for store in (deleting, other):
+            store.lookup(self.session, 1, "key-1")
+            store.lookup(self.session, 1, "key-2")
+
+        deleting.delete_vote(self.session, 7)
+        self.session.query(Votes).filter_by(vote_id=7).delete()
+        self.session.commit()
+
+        # Only the deleted vote's key is forgotten, the other worker finds out its row is gone
+        self.assertEqual(((1, "key-1") in deleting.cache, (1, "key-2") in deleting.cache), (False, True))
+        self.assertIsNone(other.cached(self.session, 1, "key-1"))
+        self.assertIsNone(other.lookup(self.session, 1, "key-1"))
+        self.assertEqual(other.cached(self.session, 1, "key-2"), 8)
+
+    def test_clear_only_deletes_the_election_being_reset(self):
+        store = IdempotencyStore(self.session_factory)
+        self.record(store, "key-1", 7, {"candidate_id": 1})
+        self.record(store, "key-2", 8, {"candidate_id": 1})
+        store.lookup(self.session, 1, "key-1")
+        store.lookup(self.session, 1, "key-2")
+
+        store.clear(self.session, 1)
+        self.session.commit()
+
+        self.assertEqual(self.session.query(IdempotencyKey.key).all(), [("key-2",)])
+        self.assertEqual(((1, "key-1") in store.cache, (1, "key-2") in store.cache), (False, True))
+
+    def test_keys_expire(self):
+        store = IdempotencyStore(self.session_factory, ttl=0)
+        self.record(store, "key-1", 7, {"candidate_id": 1})
+
+        self.assertIsNone(store.lookup(self.session, 1, "key-1", request_hash({"candidate_id": 1})))
+        self.assertEqual(store.sweep(), 1)
+        self.assertEqual(self.session.query(IdempotencyKey).count(), 0)
+
+
+@unittest.skipUnless(Models.engine.dialect.name == 'sqlite', "needs DATABASE_URL to be a SQLite file")
+class TestIdempotentVotes(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        Base.metadata.create_all(Models.engine)
+        session = API.Session()
+        add_constituencies(session)
+        add_party(session)
+        for candidate_id in (1, 2):
+            add_candidate(session, candidate_id)
+        voter = add_voter(session, 1, gov_id="12345678")
+        session.flush()
+        Elections.open_first_election(session)
+        session.commit()
+        app = API.create_app()
+        with app.app_context():
+            cls.token = API.create_access_token(identity="12345678", additional_claims=Helpers.identity_claims(voter))
+        API.Session.remove()
+        cls.client = app.test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        API.Session.remove()
+        Base.metadata.drop_all(Models.engine)
+
+    def setUp(self):
+        API.limiter.store = create_bucket_store()
+
+    def vote(self, body, key):
+        return self.client.post("/api/v1.0/votes", json=body, base_url="https://localhost",
+                                headers={"Authorization": f"Bearer {self.token}", "Idempotency-Key": key})
+
+    def test_retried_vote_is_replayed_and_counted_once(self):
+        first = self.vote({"candidate_id": 1, "vote_type": 1}, "retry-1")
+        retry = self.vote({"vote_type": 1, "candidate_id": 1}, "retry-1")
+
+        self.assertEqual((first.status_code, retry.status_code), (201, 201))
+        self.assertEqual(retry.get_json()["vote_id"], first.get_json()["vote_id"])
+        self.assertEqual(retry.headers.get("Idempotent-Replayed"), "true")
+        session = API.Session()
+        self.assertEqual(session.query(Votes).filter_by(candidate_id=1).count(), 1)
+        self.assertEqual(session.get(Candidate, 1).vote_count, 1)
+        API.Session.remove()
+
+    def test_key_reused_for_another_vote_is_refused(self):
+        self.assertEqual(self.vote({"candidate_id": 2, "vote_type": -1}, "reused-1").status_code, 201)
+
+        response = self.vote({"candidate_id": 1, "vote_type": -1}, "reused-1")
+        self.assertEqual(response.status_code, 422)
+        session = API.Session()
+        self.assertEqual(session.query(Votes).filter_by(vote_type=-1).count(), 1)
+        API.Session.remove()
+
+
+if __name__ == '__main__':
+    unittest.main()
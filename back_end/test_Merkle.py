@@ -0,0 +1,83 @@
+import unittest
+
+from Merkle import MerkleAppender, inclusion_proof, verify_inclusion, audit, load_root, hash_node, vote_leaf, new_tree
+from Models import Votes
+from testing_db import create_session_factory, add_election, add_constituencies, add_party, add_candidate, add_voters
+
+
+def tree_hash(leaves):
+    # RFC 9162 definition of the root, computed from scratch
+    if len(leaves) == 1:
+        return leaves[0]
+    split = 1 << ((len(leaves) - 1).bit_length() - 1)
+    return hash_node(tree_hash(leaves[:split]), tree_hash(leaves[split:]))
+
+
+class TestMerkle(unittest.TestCase):
+
+    def setUp(self):
+        session_factory = create_session_factory()
+        self.session = session_factory()
+        self.appender = MerkleAppender(session_factory, batch_size=4)
+
+        add_election(self.session)
+        self.session.add(new_tree(1))
+        add_constituencies(self.session)
+        add_party(self.session)
+        add_candidate(self.session, 1)
+        add_voters(self.session, range(1, 21))
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def cast(self, voter_ids):
+        votes = [Votes(election_id=1, voter_id=voter_id, candidate_id=1, vote_type=1, slot=0)
+                 for voter_id in voter_ids]
+        self.session.add_all(votes)
+        self.session.commit()
+        # A vote is stored before it is in the tree
+        self.assertIsNone(inclusion_proof(self.session, votes[0]))
+        self.assertEqual(self.appender.append(), len(votes))
+        self.session.expire_all()
+        return votes
+
+    def test_every_vote_has_a_valid_proof(self):
+        votes = self.cast([1])
+        for voter_id in range(2, 14, 3):
+            votes += self.cast(range(voter_id, voter_id + 3))
+
+        root = load_root(self.session, 1)
+        self.assertEqual(root["size"], 13)
+        self.assertEqual(root["root"], tree_hash([vote_leaf(vote) for vote in votes]).hex())
+        for vote in votes:
+            proof = inclusion_proof(self.session, vote)
+            self.assertTrue(verify_inclusion(bytes.fromhex(proof["leaf"]), proof["leaf_index"], proof["tree_size"],
+                                             [bytes.fromhex(node) for node in proof["path"]],
+                                             bytes.fromhex(proof["root"])))
+            self.assertLessEqual(len(proof["path"]), 4)
+
+        self.assertFalse(verify_inclusion(vote_leaf(votes[1]), 0, 13,
+                                          [bytes.fromhex(node) for node in inclusion_proof(self.session, votes[0])
+                                           ["path"]], bytes.fromhex(root["root"])))
+
+    def test_audit_finds_altered_and_deleted_votes(self):
+        votes = self.cast(range(1, 8))
+        report, checkpoint = audit(self.session, 1)
+        self.assertEqual((report["checked"], report["mismatched"], report["root_matches"]), (7, [], True))
+
+        self.cast(range(8, 11))
+        votes[2].candidate_id = 2
+        self.session.delete(votes[3])
+        self.session.commit()
+
+        # Only the new votes are read again
+        report, _ = audit(self.session, 1, checkpoint)
+        self.assertEqual((report["checked"], report["root_matches"]), (3, True))
+
+        report, _ = audit(self.session, 1)
+        self.assertEqual((report["mismatched"], report["missing"]), ([votes[2].vote_id], [3]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, Boolean, DateTime, ForeignKey, \
+    inspect, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from Migrations import migrate, MIGRATIONS
+from Models import Election, Votes, Voter, Turnout
+
+
+def original_schema():
+    # The tables as they were before elections, slots and OTP expiry
+    metadata = MetaData()
+    Table('Constituency', metadata, Column('constituency_id', Integer, primary_key=True),
+          Column('constituency_name', String))
+    Table('Voter', metadata, Column('voter_id', Integer, primary_key=True),
+          Column('first_name', String, nullable=False), Column('last_name', String, nullable=False),
+          Column('gov_id', String, unique=True, nullable=False), Column('password', String, nullable=False),
+          Column('constituency_id', Integer, ForeignKey('Constituency.constituency_id'), nullable=False),
+          Column('email', String, unique=True, nullable=False), Column('isAdmin', Boolean))
+    Table('Verification', metadata, Column('id', Integer, primary_key=True),
+          Column('email', String, unique=True, nullable=False), Column('otp', String, unique=True, nullable=False))
+    Table('Party', metadata, Column('party_id', Integer, primary_key=True),
+          Column('party_name', String, unique=True, nullable=False), Column('image', String, nullable=False),
+          Column('manifesto', String, nullable=False))
+    Table('Candidate', metadata, Column('candidate_id', Integer, primary_key=True),
+          Column('candidate_firstname', String, nullable=False), Column('candidate_lastname', String, nullable=False),
+          Column('party_id', Integer, ForeignKey('Party.party_id'), nullable=False),
+          Column('vote_count', Integer), Column('image', String, nullable=False),
+          Column('constituency_id', Integer, ForeignKey('Constituency.constituency_id'), nullable=False),
+          Column('statement', String, nullable=False))
+    Table('Votes', metadata, Column('vote_id', Integer, primary_key=True),
+          Column('voter_id', Integer, ForeignKey('Voter.voter_id'), nullable=False),
+          Column('candidate_id', Integer, ForeignKey('Candidate.candidate_id'), nullable=False),
+          Column('vote_type', Integer, nullable=False))
+    return metadata
+
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+        metadata = original_schema()
+        metadata.create_all(self.engine)
+        tables = metadata.tables
+        with self.engine.begin() as connection:
+            connection.execute(insert(tables['Constituency']), [{'constituency_id': 1, 'constituency_name': "C"}])
+            connection.execute(insert(tables['Party']), [{'party_id': 1, 'party_name': "P", 'image': "",
+                                                          'manifesto': ""}])
+            connection.execute(insert(tables['Candidate']), [
+                {'candidate_id': c, 'candidate_firstname': "F", 'candidate_lastname': "L", 'party_id': 1,
+                 'vote_count': 1, 'image': "", 'constituency_id': 1, 'statement': ""} for c in (1, 2, 3)])
+            connection.execute(insert(tables['Voter']), [
+                {'voter_id': v, 'first_name': "F", 'last_name': "L", 'gov_id': str(v), 'password': "",
+                 'constituency_id': 1, 'email': f"{v}@example.com"} for v in (1, 2)])
+            connection.execute(insert(tables['Votes']), [
+                {'voter_id': 1, 'candidate_id': 1, 'vote_type': 1},
+                {'voter_id': 1, 'candidate_id': 2, 'vote_type': 1},
+                {'voter_id': 1, 'candidate_id': 3, 'vote_type': -1}])
+            connection.execute(insert(tables['Verification']), [{'email': "a@b.com", 'otp': "123456"}])
+
+    def test_existing_votes_move_into_the_first_election(self):
+        # SQLite keeps the constraints it has, and tables that did not exist are created with every column
+        self.assertEqual({name for name, _ in MIGRATIONS} - set(migrate(self.engine)),
+                         {"add NOT NULL and foreign key constraints", "add NotificationJob leases",
+                          "add IdempotencyKey.request_hash", "add IdempotencyKey.journal_id"})
+
+        session = sessionmaker(bind=self.engine)()
+        [election] = session.query(Election).all()
+        self.assertIsNone(election.closed_at)
+        self.assertEqual([(vote.election_id, vote.vote_type, vote.slot, vote.leaf_index)
+                          for vote in session.query(Votes).order_by(Votes.vote_id)],
+                         [(election.election_id, 1, 0, None), (election.election_id, 1, 1, None),
+                          (election.election_id, -1, 0, None)])
+        self.assertEqual([voter.voted_in for voter in session.query(Voter).order_by(Voter.voter_id)],
+                         [election.election_id, None])
+        self.assertEqual([(row.registered, row.voted) for row in session.query(Turnout)], [(2, 1)])
+        self.assertIn('attempts', {column['name'] for column in inspect(self.engine).get_columns('Verification')})
+
+        session.add(Votes(election_id=election.election_id, voter_id=1, candidate_id=1, vote_type=1, slot=1))
+        with self.assertRaises(IntegrityError):
+            session.flush()
+        session.close()
+
+        # Nothing is left to do the second time
+        self.assertEqual(migrate(self.engine), [])
+
+    def test_notification_jobs_get_leases(self):
+        Table('NotificationJob', MetaData(), Column('job_id', Integer, primary_key=True),
+              Column('subject', String, nullable=False), Column('body', String, nullable=False),
+              Column('constituency_id', Integer), Column('status', String(16), nullable=False),
+              Column('total', Integer, nullable=False), Column('last_voter_id', Integer, nullable=False),
+              Column('sent', Integer, nullable=False), Column('failed', Integer, nullable=False),
+              Column('created_at', DateTime, nullable=False), Column('updated_at', DateTime, nullable=False)) \
+            .create(self.engine)
+
+        self.assertIn("add NotificationJob leases", migrate(self.engine))
+        self.assertLessEqual({'lease_owner', 'lease_expires_at'},
+                             {column['name'] for column in inspect(self.engine).get_columns('NotificationJob')})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+import sys
+import threading
+import time
+import types
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from Models import NotificationJob
+from CircuitBreaker import CircuitOpen
+from Notifications import NotificationSender, SinkTransport, GmailTransport
+from testing_db import create_session_factory, add_constituencies, add_voter
+
+
+class RecordingTransport(SinkTransport):
+
+    def __init__(self, stop_after=None, hold=False):
+        super().__init__()
+        self.messages = []
+        self.stop_after = stop_after
+        self.stop = threading.Event()
+        # With hold, sends after stop_after wait until release is set
+        self.release = threading.Event()
+        if not hold:
+            self.release.set()
+
+    def send(self, destination, subject, body):
+        super().send(destination, subject, body)
+        with self.lock:
+            self.messages.append((destination, subject, body))
+            if self.stop_after is not None and self.sent >= self.stop_after:
+                self.stop.set()
+        if self.stop.is_set():
+            self.release.wait()
+
+
+class TestNotifications(unittest.TestCase):
+
+    def setUp(self):
+        self.session_factory = create_session_factory()
+
+        session = self.session_factory()
+        add_constituencies(session, 2)
+        for voter_id in range(1, 101):
+            add_voter(session, voter_id, 1 + voter_id % 2, first_name=f"F{voter_id}")
+        session.commit()
+        session.close()
+
+    def create_job(self, sender, constituency_id=None):
+        session = self.session_factory()
+        try:
+            return sender.create_job(session, "Polls open in $constituency_name", "Hello $first_name",
+                                     constituency_id).job_id
+        finally:
+            session.close()
+
+    def job(self, job_id):
+        session = self.session_factory()
+        try:
+            return session.get(NotificationJob, job_id)
+        finally:
+            session.close()
+
+    def test_sends_rendered_message_to_each_voter(self):
+        transport = RecordingTransport()
+        sender = NotificationSender(self.session_factory, transport, workers=4, rate=10000, chunk_size=7)
+        job_id = self.create_job(sender, constituency_id=2)
+
+        self.assertEqual(sender.run(job_id), 'done')
+        self.assertEqual(len(transport.messages), 50)
+        self.assertIn(("3@example.com", "Polls open in Foyle", "Hello F3"), transport.messages)
+        job = self.job(job_id)
+        self.assertEqual((job.total, job.sent, job.failed, job.last_voter_id), (50, 50, 0, 99))
+
+    def test_paused_job_resumes_from_checkpoint(self):
+        transport = RecordingTransport(stop_after=30)
+        sender = NotificationSender(self.session_factory, transport, workers=4, rate=10000, chunk_size=10)
+        job_id = self.create_job(sender)
+
+        self.assertEqual(sender.run(job_id, transport.stop), 'paused')
+        self.assertEqual(self.job(job_id).sent, 30)
+
+        session = self.session_factory()
+        try:
+            self.assertTrue(sender.requeue(session, job_id))
+        finally:
+            session.close()
+        self.assertEqual(sender.run(job_id), 'done')
+        self.assertEqual(sorted(destination for destination, _, _ in transport.messages),
+                         sorted(f"{v}@example.com" for v in range(1, 101)))
+        self.assertEqual(self.job(job_id).sent, 100)
+
+    def test_pause_from_another_worker_stops_the_job(self):
+        transport = RecordingTransport(stop_after=30, hold=True)
+        worker = NotificationSender(self.session_factory, transport, workers=4, rate=10000, chunk_size=10)
+        other = NotificationSender(self.session_factory, transport, workers=4, rate=10000, chunk_size=10)
+        job_id = self.create_job(worker)
+
+        statuses = []
+        thread = threading.Thread(target=lambda: statuses.append(worker.run(job_id)))
+        thread.start()
+        transport.stop.wait()
+        session = self.session_factory()
+        try:
+            self.assertTrue(other.pause(session, job_id))
+        finally:
+            session.close()
+        transport.release.set()
+        thread.join()
+
+        job = self.job(job_id)
+        self.assertEqual((statuses, job.status, job.lease_owner), (['paused'], 'paused', None))
+        self.assertLess(job.sent, 100)
+
+        session = self.session_factory()
+        try:
+            self.assertTrue(other.requeue(session, job_id))
+        finally:
+            session.close()
+        self.assertEqual(other.run(job_id), 'done')
+        self.assertEqual(self.job(job_id).sent, 100)
+
+    def test_job_is_taken_over_once_its_lease_runs_out(self):
+        first = NotificationSender(self.session_factory, RecordingTransport(), rate=10000, chunk_size=10)
+        second = NotificationSender(self.session_factory, RecordingTransport(), rate=10000, chunk_size=10)
+        job_id = self.create_job(first)
+
+        session = self.session_factory()
+        try:
+            self.assertTrue(first.claim(session, job_id))
+            self.assertIsNone(second.run(job_id))
+
+            # The first worker stopped without releasing the job
+            session.get(NotificationJob, job_id).lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+            session.commit()
+        finally:
+            session.close()
+
+        self.assertEqual(second.run(job_id), 'done')
+        # Progress from the worker that lost the job is not written over the new one
+        session = self.session_factory()
+        try:
+            self.assertIsNone(first.save_progress(session, job_id, 10, 0, 10))
+        finally:
+            session.close()
+        self.assertEqual((self.job(job_id).sent, self.job(job_id).last_voter_id), (100, 100))
+
+    def test_lease_is_kept_while_waiting_on_an_open_breaker(self):
+        transport = RecordingTransport()
+        send = transport.send
+        calls = []
+
+        def breaker_open_once(destination, subject, body):
+            calls.append(destination)
+            if len(calls) == 1:
+                raise CircuitOpen("gmail-notifications", 1)
+            send(destination, subject, body)
+
+        transport.send = breaker_open_once
+        worker = NotificationSender(self.session_factory, transport, workers=1, rate=10000, chunk_size=10,
+                                    lease_seconds=0.3)
+        other = NotificationSender(self.session_factory, RecordingTransport(), rate=10000, chunk_size=10)
+        job_id = self.create_job(worker)
+        self.assertTrue(worker.start(job_id))
+
+        # Well past the lease, but the worker is still waiting for the breaker to close
+        time.sleep(0.6)
+        self.assertIsNone(other.run(job_id))
+        deadline = time.monotonic() + 10
+        while self.job(job_id).status == 'running' and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual((self.job(job_id).status, self.job(job_id).sent), ('done', 100))
+
+    def test_gmail_credentials_are_loaded_once_per_process(self):
+        google = types.SimpleNamespace(gmail_credentials=lambda: time.sleep(0.05) or object(),
+                                       gmail_service=lambda creds: creds,
+                                       send_message=lambda service, destination, subject, body: None)
+        loads = []
+        gmail_credentials = google.gmail_credentials
+        google.gmail_credentials = lambda: loads.append(1) or gmail_credentials()
+
+        with patch.dict(sys.modules, {'GoogleAPI': google}):
+            transport = GmailTransport()
+        threads = [threading.Thread(target=transport.send, args=("a@b.com", "Subject", "Body")) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(loads), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from Models import Voter, Votes
+from Turnout import record_registration, record_vote, record_removal, rebuild, load_turnout
+from testing_db import create_session_factory, add_election, add_constituencies, add_party, add_candidate, add_voter
+
+
+class TestTurnout(unittest.TestCase):
+
+    def setUp(self):
+        self.session = create_session_factory()()
+        add_election(self.session)
+        add_constituencies(self.session, 2)
+        add_party(self.session)
+        add_candidate(self.session, 1)
+        for voter_id in range(1, 5):
+            add_voter(self.session, voter_id, 1 if voter_id < 4 else 2)
+            record_registration(self.session, 1, 1 if voter_id < 4 else 2)
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_voter_is_counted_once_however_many_votes(self):
+        for slot in range(2):
+            self.session.add(Votes(election_id=1, voter_id=1, candidate_id=1, vote_type=1, slot=slot))
+            record_vote(self.session, 1, 1)
+        self.session.add(Votes(election_id=1, voter_id=2, candidate_id=1, vote_type=1, slot=0))
+        record_vote(self.session, 2, 1)
+        self.session.commit()
+
+        turnout = load_turnout(self.session, 1)
+        self.assertEqual((turnout["registered"], turnout["voted"], turnout["turnout"]), (4, 2, 50.0))
+        self.assertEqual([(row["registered"], row["voted"]) for row in turnout["constituencies"]], [(3, 2), (1, 0)])
+
+    def test_rebuild_matches_incremental_counts(self):
+        self.session.add(Votes(election_id=1, voter_id=4, candidate_id=1, vote_type=1, slot=0))
+        record_vote(self.session, 4, 1)
+        record_removal(self.session, self.session.get(Voter, 3), 1)
+        self.session.query(Voter).filter(Voter.voter_id == 3).delete()
+        self.session.commit()
+        incremental = load_turnout(self.session, 1)
+
+        rebuild(self.session, 1)
+        self.assertEqual(load_turnout(self.session, 1), incremental)
+        self.assertEqual(incremental["constituencies"][1]["turnout"], 100.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from Idempotency import IdempotencyStore
+from Models import Candidate, Votes, IdempotencyKey, RejectedVote
+from VoteJournal import VoteJournal, JournalReplayer, encode, decode, read_entries
+from testing_db import create_session_factory, add_election, add_constituencies, add_party, add_candidate, add_voters
+
+
+def apply_vote(session, candidate_id, vote_type):
+    session.query(Candidate).filter(Candidate.candidate_id == candidate_id) \
+        .update({Candidate.vote_count: Candidate.vote_count + vote_type}, synchronize_session=False)
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+class TestVoteJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.session_factory = create_session_factory()
+
+        session = self.session_factory()
+        add_election(session)
+        add_constituencies(session)
+        add_party(session)
+        for candidate_id in (1, 2):
+            add_candidate(session, candidate_id)
+        add_voters(session, range(1, 1001))
+        session.commit()
+        session.close()
+
+        self.journal = VoteJournal(self.directory)
+        self.replayer = JournalReplayer(self.directory, self.session_factory,
+                                        IdempotencyStore(self.session_factory), apply_vote, self.journal)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def tallies(self):
+        session = self.session_factory()
+        try:
+            return dict(session.query(Candidate.candidate_id, Candidate.vote_count)), session.query(Votes).count()
+        finally:
+            session.close()
+
+    def test_encode_decode_round_trip(self):
+        entry = {'id': 'a', 'voter_id': 1, 'candidate_id': 2, 'vote_type': 1, 'slot': 0, 'key': 'k'}
+        line = encode(entry)
+
+        self.assertEqual(decode(line), entry)
+        self.assertIsNone(decode(line.replace(b'"k"', b'"x"')))
+
+    def test_torn_last_record_is_ignored(self):
+        path = os.path.join(self.directory, 'segment.journal')
+        with open(path, 'wb') as segment:
+            segment.write(encode({'id': 'a'}) + encode({'id': 'b'}) + encode({'id': 'c'})[:10])
+
+        self.assertEqual([entry['id'] for entry, _ in read_entries(path)], ['a', 'b'])
+
+    def test_slots_are_claimed_across_pending_votes(self):
+        first = self.journal.accept(1, 1, 1, 1, 2, set())
+        second = self.journal.accept(1, 1, 2, 1, 2, set())
+
+        self.assertEqual((first['slot'], second['slot']), (0, 1))
+        self.assertIsNone(self.journal.accept(1, 1, 1, 1, 2, set()))
+        # A new election starts with every slot free
+        self.assertEqual(self.journal.accept(2, 1, 1, 1, 2, set())['slot'], 0)
+        self.assertIs(self.journal.accept(1, 1, 2, -1, 1, set(), key='retry'),
+                      self.journal.accept(1, 1, 2, -1, 1, set(), key='retry'))
+
+    def test_recovers_segment_left_open_by_crashed_process(self):
+        for voter_id in range(1, 11):
+            self.journal.accept(1, voter_id, 1, 1, 2, set())
+        self.journal.file.close()
+
+        # The segment now looks like it belongs to a process that died before rotating it
+        [path] = glob.glob(os.path.join(self.directory, '*.open'))
+        name = os.path.basename(path).split('-')
+        os.rename(path, os.path.join(self.directory, f"{name[0]}-{dead_pid()}-{name[2]}"))
+        self.journal.file = None
+
+        self.assertEqual(self.replayer.replay(), 10)
+        self.assertEqual(self.tallies(), ({1: 10, 2: 0}, 10))
+        self.assertEqual(self.journal.pending, {})
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_replaying_a_segment_again_does_not_count_twice(self):
+        for voter_id in range(1, 6):
+            self.journal.accept(1, voter_id, 2, 1, 2, set())
+        self.journal.rotate()
+        [path] = glob.glob(os.path.join(self.directory, '*.journal'))
+        shutil.copy(path, path + '.copy')
+
+        self.replayer.replay()
+        # As if the process died after committing but before removing the segment
+        os.rename(path + '.copy', path)
+
+        self.assertEqual(self.replayer.replay(), 0)
+        self.assertEqual(self.tallies(), ({1: 0, 2: 5}, 5))
+
+    def test_vote_gets_next_free_slot_and_is_rejected_once_none_are_left(self):
+        session = self.session_factory()
+        session.add(Votes(election_id=1, voter_id=1, candidate_id=2, vote_type=1, slot=0))
+        session.add(Votes(election_id=1, voter_id=2, candidate_id=2, vote_type=-1, slot=0))
+        session.commit()
+        session.close()
+
+        # As if both workers read the database before the votes above were written
+        first = self.journal.accept(1, 1, 1, 1, 2, set())
+        second = self.journal.accept(1, 2, 1, -1, 1, set())
+
+        self.assertEqual(self.replayer.replay(), 1)
+        self.assertEqual(self.tallies(), ({1: 1, 2: 0}, 3))
+        self.assertEqual([entry['voter_id'] for entry, _ in
+                          read_entries(os.path.join(self.directory, 'rejected.log'))], [2])
+        # The voter can look up what became of both votes by their journal ids
+        session = self.session_factory()
+        self.assertEqual(session.query(IdempotencyKey.journal_id).filter_by(voter_id=1).scalar(), first['id'])
+        self.assertEqual(session.query(RejectedVote.journal_id, RejectedVote.reason).one(),
+                         (second['id'], "no free slot"))
+        session.close()
+
+    def test_slots_in_the_database_are_checked_by_a_new_worker(self):
+        session = self.session_factory()
+        session.add_all(Votes(election_id=1, voter_id=1, candidate_id=2, vote_type=1, slot=slot) for slot in (0, 1))
+        session.commit()
+
+        # A restarted worker has no claims of its own, only the database knows the slots are used
+        journal = VoteJournal(self.directory)
+        stored = journal.stored_slots(session, 1, 1, 1)
+        session.close()
+        self.assertEqual(stored, {0, 1})
+        self.assertTrue(journal.has_stored_slots(1, 1, 1))
+        self.assertIsNone(journal.accept(1, 1, 1, 1, 2, stored))
+
+    def test_two_workers_claiming_the_same_slot_both_count(self):
+        # Each worker only knows its own journal, so both hand out slot 0
+        other = VoteJournal(self.directory)
+        first = self.journal.accept(1, 1, 1, 1, 2, set())
+        second = other.accept(1, 1, 2, 1, 2, set())
+        third = other.accept(1, 1, 2, 1, 2, set())
+        self.assertEqual((first['slot'], second['slot'], third['slot']), (0, 0, 1))
+        other.rotate()
+
+        self.assertEqual(self.replayer.replay(), 2)
+        session = self.session_factory()
+        self.assertEqual(sorted(session.query(Votes.slot).filter_by(voter_id=1).all()), [(0,), (1,)])
+        session.close()
+        self.assertEqual([entry['id'] for entry, _ in
+                          read_entries(os.path.join(self.directory, 'rejected.log'))], [third['id']])
+        # The worker still remembers the slots it gave out once they are replayed
+        self.assertIsNone(self.journal.accept(1, 1, 1, 1, 1, set()))
+
+    def test_replay_throughput(self):
+        threads = [threading.Thread(target=lambda first=first: [self.journal.accept(1, voter_id, 1 + voter_id % 2,
+                                                                                     1, 2, set())
+                                                                 for voter_id in range(first, first + 100)])
+                   for first in range(1, 1001, 100)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        started = time.perf_counter()
+        replayed = self.replayer.replay()
+        elapsed = time.perf_counter() - started
+
+        self.assertEqual(replayed, 1000)
+        self.assertEqual(self.tallies(), ({1: 500, 2: 500}, 1000))
+        self.assertGreater(replayed / elapsed, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+from unittest.mock import patch
+
+import benchmarks
+
+# The database hot paths, short enough to run with every test run. The full suite is
+# run with: python benchmarks.py
+SUBSET = ['load_identity', 'free_vote_slot', 'load_candidate_list']
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_compare_flags_slowdowns_past_the_threshold(self):
+        baselines = {'calibration': {'relative': 1.0}, 'fast': {'relative': 10.0}, 'slow': {'relative': 10.0}}
+        results = {name: {'seconds': 0.001, 'relative': relative}
+                   for name, relative in (('calibration', 2.0), ('fast', 12.0), ('slow', 13.0), ('new', 5.0))}
+
+        self.assertEqual(benchmarks.compare(results, baselines, 1.25), ['slow'])
+
+    def test_hot_paths_are_within_threshold_of_their_baselines(self):
+        baselines = benchmarks.load_baselines()
+        self.assertTrue(set(SUBSET) <= set(baselines), "run python benchmarks.py --update to record baselines")
+
+        with patch.object(benchmarks, 'REPEATS', 5):
+            regressions = benchmarks.compare(benchmarks.run(SUBSET), baselines, benchmarks.BENCHMARK_THRESHOLD)
+            # Other tests' background threads can slow one run down, a regression has to show up twice
+            if regressions:
+                regressions = benchmarks.compare(benchmarks.run(regressions), baselines,
+                                                 benchmarks.BENCHMARK_THRESHOLD)
+
+        self.assertEqual(regressions, [], f"slower than {benchmarks.BENCHMARK_THRESHOLD}x baseline")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from Models import Base, Constituency, Party, Candidate, Voter, Election
+
+# An in-memory database and the rows most tests start from. Columns a test does not
+# care about get placeholder values, any of them can be given as a keyword instead.
+
+CONSTITUENCY_NAMES = ["Belfast South", "Foyle"]
+
+
+def create_session_factory():
+    # Every session and thread shares the one connection, so they all see the same database
+    engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+def add_election(session, election_id=1):
+    election = Election(election_id=election_id, name="Election", started_at=datetime(2024, 5, 2))
+    session.add(election)
+    return election
+
+
+def add_constituencies(session, count=1):
+    session.add_all(Constituency(constituency_id=constituency_id, constituency_name=name)
+                    for constituency_id, name in enumerate(CONSTITUENCY_NAMES[:count], 1))
+
+
+def add_party(session, party_id=1, **columns):
+    party = Party(**{'party_id': party_id, 'party_name': "Party", 'image': "", 'manifesto': "", **columns})
+    session.add(party)
+    return party
+
+
+def add_candidate(session, candidate_id, constituency_id=1, **columns):
+    candidate = Candidate(**{'candidate_id': candidate_id, 'candidate_firstname': "F",
+                             'candidate_lastname': str(candidate_id), 'party_id': 1, 'vote_count': 0, 'image': "",
+                             'constituency_id': constituency_id, 'statement': "", **columns})
+    session.add(candidate)
+    return candidate
+
+
+def add_voter(session, voter_id, constituency_id=1, **columns):
+    voter = Voter(**{'voter_id': voter_id, 'first_name': "F", 'last_name': "L", 'gov_id': str(voter_id),
+                     'password': "", 'constituency_id': constituency_id, 'email': f"{voter_id}@example.com",
+                     **columns})
+    session.add(voter)
+    return voter
+
+
+def add_voters(session, voter_ids, constituency_id=1):
+    return [add_voter(session, voter_id, constituency_id) for voter_id in voter_ids]
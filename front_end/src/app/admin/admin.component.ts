@@ -4,6 +4,7 @@ import {FormGroup, FormControl, Validators, FormBuilder} from '@angular/forms';
 import { ActivatedRoute } from "@angular/router";
 import {VoteService} from "../services/vote.service";
 import { AuthService } from '../services/auth.service';
+import { map, shareReplay } from 'rxjs/operators';
 
 @Component({
   selector: 'admin',
@@ -17,6 +18,9 @@ export class AdminComponent implements OnInit {
   partyFormGroup: any;
   candidate_list: any = [];
   party_list: any = [];
+  summary: any;
+  page: number = 1;
+  perPage: number = 20;
   currentlyOpenFormId: number | null = null;
   isAdmin: boolean = false;
   showAddPartyForm = false;
@@ -52,8 +56,23 @@ export class AdminComponent implements OnInit {
       manifesto: new FormControl('', Validators.required)
     });
 
-    this.candidate_list = this.webService.getCandidates();
-    this.party_list = this.webService.getParties();
+    this.loadSummary();
+  }
+
+  // One request for the counts and the current page of each list
+  loadSummary() {
+    this.summary = this.webService.getAdminSummary(this.page, this.perPage).pipe(shareReplay(1));
+    this.candidate_list = this.summary.pipe(map((summary: any) => summary.candidates));
+    this.party_list = this.summary.pipe(map((summary: any) => summary.parties));
+  }
+
+  changePage(step: number) {
+    this.page = Math.max(this.page + step, 1);
+    this.loadSummary();
+  }
+
+  hasNextPage(summary: any) {
+    return this.page * this.perPage < Math.max(summary.counts.candidates, summary.counts.parties);
   }
 
 
@@ -89,14 +108,22 @@ export class AdminComponent implements OnInit {
       party_id: new FormControl(candidate.party_id, Validators.required),
       image: new FormControl(candidate.image, Validators.required),
       constituency_id: new FormControl(candidate.constituency_id, Validators.required),
-      statement: new FormControl(candidate.statement, Validators.required)
+      statement: new FormControl('', Validators.required)
+    });
+    // The candidate list only carries an excerpt, so the full statement is fetched for editing
+    this.webService.getCandidate(candidate.candidate_id).subscribe((response: any) => {
+      this.candidateFormGroup.patchValue({statement: response[0]?.statement});
     });
   }
   createPartyForm(party: any) {
     this.partyFormGroup = new FormGroup({
       party_name: new FormControl(party.party_name, Validators.required),
       image: new FormControl(party.image, Validators.required),
-      manifesto: new FormControl(party.manifesto, Validators.required)
+      manifesto: new FormControl('', Validators.required)
+    });
+    // The party list only carries an excerpt, so the full manifesto is fetched for editing
+    this.webService.getParty(party.party_id).subscribe((response: any) => {
+      this.partyFormGroup.patchValue({manifesto: response.manifesto});
     });
   }
 
@@ -157,4 +184,14 @@ export class AdminComponent implements OnInit {
     })
   }
 
+  startElection(name: string){
+    if (!name.trim()) {
+      return;
+    }
+    this.authService.startElection(name.trim()).subscribe( response => {
+      console.log('Election Started', response);
+      this.loadSummary();
+    })
+  }
+
 }
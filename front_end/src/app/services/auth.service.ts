@@ -77,4 +77,9 @@ export class AuthService {
     const headers = new HttpHeaders().set('Authorization', 'Bearer ' + this.getToken());
     return this.http.delete('http://localhost:5000/api/v1.0/votes',{ headers });
   }
+
+  startElection(name: string) {
+    const headers = new HttpHeaders().set('Authorization', 'Bearer ' + this.getToken());
+    return this.http.post('http://localhost:5000/api/v1.0/elections', { name }, { headers });
+  }
 }
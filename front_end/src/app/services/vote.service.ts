@@ -12,10 +12,21 @@ export class VoteService {
               private authService: AuthService) { }
 
   voteForCandidate(voter_id: number, candidate_id: number, vote_type: number) {
-    const headers = new HttpHeaders().set('Authorization', 'Bearer ' + this.authService.getToken());
+    // Retries of this request reuse the key, so the server only counts the vote once
+    const headers = new HttpHeaders()
+      .set('Authorization', 'Bearer ' + this.authService.getToken())
+      .set('Idempotency-Key', crypto.randomUUID());
     return this.http.post('http://localhost:5000/api/v1.0/votes', { voter_id, candidate_id, vote_type }, { headers });
   }
 
+  submitBallot(positive: number[], negative: number[]) {
+    // Every vote on the ballot is counted together, a retry with the same key is only counted once
+    const headers = new HttpHeaders()
+      .set('Authorization', 'Bearer ' + this.authService.getToken())
+      .set('Idempotency-Key', crypto.randomUUID());
+    return this.http.post('http://localhost:5000/api/v1.0/ballots', { positive, negative }, { headers });
+  }
+
   getRemainingVotes(voter_id: string) {
     const headers = new HttpHeaders().set('Authorization', 'Bearer ' + this.authService.getToken());
     return this.http.get<{remaining_positive_votes: number, remaining_negative_votes: number}>('http://localhost:5000/api/v1.0/remaining-votes/'+ voter_id, { headers });
@@ -11,7 +11,7 @@ export class WebService {
 constructor(private http: HttpClient) {}
 
   getParties(){
-    return this.http.get('http://localhost:5000/api/v1.0/parties');
+    return this.http.get('http://localhost:5000/api/v1.0/parties?excerpt=200');
   }
 
   getParty(p_id: any){
@@ -20,7 +20,7 @@ constructor(private http: HttpClient) {}
   }
 
   getCandidates(){
-    return this.http.get('http://localhost:5000/api/v1.0/candidates');
+    return this.http.get('http://localhost:5000/api/v1.0/candidates?excerpt=200');
   }
 
   getCandidate(c_id: any){
@@ -121,6 +121,14 @@ constructor(private http: HttpClient) {}
     return this.http.delete('http://localhost:5000/api/v1.0/parties/' + party_id, { headers: headers });
   }
 
+  getAdminSummary(page: number = 1, perPage: number = 20){
+    const headers = new HttpHeaders({
+      'Authorization': 'Bearer ' + localStorage.getItem('access_token')
+    });
+    return this.http.get('http://localhost:5000/api/v1.0/admin/summary?excerpt=200&page=' + page +
+      '&per_page=' + perPage, { headers: headers });
+  }
+
   getVotingData() {
     return this.http.get('http://localhost:5000/api/v1.0/voting-data');
   }
@@ -19,31 +19,48 @@ export class VoteComponent {
   remaining_positive_votes: any;
   remaining_negative_votes: any;
 
+  // Choices are collected here and sent as one ballot
+  positive_choices: any[] = [];
+  negative_choices: any[] = [];
+
   constructor(public webService: WebService,
               private formBuilder: FormBuilder,
               private voteService: VoteService,
               private authService: AuthService,
               private router: Router) {}
 
-submitVote(vote_type: number, candidate: any) {
-  this.voteService.voteForCandidate(this.voter_id, candidate.candidate_id, vote_type).subscribe(
+submitBallot() {
+  this.voteService.submitBallot(this.positive_choices.map(candidate => candidate.candidate_id),
+                                this.negative_choices.map(candidate => candidate.candidate_id)).subscribe(
     response => {
-      console.log('Vote submitted', response);
-      this.updateRemainingVotes();
+      console.log('Ballot submitted', response);
+      this.positive_choices = [];
+      this.negative_choices = [];
       this.voteService.getRemainingVotes(this.voter_id).subscribe(remainingVotes => {
         console.log('Remaining Votes:', remainingVotes);
+        this.remaining_positive_votes = remainingVotes.remaining_positive_votes;
+        this.remaining_negative_votes = remainingVotes.remaining_negative_votes;
         if (remainingVotes.remaining_positive_votes === 0 && remainingVotes.remaining_negative_votes === 0) {
           this.router.navigate(['/voting-data']);
         }
       });
 
     },
-    error => console.error('Error submitting vote', error)
+    error => console.error('Error submitting ballot', error)
   );
 }
 
   onVoteButtonClick(vote_type: number, candidate: any) {
-    this.submitVote(vote_type, candidate);
+    if (vote_type === 1 && this.positive_choices.length < this.remaining_positive_votes) {
+      this.positive_choices.push(candidate);
+    } else if (vote_type === -1 && this.negative_choices.length < this.remaining_negative_votes) {
+      this.negative_choices.push(candidate);
+    }
+  }
+
+  clearBallot() {
+    this.positive_choices = [];
+    this.negative_choices = [];
   }
 
   ngOnInit() {
@@ -36,6 +36,7 @@ export class VotingDataComponent implements OnInit {
         accumulator.push({
           candidate_name: current.candidate_name,
           candidate_image: current.candidate_image,
+          candidate_thumbnail: current.candidate_thumbnail,
           party_name: current.party_name,
           vote_count: current.vote_count,
         });